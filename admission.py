@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from telegram import Update
+from telegram.error import TelegramError
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+STALE = 'stale'
+COLLAPSED = 'collapsed'
+# seconds an update that is never admitted is remembered, unless max_age is longer
+FORGET_AFTER = 3600
+
+
+def keyboard_age(query, now):
+    """
+    Seconds since the keyboard of a callback query was sent or last edited, None for inline messages
+    """
+    message = query.message
+    if message is None:
+        return None
+    sent = message.edit_date or message.date
+    return now - sent.timestamp() if sent else None
+
+
+class Admission:
+    """
+    Decides which updates the dispatcher runs, in the dispatcher thread before any handler sees them
+    Callback queries on keyboards older than max_age, or that waited in the queue that long, are answered
+    with expired_text instead. A button pressed again within collapse seconds of the same press is dropped
+    """
+
+    def __init__(self, dispatcher, max_age=1800, collapse=1.0, expired_text='', pending=None):
+        self.dispatcher = dispatcher
+        self.max_age = max_age
+        self.collapse = collapse
+        self.expired_text = expired_text
+        # updates handed to the workers but not run yet, see workers.install
+        self.pending = pending
+        self.shed = {STALE: 0, COLLAPSED: 0}
+        # update id -> monotonic time it was received
+        self._received = {}
+        # (user id, message id, data) -> monotonic time the last admitted press was received
+        self._presses = {}
+        self._lock = threading.Lock()
+
+    def depth(self):
+        depth = self.dispatcher.update_queue.qsize()
+        return depth + self.pending() if self.pending else depth
+
+    def received(self, update):
+        if isinstance(update, Update):
+            now = time.monotonic()
+            with self._lock:
+                self._received[update.update_id] = now
+                self._prune_received(now)
+
+    def admit(self, update):
+        """
+        True when the update should be processed, shed updates are answered here
+        """
+        if not isinstance(update, Update):
+            return True
+        with self._lock:
+            received = self._received.pop(update.update_id, None)
+        waited = time.monotonic() - received if received is not None else 0.0
+        query = update.callback_query
+        if query is None:
+            message = update.effective_message
+            if message is not None and message.date and metrics.enabled:
+                metrics.observe(metrics.UPDATE_AGE_METRIC, {'type': 'message'},
+                                max(waited, time.time() - message.date.timestamp()))
+            return True
+
+        age = max(waited, keyboard_age(query, time.time()) or 0.0)
+        if metrics.enabled:
+            metrics.observe(metrics.UPDATE_AGE_METRIC, {'type': 'callback'}, age)
+        if self.max_age and age > self.max_age:
+            return self._shed(update, STALE, self.expired_text)
+
+        if self.collapse and received is not None:
+            key = (query.from_user.id, query.message.message_id if query.message else query.inline_message_id,
+                   query.data)
+            with self._lock:
+                last = self._presses.get(key)
+                if last is not None and received - last < self.collapse:
+                    collapsed = True
+                else:
+                    collapsed = False
+                    self._presses[key] = received
+                    self._prune(received)
+            if collapsed:
+                return self._shed(update, COLLAPSED)
+        return True
+
+    def _shed(self, update, reason, text=None):
+        self.shed[reason] += 1
+        metrics.increment(metrics.SHED_METRIC, {'reason': reason})
+        logger.debug(f'Update {update.update_id} shed, {reason}')
+        # the spinner on the button stops once the query is answered, off the dispatcher thread
+        self.dispatcher.run_async(self._answer, update.callback_query, text)
+        return False
+
+    @staticmethod
+    def _answer(query, text):
+        try:
+            query.answer(text=text or None, show_alert=bool(text))
+        except TelegramError as err:
+            # telegram refuses answers to queries older than a few minutes
+            logger.debug(f'Callback query {query.id} not answered {err}')
+
+    def _prune(self, now):
+        if len(self._presses) > 1000:
+            self._presses = {key: last for key, last in self._presses.items() if now - last < self.collapse}
+
+    def _prune_received(self, now):
+        # updates the dispatcher never took off the queue stay until they are this old
+        if len(self._received) > 1000:
+            forget_after = max(self.max_age, FORGET_AFTER)
+            self._received = {id: received for id, received in self._received.items() if now - received < forget_after}
+
+
+def install(dispatcher, max_age=1800, collapse=1.0, expired_text='', pending=None):
+    """
+    Put the admission in front of the dispatcher, install after workers.install so it runs before the workers
+    """
+    admission = Admission(dispatcher, max_age, collapse, expired_text, pending)
+    update_queue = dispatcher.update_queue
+    put = update_queue.put
+    process_update = dispatcher.process_update
+
+    def receive(update, *args, **kwargs):
+        admission.received(update)
+        put(update, *args, **kwargs)
+
+    def admit(update):
+        if admission.admit(update):
+            process_update(update)
+
+    # the updater and the webhook listeners share this queue
+    update_queue.put = receive
+    dispatcher.process_update = admit
+    metrics.gauge(metrics.UPDATE_QUEUE_METRIC, admission.depth)
+    return admission
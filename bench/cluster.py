@@ -0,0 +1,106 @@
+import argparse
+import multiprocessing
+import threading
+import time
+from queue import Queue
+from telegram import Update
+from telegram.ext import Dispatcher, TypeHandler
+import bot
+import cluster
+import settings
+import workers
+from bench.stub_api import StubApi
+from bench.updates import FakeBot, session
+from webhook import WebhookServer
+
+
+PORT = 8700
+PATH = '/updates'
+SECRET = 'bench'
+
+
+def worker(port, api, threads, processed, ready):
+    """
+    One worker process, the bot conversation behind the same listener cluster workers use
+    """
+    settings.API_HOST = api
+    settings.MEDIA_STREAM = False
+    settings.PERSISTENCE_ENABLED = False
+
+    def count(update, context):
+        with processed.get_lock():
+            processed.value += 1
+
+    dispatcher = Dispatcher(FakeBot(), Queue())
+    dispatcher.add_handler(bot.conversation())
+    dispatcher.add_handler(TypeHandler(Update, count), group=1)
+    # parallel across users, in order for each user, like handlers = ordered
+    workers.install(dispatcher, threads)
+    server = WebhookServer(('127.0.0.1', port), dispatcher.bot, dispatcher.update_queue, PATH, SECRET)
+    threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True).start()
+    ready.set()
+    server.serve_forever()
+
+
+def run(args, processes, stub):
+    """
+    Updates/s of processes workers, every user sends its sessions through the receiver's forwarder
+    """
+    context = multiprocessing.get_context('spawn')
+    processed = context.Value('i', 0)
+    started = []
+    for index in range(processes):
+        ready = context.Event()
+        process = context.Process(target=worker, args=(PORT + index, stub.url, args.threads, processed, ready),
+                                  daemon=True)
+        process.start()
+        started.append((process, ready))
+    for process, ready in started:
+        ready.wait()
+
+    # users new to the stub API for every run, they register in the first round
+    first = 100000 * (processes + 1)
+    fake = FakeBot()
+    updates = [
+        Update.de_json(data, fake)
+        for round in range(args.rounds)
+        for user_id in range(first, first + args.users)
+        for action, data in session(user_id, stub, registered=round > 0)
+    ]
+    forwarder = cluster.Forwarder([f'http://127.0.0.1:{PORT + index}{PATH}' for index in range(processes)], SECRET)
+    begin = time.perf_counter()
+    for update in updates:
+        forwarder.put(update)
+    while processed.value < len(updates):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - begin
+
+    forwarder.stop()
+    for process, ready in started:
+        process.terminate()
+        process.join()
+    return len(updates), elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Updates/s of the bot with 1..n cluster worker processes')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=settings.WORKERS, help='handler threads per worker')
+    parser.add_argument('--users', type=int, default=40)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds the stub API takes per request')
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--stories', type=int, default=20)
+    args = parser.parse_args()
+
+    stub = StubApi(topics=args.topics, stories=args.stories, latency=args.latency).start()
+    baseline = None
+    print(f'{args.users} users x {args.rounds} rounds, {args.latency * 1000:.0f}ms API latency, '
+          f'{args.threads} threads per worker')
+    print(f"{'processes':>10}{'updates':>9}{'seconds':>9}{'updates/s':>11}{'speedup':>9}")
+    for processes in args.processes:
+        count, elapsed = run(args, processes, stub)
+        throughput = count / elapsed
+        baseline = baseline or throughput
+        print(f'{processes:>10}{count:>9}{elapsed:>9.2f}{throughput:>11.1f}{throughput / baseline:>9.2f}')
+    stub.shutdown()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+from telegram import Update
+from telegram.ext import Dispatcher
+import bot
+import logbook
+import metrics
+import settings
+from bench.stub_api import StubApi
+from bench.updates import FakeBot, session
+
+
+# p95 changes smaller than this are noise for handlers that don't touch the API
+MIN_SLOWDOWN = 0.002
+
+_local = threading.local()
+_background = [0]
+_lock = threading.Lock()
+
+
+def count_api_calls():
+    """
+    Count API calls per handled update, calls made outside an update (prefetch) are counted as background
+    """
+    api = logbook.api
+
+    def counted(*args, **kwargs):
+        if getattr(_local, 'calls', None) is not None:
+            _local.calls += 1
+        else:
+            with _lock:
+                _background[0] += 1
+        return api(*args, **kwargs)
+
+    logbook.api = counted
+
+
+def coalesced():
+    return sum(count for (metric, labels), count in metrics.counters() if metric == metrics.COALESCED_METRIC)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def user(dispatcher, stub, user_id, rounds, start, results):
+    start.wait()
+    for round in range(rounds):
+        for action, data in session(user_id, stub, registered=round > 0):
+            update = Update.de_json(data, dispatcher.bot)
+            _local.calls = 0
+            started = time.perf_counter()
+            dispatcher.process_update(update)
+            seconds = time.perf_counter() - started
+            with _lock:
+                results[action].append((seconds, _local.calls))
+            _local.calls = None
+
+
+def run(args):
+    stub = StubApi(topics=args.topics, stories=args.stories, latency=args.latency, seed=args.seed).start()
+    settings.API_HOST = stub.url
+    settings.API_CLIENT = args.client
+    settings.MEDIA_STREAM = False
+    settings.PERSISTENCE_ENABLED = False
+    count_api_calls()
+
+    dispatcher = Dispatcher(FakeBot(), Queue())
+    dispatcher.add_handler(bot.conversation())
+    errors = []
+    dispatcher.add_error_handler(lambda update, context: errors.append(context.error))
+    logbook.sync_topic_index()
+    _background[0] = 0
+    stub.requests.clear()
+    coalesced_before = coalesced()
+
+    results = defaultdict(list)
+    start = threading.Event()
+    threads = [
+        threading.Thread(target=user, args=(dispatcher, stub, 100000 + i, args.rounds, start, results))
+        for i in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    start.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stub.shutdown()
+
+    updates = sum(len(samples) for samples in results.values())
+    return {
+        'users': args.users,
+        'rounds': args.rounds,
+        'latency': args.latency,
+        'client': args.client,
+        'updates': updates,
+        'elapsed': elapsed,
+        'throughput': updates / elapsed,
+        'errors': len(errors),
+        'api_calls': sum(stub.requests.values()),
+        'background_api_calls': _background[0],
+        'coalesced_api_calls': coalesced() - coalesced_before,
+        'endpoints': dict(stub.requests.most_common()),
+        'actions': {
+            action: {
+                'count': len(samples),
+                'p50': percentile([seconds for seconds, calls in samples], 0.5),
+                'p95': percentile([seconds for seconds, calls in samples], 0.95),
+                'p99': percentile([seconds for seconds, calls in samples], 0.99),
+                'api_calls': sum(calls for seconds, calls in samples) / len(samples)
+            }
+            for action, samples in sorted(results.items())
+        }
+    }
+
+
+def report(result):
+    print(f"{result['users']} users x {result['rounds']} rounds, {result['latency'] * 1000:.0f}ms API latency, "
+          f"{result['client']} client")
+    print(f"{result['updates']} updates in {result['elapsed']:.2f}s, {result['throughput']:.1f} updates/s, "
+          f"{result['errors']} errors")
+    print(f"{result['api_calls']} API calls, {result['background_api_calls']} in background, "
+          f"{result['coalesced_api_calls']} answered by a request already in flight")
+    print()
+    print(f"{'action':<18}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'api/action':>12}")
+    for action, stats in result['actions'].items():
+        print(f"{action:<18}{stats['count']:>7}{stats['p50'] * 1000:>9.1f}{stats['p95'] * 1000:>9.1f}"
+              f"{stats['p99'] * 1000:>9.1f}{stats['api_calls']:>12.2f}")
+    print()
+    for endpoint, count in result['endpoints'].items():
+        print(f'{endpoint:<28}{count:>7}')
+
+
+def compare(result, baseline, tolerance):
+    """
+    Actions that got slower at p95 or make more API calls than in the baseline run
+    """
+    regressions = []
+    for action, stats in result['actions'].items():
+        before = baseline['actions'].get(action)
+        if before is None:
+            continue
+        if stats['p95'] > before['p95'] * (1 + tolerance) and stats['p95'] - before['p95'] > MIN_SLOWDOWN:
+            regressions.append(f"{action} p95 {before['p95'] * 1000:.1f}ms -> {stats['p95'] * 1000:.1f}ms")
+        if stats['api_calls'] > before['api_calls'] + 0.01:
+            regressions.append(f"{action} API calls {before['api_calls']:.2f} -> {stats['api_calls']:.2f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive the bot conversation with synthetic updates against a stub API')
+    parser.add_argument('--users', type=int, default=20, help='concurrent users')
+    parser.add_argument('--rounds', type=int, default=5, help='sessions per user')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stub API takes per request')
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--stories', type=int, default=20, help='stories per topic')
+    parser.add_argument('--client', choices=('requests', 'aiohttp'), default=settings.API_CLIENT)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        print()
+        print('\n'.join(regressions) if regressions else 'No regressions')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+
+WORDS = ('morning', 'river', 'garden', 'winter', 'city', 'harbour', 'forest', 'kitchen', 'market', 'station',
+         'bridge', 'island', 'summer', 'mountain', 'village', 'festival', 'concert', 'library', 'beach', 'road')
+TYPE_TEXT = 4
+
+
+class StubApi(ThreadingHTTPServer):
+    """
+    In-memory stand-in for the Logbook REST API with a fixed latency per request
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), topics=200, stories=20, latency=0.0, seed=1):
+        super().__init__(address, StubApiHandler)
+        self.latency = latency
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.users = {}
+        self.topics = {}
+        self.stories = {}
+        self.ids = iter(range(1, 10 ** 9))
+        for i in range(topics):
+            topic = self.add('topics', {'title': f'{self.random.choice(WORDS)} {self.random.choice(WORDS)} {i}'})
+            for j in range(stories):
+                self.add('stories', {'topic': topic['id'], 'type': TYPE_TEXT, 'description': f'story {j}',
+                                     'content': f'text of story {j}', 'user': None})
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def add(self, table, data):
+        with self.lock:
+            item = dict(data, id=next(self.ids))
+            getattr(self, table)[item['id']] = item
+        return item
+
+    def random_topic(self):
+        with self.lock:
+            return self.random.choice(list(self.topics.values()))
+
+    def random_story_id(self):
+        with self.lock:
+            return self.random.choice(list(self.stories)) if self.stories else 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='stub-api', daemon=True).start()
+        return self
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let them wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path, query = self.parse()
+        server = self.server
+        if path == '/users':
+            users = [user for user in list(server.users.values()) if str(user['telegram_id']) == query.get('search')]
+            return self.reply(200, users)
+        match = re.fullmatch(r'/(topics|stories)/(\d+)', path)
+        if match:
+            item = getattr(server, match.group(1)).get(int(match.group(2)))
+            return self.reply(200, item) if item else self.reply(404, {'detail': 'Not found.'})
+        if path == '/topics':
+            search = query.get('search', '').lower()
+            topics = [topic for topic in list(server.topics.values()) if search in topic['title'].lower()]
+            return self.reply(200, self.paginate(sorted(topics, key=lambda topic: -topic['id']), query))
+        if path == '/stories':
+            stories = [story for story in list(server.stories.values()) if str(story['topic']) == query.get('topic')]
+            return self.reply(200, self.paginate(stories, query))
+        self.reply(404, {'detail': 'Not found.'})
+
+    def do_POST(self):
+        path, query = self.parse()
+        data = self.body()
+        if path == '/users':
+            return self.reply(201, self.server.add('users', data))
+        if path == '/topics':
+            return self.reply(201, self.server.add('topics', data))
+        if path == '/stories':
+            # every serializer field is returned, fields the form left out included
+            story = dict({'description': None, 'content': None, 'user': None}, **data)
+            story['topic'] = int(data.get('topic', 0))
+            story['type'] = int(data.get('type', TYPE_TEXT))
+            return self.reply(201, self.server.add('stories', story))
+        self.reply(404, {'detail': 'Not found.'})
+
+    def do_PUT(self):
+        path, query = self.parse()
+        data = self.body()
+        match = re.fullmatch(r'/stories/(\d+)', path)
+        story = match and self.server.stories.get(int(match.group(1)))
+        if not story:
+            return self.reply(404, {'detail': 'Not found.'})
+        story.update(data)
+        self.reply(200, story)
+
+    def do_DELETE(self):
+        path, query = self.parse()
+        match = re.fullmatch(r'/(topics|stories)/(\d+)', path)
+        with self.server.lock:
+            item = match and getattr(self.server, match.group(1)).pop(int(match.group(2)), None)
+        self.reply(204 if item else 404, None)
+
+    def parse(self):
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip('/')
+        # count by endpoint, ids folded like the metrics endpoint label
+        endpoint = re.sub(r'/\d+', '/{id}', path)
+        with self.server.lock:
+            self.server.requests[f'{self.command} {endpoint}'] += 1
+        return path, {name: values[0] for name, values in parse_qs(parts.query).items()}
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            raw = self.read_chunked()
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(raw or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return {name: values[0] for name, values in parse_qs(raw.decode()).items()}
+        # streamed multipart uploads, only the size matters here
+        return {'content': f'{len(raw)} bytes'}
+
+    def read_chunked(self):
+        raw = b''
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return raw
+            raw += self.rfile.read(size)
+            self.rfile.readline()
+
+    def paginate(self, items, query):
+        if 'page_size' not in query:
+            return items
+        size = int(query['page_size'])
+        page = int(query.get('page', 1))
+
+        def link(number):
+            return f"{self.server.url}{urlsplit(self.path).path}?{urlencode(dict(query, page=number))}"
+
+        return {
+            'count': len(items),
+            'next': link(page + 1) if page * size < len(items) else None,
+            'previous': link(page - 1) if page > 1 else None,
+            'results': items[(page - 1) * size:page * size]
+        }
+
+    def reply(self, code, data):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = json.dumps(data).encode() if data is not None else b''
+        headers = {'Content-Type': 'application/json'}
+        if self.command == 'GET' and code == 200:
+            # same validator Django's ConditionalGetMiddleware would give
+            headers['ETag'] = f'"{hashlib.md5(body).hexdigest()}"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                code, body = 304, b''
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a stub Logbook API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--stories', type=int, default=20, help='stories per topic')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    args = parser.parse_args()
+    stub = StubApi(('127.0.0.1', args.port), args.topics, args.stories, args.latency)
+    print(f'Stub API on {stub.url}')
+    stub.serve_forever()
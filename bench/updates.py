@@ -0,0 +1,102 @@
+import itertools
+import threading
+import time
+from telegram import Bot
+import bot
+import settings
+
+
+_ids = itertools.count(1)
+_ids_lock = threading.Lock()
+
+
+def next_id():
+    with _ids_lock:
+        return next(_ids)
+
+
+class FakeBot(Bot):
+    """
+    Bot that answers Bot API calls locally instead of sending them to telegram
+    """
+
+    def __init__(self):
+        super().__init__('123:benchmark')
+        self.calls = 0
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        self.calls += 1
+        data = data or {}
+        if endpoint == 'getMe':
+            return {'id': 123, 'is_bot': True, 'first_name': 'Logbook', 'username': 'logbook_bench_bot'}
+        if endpoint == 'getFile':
+            return {'file_id': data['file_id'], 'file_unique_id': data['file_id'], 'file_size': 1024,
+                    'file_path': f"https://api.telegram.org/file/bot123:benchmark/media/{data['file_id']}"}
+        if endpoint.startswith('send') or endpoint.startswith('edit'):
+            return {'message_id': next_id(), 'date': int(time.time()), 'text': data.get('text', ''),
+                    'chat': {'id': data.get('chat_id', 0), 'type': 'private'}}
+        return True
+
+
+def message(user_id, text=None, **fields):
+    data = {'message_id': next_id(), 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user {user_id}'}, **fields}
+    if text is not None:
+        data['text'] = text
+        if text.startswith('/'):
+            data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': next_id(), 'message': data}
+
+
+def callback(user_id, data):
+    return {'update_id': next_id(), 'callback_query': {
+        'id': str(next_id()), 'chat_instance': str(user_id), 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user {user_id}'},
+        'message': {'message_id': 1, 'date': int(time.time()), 'text': 'Topics',
+                    'chat': {'id': user_id, 'type': 'private'}}
+    }}
+
+
+def photo(user_id):
+    file_id = f'photo{next_id()}'
+    return message(user_id, caption='bench photo',
+                   photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 480}])
+
+
+def video(user_id):
+    file_id = f'video{next_id()}'
+    return message(user_id, caption='bench video',
+                   video={'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 480, 'duration': 5})
+
+
+def session(user_id, stub, registered):
+    """
+    One round of a user's actions as (action, update) pairs, in the order the bot expects them
+    """
+    yield 'start', message(user_id, f'/{bot.COMMAND_START}')
+    if not registered:
+        yield 'register', message(user_id, settings.REGISTRATION_CODE)
+    yield 'browse_topics', callback(user_id, bot.CALLBACK_NEXT)
+    yield 'browse_topics', callback(user_id, bot.CALLBACK_PREVIOUS)
+
+    topic = stub.random_topic()
+    yield 'search_intro', callback(user_id, bot.CALLBACK_SEARCH)
+    yield 'search_topic', message(user_id, topic['title'])
+    yield 'edit_topic', callback(user_id, str(topic['id']))
+    yield 'ask_for_story', callback(user_id, bot.CALLBACK_TEXT)
+    yield 'text_story', message(user_id, 'bench text story')
+    yield 'ask_for_story', callback(user_id, bot.CALLBACK_PHOTO)
+    yield 'photo_story', photo(user_id)
+    yield 'ask_for_story', callback(user_id, bot.CALLBACK_VIDEO)
+    yield 'video_story', video(user_id)
+    yield 'browse_stories', callback(user_id, bot.CALLBACK_STORIES)
+    yield 'browse_stories', callback(user_id, bot.CALLBACK_NEXT)
+    yield 'close_stories', callback(user_id, bot.CALLBACK_BACK)
+    yield 'close_topic', callback(user_id, bot.CALLBACK_BACK)
+
+    yield 'lookup_intro', callback(user_id, bot.CALLBACK_LOOKUP)
+    yield 'lookup_story', message(user_id, str(stub.random_story_id()))
+    yield 'edit_story_intro', callback(user_id, bot.CALLBACK_EDIT)
+    yield 'update_story', message(user_id, 'bench description')
+    yield 'remove_story', callback(user_id, bot.CALLBACK_REMOVE_STORY)
+    yield 'exit', message(user_id, f'/{bot.COMMAND_EXIT}')
@@ -1,8 +1,30 @@
+import argparse
+import gettext
+import json
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import admission
+import cluster
+import importer
 import logbook
-import gettext
-from telegram import (InlineKeyboardMarkup, InlineKeyboardButton)
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler)
+import media
+import metrics
+import profiler
+import resilience
+import workers
+import webhook
+from persistence import SqlitePersistence
+from journal import Journal
+from file_ids import FileIds
+from sessions import Sessions
+from sender import Sender, QueuedBot, BULK, sent
+from telegram import (InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, Update)
+from telegram.error import TelegramError
+from telegram.utils.request import Request
+from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler,
+                          DispatcherHandlerStop, TypeHandler)
 import settings
 
 
@@ -15,6 +37,12 @@ loggingLevel = logging.getLevelName(settings.LOGGING_LEVEL)
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=loggingLevel)
 logger = logging.getLogger(__name__)
 
+# telegram message length limit
+MESSAGE_SIZE = 4096
+# telegram limits of media captions and of photos in one media group
+CAPTION_SIZE = 1024
+MEDIA_GROUP_SIZE = 10
+
 # stories types
 TYPE_PHOTO = 1
 TYPE_ALBUM = 2
@@ -30,13 +58,25 @@ SELECT_STORY_TYPE, EDIT_STORY, VIDEO_STORY, PHOTO_STORY, TEXT_STORY, UPDATE_STOR
 # callbacks
 (CALLBACK_VIDEO, CALLBACK_PHOTO, CALLBACK_TEXT, CALLBACK_BACK, CALLBACK_EDIT, CALLBACK_SEARCH, CALLBACK_NEW,
  CALLBACK_LOOKUP, CALLBACK_REMOVE_TOPIC, CALLBACK_REMOVE_STORY) = map(chr, range(14, 24))
+CALLBACK_NEXT, CALLBACK_PREVIOUS, CALLBACK_STORIES = map(chr, range(24, 27))
+
+# stories browser state
+BROWSE_STORIES = chr(27)
 
 # commands
 COMMAND_START = 'start'
 COMMAND_EXIT = 'exit'
 COMMAND_HELP = 'help'
+COMMAND_STATS = 'stats'
+COMMAND_IMPORT = 'import'
+COMMAND_SESSIONS = 'sessions'
+COMMAND_PROFILE = 'profile'
 
 PHOTO_SIZE = 640
+STORY_PREVIEW_SIZE = 80
+
+# guards bot_data['albums'], media_group_id -> album being collected
+albums_lock = threading.Lock()
 
 
 def start(update, context):
@@ -49,19 +89,8 @@ def start(update, context):
         else:
             return register_intro(update)
 
-    buttons = []
-    topics = logbook.get_latest_topics()
-    if topics['status']:
-        context.user_data['topics'] = topics['data']
-        for topic in topics['data']:
-            buttons.append([InlineKeyboardButton(text=topic['title'], callback_data=topic['id'])])
-    buttons.append([
-        InlineKeyboardButton(text=_('search-topic'), callback_data=CALLBACK_SEARCH),
-        InlineKeyboardButton(text=_('new-topic'), callback_data=CALLBACK_NEW),
-        InlineKeyboardButton(text=_('lookup-story'), callback_data=CALLBACK_LOOKUP)
-    ])
-
-    reply_markup = InlineKeyboardMarkup(buttons)
+    topics = logbook.get_topics_page()
+    reply_markup = topics_keyboard(context, topics)
     text = context.user_data.pop('flash', _('latest-topics'))
 
     if context.user_data.get('start_over'):
@@ -74,6 +103,46 @@ def start(update, context):
     return SELECT_TOPIC
 
 
+def browse_topics(update, context):
+    logger.debug('Browse topics')
+
+    direction = 'next' if update.callback_query.data == CALLBACK_NEXT else 'previous'
+    cursor = context.user_data.get('topics_page', {}).get(direction)
+    topics = logbook.get_topics_page(cursor)
+    reply_markup = topics_keyboard(context, topics)
+    update.callback_query.edit_message_text(text=update.callback_query.message.text, reply_markup=reply_markup)
+    return SELECT_TOPIC
+
+
+def topics_keyboard(context, topics):
+    buttons = []
+    if topics['status']:
+        page = topics['data']
+        # topics are looked up by id in the shared topic table, user_data keeps only the cursors
+        context.user_data.pop('topics', None)
+        context.user_data['topics_page'] = {'next': page['next'], 'previous': page['previous']}
+        for topic in page['results']:
+            buttons.append([InlineKeyboardButton(text=topic['title'], callback_data=topic['id'])])
+        pages = page_buttons(page)
+        if pages:
+            buttons.append(pages)
+    buttons.append([
+        InlineKeyboardButton(text=_('search-topic'), callback_data=CALLBACK_SEARCH),
+        InlineKeyboardButton(text=_('new-topic'), callback_data=CALLBACK_NEW),
+        InlineKeyboardButton(text=_('lookup-story'), callback_data=CALLBACK_LOOKUP)
+    ])
+    return InlineKeyboardMarkup(buttons)
+
+
+def page_buttons(page):
+    buttons = []
+    if page['previous']:
+        buttons.append(InlineKeyboardButton(text=_('previous-page'), callback_data=CALLBACK_PREVIOUS))
+    if page['next']:
+        buttons.append(InlineKeyboardButton(text=_('next-page'), callback_data=CALLBACK_NEXT))
+    return buttons
+
+
 def register_intro(update):
     logger.debug('Registration intro')
 
@@ -109,44 +178,11 @@ def edit_topic(update, context):
     logger.debug('Editing topic')
 
     if context.user_data.get('topic_start_over'):
-        topic_id = context.user_data.get('topic_id')
-        topic = logbook.get_topic_by_id(context.user_data.get('topics'), topic_id)
-        stories_count = logbook.get_topic_stories_count(topic_id)
-        buttons = [
-            [InlineKeyboardButton(text=_('video'), callback_data=CALLBACK_VIDEO),
-             InlineKeyboardButton(text=_('photo'), callback_data=CALLBACK_PHOTO),
-             InlineKeyboardButton(text=_('text'), callback_data=CALLBACK_TEXT)],
-            [InlineKeyboardButton(text=_('back'), callback_data=CALLBACK_BACK)]
-        ]
-        if stories_count == 0:
-            buttons[1].append(InlineKeyboardButton(text=_('remove'), callback_data=CALLBACK_REMOVE_TOPIC))
-        reply_markup = InlineKeyboardMarkup(buttons)
-        text = _('topic-info {topic_title} {stories_count}').format(
-            topic_title=topic['title'],
-            stories_count=stories_count
-        )
-        flash = context.user_data.pop('flash')
-        if flash:
-            text = f'{flash}\n{text}'
+        text, reply_markup = topic_info(context.user_data, context.user_data.pop('flash', None))
         update.message.reply_text(text=text, reply_markup=reply_markup)
     else:
-        topic_id = int(update.callback_query.data)
-        context.user_data['topic_id'] = topic_id
-        topic = logbook.get_topic_by_id(context.user_data.get('topics'), topic_id)
-        stories_count = logbook.get_topic_stories_count(topic_id)
-        buttons = [
-            [InlineKeyboardButton(text=_('video'), callback_data=CALLBACK_VIDEO),
-             InlineKeyboardButton(text=_('photo'), callback_data=CALLBACK_PHOTO),
-             InlineKeyboardButton(text=_('text'), callback_data=CALLBACK_TEXT)],
-            [InlineKeyboardButton(text=_('back'), callback_data=CALLBACK_BACK)]
-        ]
-        if stories_count == 0:
-            buttons[1].append(InlineKeyboardButton(text=_('remove'), callback_data=CALLBACK_REMOVE_TOPIC))
-        reply_markup = InlineKeyboardMarkup(buttons)
-        text = _('topic-info {topic_title} {stories_count}').format(
-            topic_title=topic['title'],
-            stories_count=stories_count
-        )
+        context.user_data['topic_id'] = int(update.callback_query.data)
+        text, reply_markup = topic_info(context.user_data)
         update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
 
     context.user_data['topic_start_over'] = False
@@ -154,6 +190,78 @@ def edit_topic(update, context):
     return SELECT_STORY_TYPE
 
 
+def topic_info(user_data, flash=None):
+    topic_id = user_data.get('topic_id')
+    topic = get_topic(user_data, topic_id)
+    stories_count = logbook.get_topic_stories_count(topic_id)
+    buttons = [
+        [InlineKeyboardButton(text=_('video'), callback_data=CALLBACK_VIDEO),
+         InlineKeyboardButton(text=_('photo'), callback_data=CALLBACK_PHOTO),
+         InlineKeyboardButton(text=_('text'), callback_data=CALLBACK_TEXT)],
+        [InlineKeyboardButton(text=_('back'), callback_data=CALLBACK_BACK)]
+    ]
+    if stories_count == 0:
+        buttons[1].append(InlineKeyboardButton(text=_('remove'), callback_data=CALLBACK_REMOVE_TOPIC))
+    else:
+        buttons[1].insert(0, InlineKeyboardButton(text=_('stories'), callback_data=CALLBACK_STORIES))
+    reply_markup = InlineKeyboardMarkup(buttons)
+    text = _('topic-info {topic_title} {stories_count}').format(
+        topic_title=topic['title'],
+        stories_count=stories_count
+    )
+    if flash:
+        text = f'{flash}\n{text}'
+    return text, reply_markup
+
+
+def get_topic(user_data, topic_id):
+    topic = logbook.get_topic_by_id(topic_id)
+    if topic is None:
+        # not seen by this process yet, a button sent before a restart
+        result = logbook.lookup_topic(topic_id)
+        topic = result['data'] if result['status'] else {'id': topic_id, 'title': f'#{topic_id}'}
+    return topic
+
+
+def browse_stories(update, context):
+    logger.debug('Browse stories')
+
+    topic_id = context.user_data.get('topic_id')
+    if update.callback_query.data == CALLBACK_STORIES:
+        cursor = None
+    else:
+        direction = 'next' if update.callback_query.data == CALLBACK_NEXT else 'previous'
+        cursor = context.user_data.get('stories_page', {}).get(direction)
+    stories = logbook.get_stories_page(topic_id, cursor)
+
+    topic = get_topic(context.user_data, topic_id)
+    text = _('topic-stories {topic_title}').format(topic_title=topic['title'])
+    buttons = []
+    if stories['status']:
+        page = stories['data']
+        context.user_data['stories_page'] = {'next': page['next'], 'previous': page['previous']}
+        for story in page['results']:
+            text = f"{text}\n#{story['id']} {(story['description'] or '')[:STORY_PREVIEW_SIZE]}"
+        pages = page_buttons(page)
+        if pages:
+            buttons.append(pages)
+    else:
+        logger.error(f"Browse stories {stories['error']}")
+    buttons.append([InlineKeyboardButton(text=_('back'), callback_data=CALLBACK_BACK)])
+
+    update.callback_query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(buttons))
+    return BROWSE_STORIES
+
+
+def close_stories(update, context):
+    logger.debug('Closing stories')
+
+    context.user_data.pop('stories_page', None)
+    text, reply_markup = topic_info(context.user_data)
+    update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
+    return SELECT_STORY_TYPE
+
+
 def search_topic_intro(update, context):
     logger.debug('Search topic intro')
 
@@ -165,20 +273,9 @@ def search_topic_intro(update, context):
 def search_topic(update, context):
     logger.debug('Searching for topic')
 
-    buttons = []
-    topics = logbook.search_topics(update.message.text)
-    if topics['status']:
-        context.user_data['topics'] = topics['data']
-        for topic in topics['data']:
-            buttons.append([InlineKeyboardButton(text=topic['title'], callback_data=topic['id'])])
-    buttons.append([
-        InlineKeyboardButton(text=_('search-topic'), callback_data=CALLBACK_SEARCH),
-        InlineKeyboardButton(text=_('new-topic'), callback_data=CALLBACK_NEW),
-        InlineKeyboardButton(text=_('lookup-story'), callback_data=CALLBACK_LOOKUP)
-    ])
-
-    reply_markup = InlineKeyboardMarkup(buttons)
-    text = _('search-results') if topics['status'] and len(topics['data']) > 0 else _('nothing-found')
+    topics = logbook.get_topics_page(search=update.message.text)
+    reply_markup = topics_keyboard(context, topics)
+    text = _('search-results') if topics['status'] and topics['data']['count'] > 0 else _('nothing-found')
     update.message.reply_text(text=text, reply_markup=reply_markup)
     context.user_data['start_over'] = False
 
@@ -235,20 +332,14 @@ def lookup_story(update, context):
         }
 
     if story['status']:
+        context.user_data['story_topic_id'] = story['data'].get('topic')
         text = _('story-info {id} {description}').format(
             id=story['data']['id'],
             description=story['data']['description']
         )
+        urls = media_urls(story['data'])
         if story['data']['type'] == TYPE_TEXT:
             text = f"{text}\n{story['data']['content']}"
-        elif story['data']['type'] == TYPE_PHOTO:
-            text = f"{text}\n{settings.SITE}/media/images/{PHOTO_SIZE}_{story['data']['content']}"
-        elif story['data']['type'] == TYPE_ALBUM:
-            # TODO
-            pass
-        elif story['data']['type'] == TYPE_VIDEO:
-            text = f"{text}\n{settings.SITE}/media/videos/{PHOTO_SIZE}_{story['data']['content']}"
-            pass
         buttons = [[
             InlineKeyboardButton(text=_('remove'), callback_data=CALLBACK_REMOVE_STORY),
             InlineKeyboardButton(text=_('edit'), callback_data=CALLBACK_EDIT),
@@ -257,17 +348,114 @@ def lookup_story(update, context):
     else:
         text = _('story-not-found {id}').format(id=story_id)
         logger.error(f"Lookup story {story['error']}")
+        urls = []
         buttons = [[
             InlineKeyboardButton(text=_('lookup-again'), callback_data=CALLBACK_LOOKUP),
             InlineKeyboardButton(text=_('back'), callback_data=CALLBACK_BACK)
         ]]
 
     reply_markup = InlineKeyboardMarkup(buttons)
-    update.message.reply_text(text=text, reply_markup=reply_markup)
+    if not urls or not reply_media(update, context, story['data'], urls, text, reply_markup):
+        # media telegram could not send is linked instead
+        text = '\n'.join([text, *urls])
+        update.message.reply_text(text=text, reply_markup=reply_markup)
 
     return EDIT_STORY
 
 
+def media_urls(story):
+    if story['type'] == TYPE_PHOTO:
+        return [f"{settings.SITE}/media/images/{PHOTO_SIZE}_{story['content']}"]
+    if story['type'] == TYPE_ALBUM:
+        return [f'{settings.SITE}/media/images/{PHOTO_SIZE}_{photo}' for photo in album_photos(story['content'])]
+    if story['type'] == TYPE_VIDEO:
+        return [f"{settings.SITE}/media/videos/{PHOTO_SIZE}_{story['content']}"]
+    return []
+
+
+def reply_media(update, context, story, urls, caption, reply_markup):
+    """
+    Send the photos or video of a story by telegram file_id, by URL the first time
+    Telegram fetches a URL from the media server on every send, a file_id it already has
+    Returns False when the media could not be sent
+    """
+    store = context.bot_data.get('file_ids')
+    file_ids = store.get(story['id']) if store else None
+    if file_ids and len(file_ids) != len(urls):
+        # taken before the story changed
+        file_ids = None
+
+    try:
+        if file_ids:
+            messages = send_media(update, story['type'], file_ids, caption, reply_markup, fallback=urls)
+        else:
+            messages = send_media(update, story['type'], urls, caption, reply_markup)
+    except TelegramError as err:
+        logger.error(f"Story {story['id']} media send failed {err}")
+        if file_ids:
+            store.forget(story['id'])
+        return False
+    sent_ids = [media_file_id(message) for message in messages]
+    if store and None not in sent_ids and sent_ids != file_ids:
+        store.put(story['id'], sent_ids)
+    return True
+
+
+def send_media(update, story_type, media, caption, reply_markup, fallback=None):
+    """
+    Reply with photos or a video given as file_ids or URLs, returns the sent messages
+    A send of file_ids telegram refuses is made again with the same part of fallback
+    """
+    separate = story_type == TYPE_ALBUM or len(caption) > CAPTION_SIZE
+    kwargs = {} if separate else {'caption': caption, 'reply_markup': reply_markup}
+    if story_type == TYPE_ALBUM:
+        messages = []
+        for offset in range(0, len(media), MEDIA_GROUP_SIZE):
+            group = slice(offset, offset + MEDIA_GROUP_SIZE)
+            # groups already delivered are not sent again when a later one falls back
+            messages.extend(send_or_fall_back(
+                lambda photos: sent(update.message.reply_media_group([InputMediaPhoto(photo) for photo in photos])),
+                media[group], fallback[group] if fallback else None))
+    elif story_type == TYPE_VIDEO:
+        messages = [send_or_fall_back(lambda video: sent(update.message.reply_video(video[0], **kwargs)),
+                                      media, fallback)]
+    else:
+        messages = [send_or_fall_back(lambda photo: sent(update.message.reply_photo(photo[0], **kwargs)),
+                                      media, fallback)]
+    if separate:
+        # albums can't have buttons and captions have their own length limit
+        update.message.reply_text(text=caption, reply_markup=reply_markup)
+    return messages
+
+
+def send_or_fall_back(send, media, fallback=None):
+    try:
+        return send(media)
+    except TelegramError as err:
+        if fallback is None:
+            raise
+        # file_ids don't survive a change of the bot token, they are taken again from the URL send
+        logger.warning(f'Send by file_id failed, sending by URL {err}')
+        return send(fallback)
+
+
+def media_file_id(message):
+    if message.photo:
+        return message.photo[-1].file_id
+    # telegram may keep a video without sound as an animation
+    media = message.video or message.animation or message.document
+    return media.file_id if media else None
+
+
+def album_photos(content):
+    if isinstance(content, list):
+        return content
+    try:
+        return json.loads(content)
+    except ValueError:
+        return [content]
+
+
 def update_story(update, context):
     logger.debug('Update story')
 
@@ -295,8 +483,12 @@ def remove_story(update, context):
     logger.debug('Remove story')
 
     story_id = context.user_data.pop('story_id', None)
-    result = logbook.remove_story(story_id)
+    topic_id = context.user_data.pop('story_topic_id', None)
+    result = logbook.remove_story(story_id, topic_id)
     if result['status']:
+        store = context.bot_data.get('file_ids')
+        if store:
+            store.forget(story_id)
         context.user_data['flash'] = _('story-removed {id}').format(id=story_id)
     else:
         context.user_data['flash'] = _('could-not-remove-story {id}').format(id=story_id)
@@ -336,15 +528,8 @@ def video_story(update, context):
         'user': context.user_data['user']['id'],
         'content': video_file.file_path
     }
-    result = logbook.create_story(data)
-
-    if result['status']:
-        context.user_data['flash'] = _('story-created {id} {description}').format(
-            id=result['data']['id'],
-            description=result['data']['description']
-        )
-    else:
-        logger.error(f"Text story create {result['error']}")
+    context.user_data['flash'] = save_story(context, update.effective_chat.id, data, stream=True,
+                                            file_ids=[update.message.video.file_id])
 
     context.user_data['topic_start_over'] = True
     return edit_topic(update, context)
@@ -353,6 +538,9 @@ def video_story(update, context):
 def photo_story(update, context):
     logger.debug('Photo story')
 
+    if update.message.media_group_id:
+        return album_story(update, context)
+
     photo_file = update.message.photo[-1].get_file()
     data = {
         'type': TYPE_PHOTO,
@@ -361,18 +549,91 @@ def photo_story(update, context):
         'user': context.user_data['user']['id'],
         'content': photo_file.file_path
     }
-    result = logbook.create_story(data)
+    context.user_data['flash'] = save_story(context, update.effective_chat.id, data, stream=True,
+                                            file_ids=[update.message.photo[-1].file_id])
 
-    if result['status']:
-        context.user_data['flash'] = _('story-created {id} {description}').format(
+    context.user_data['topic_start_over'] = True
+    return edit_topic(update, context)
+
+
+def album_story(update, context):
+    logger.debug('Album story')
+
+    group_id = update.message.media_group_id
+    with albums_lock:
+        albums = context.bot_data.setdefault('albums', {})
+        album = albums.get(group_id)
+        if album is None:
+            album = albums[group_id] = {
+                'chat_id': update.effective_chat.id,
+                'user_id': update.effective_user.id,
+                'description': None,
+                'messages': []
+            }
+            context.job_queue.run_once(create_album, settings.ALBUM_WINDOW, context=group_id)
+        album['messages'].append(update.message)
+        if update.message.caption:
+            album['description'] = update.message.caption
+
+    # the album is created once all its photos arrived, see create_album
+    return PHOTO_STORY
+
+
+def create_album(context):
+    logger.debug('Create album')
+
+    with albums_lock:
+        album = context.bot_data['albums'].pop(context.job.context)
+    user_data = context.dispatcher.user_data[album['user_id']]
+    messages = sorted(album['messages'], key=lambda message: message.message_id)
+    try:
+        with ThreadPoolExecutor(max_workers=len(messages)) as pool:
+            paths = list(pool.map(lambda message: message.photo[-1].get_file().file_path, messages))
+    except TelegramError as err:
+        # the photos are gone with the job, the user is asked to send the album again
+        logger.error(f'Album {context.job.context} file paths not received {err}')
+        flash = _('could-not-create-story')
+    else:
+        data = {
+            'type': TYPE_ALBUM,
+            'description': album['description'],
+            'topic': user_data['topic_id'],
+            'user': user_data['user']['id'],
+            'content': json.dumps(paths)
+        }
+        flash = save_story(context, album['chat_id'], data,
+                           file_ids=[message.photo[-1].file_id for message in messages]) \
+            or _('could-not-create-story')
+
+    text, reply_markup = topic_info(user_data, flash)
+    context.bot.send_message(chat_id=album['chat_id'], text=text, reply_markup=reply_markup)
+
+
+def save_story(context, chat_id, data, stream=False, file_ids=None):
+    journal = context.bot_data.get('journal')
+    if journal:
+        # the story id is not known yet, its file_ids are taken on the first lookup
+        # media is not streamed from the journal, the API gets the telegram file path
+        pending_id = journal.put(data, chat_id)
+        return _('story-queued {id}').format(id=pending_id)
+
+    if stream and settings.MEDIA_STREAM:
+        # upload the file ourselves instead of sending the telegram file path
+        result = media.upload_story(data, data['content'])
+    else:
+        result = logbook.create_story(data)
+    if not result['status']:
+        logger.error(f"Story create {result['error']}")
+        return None
+    store = context.bot_data.get('file_ids')
+    if store and file_ids:
+        store.put(result['data']['id'], file_ids)
+    if result['data'].get('description'):
+        return _('story-created {id} {description}').format(
             id=result['data']['id'],
             description=result['data']['description']
         )
-    else:
-        logger.error(f"Text story create {result['error']}")
-
-    context.user_data['topic_start_over'] = True
-    return edit_topic(update, context)
+    return _('story-created {id}').format(id=result['data']['id'])
 
 
 def text_story(update, context):
@@ -385,12 +646,7 @@ def text_story(update, context):
         'user': context.user_data['user']['id'],
         'content': update.message.text
     }
-    result = logbook.create_story(data)
-
-    if result['status']:
-        context.user_data['flash'] = _('story-created {id}').format(id=result['data']['id'])
-    else:
-        logger.error(f"Text story create {result['error']}")
+    context.user_data['flash'] = save_story(context, update.effective_chat.id, data)
 
     context.user_data['topic_start_over'] = True
     return edit_topic(update, context)
@@ -458,23 +714,132 @@ def nested_help(update, context):
     return STOPPING
 
 
+def stats(update, context):
+    logger.debug('Stats')
+
+    lines = metrics.summary()
+    text = '\n'.join(lines) if lines else _('no-stats')
+    update.message.reply_text(text=text[:MESSAGE_SIZE])
+    # admin command, the conversation never sees it
+    raise DispatcherHandlerStop()
+
+
+def sessions_report(update, context):
+    logger.debug('Sessions')
+
+    text = '\n'.join(context.bot_data['sessions'].report())
+    update.message.reply_text(text=text[:MESSAGE_SIZE])
+    raise DispatcherHandlerStop()
+
+
+def session_expired(update, context):
+    logger.debug('Session expired')
+
+    # /start begins a new conversation, anything else would go unanswered
+    if update.callback_query:
+        update.callback_query.answer(text=_('session-expired'), show_alert=True)
+    elif update.message and update.message.text != f'/{COMMAND_START}':
+        update.message.reply_text(text=_('session-expired'))
+
+
+def profile(update, context):
+    logger.debug('Profile')
+
+    try:
+        seconds = int(context.args[0]) if context.args else settings.PROFILE_SECONDS
+    except ValueError:
+        seconds = settings.PROFILE_SECONDS
+    seconds = max(1, min(seconds, settings.PROFILE_MAX_SECONDS))
+    update.message.reply_text(text=_('profile-started {seconds}').format(seconds=seconds))
+    threading.Thread(target=run_profile, args=(context.bot, update.effective_chat.id, seconds),
+                     name='profile', daemon=True).start()
+    raise DispatcherHandlerStop()
+
+
+def run_profile(bot, chat_id, seconds):
+    report = profiler.sample(seconds, settings.PROFILE_TOP)
+    if report is None:
+        bot.send_message(chat_id=chat_id, text=_('profile-busy'), priority=BULK)
+        return
+    filename = profiler.file_name()
+    try:
+        # kept on disk as well, a report too large for telegram can still be read there
+        filename = os.path.basename(profiler.save(report, settings.PROFILE_DIR))
+    except OSError as err:
+        logger.error(f'Profile not written to {settings.PROFILE_DIR} {err}')
+    try:
+        # bytes rather than a file, a retried send reads them again
+        sent(bot.send_document(chat_id=chat_id, document=report.encode(), filename=filename))
+    except TelegramError as err:
+        logger.error(f'Profile {filename} not sent {err}')
+
+
+def import_help(update, context):
+    logger.debug('Import help')
+
+    update.message.reply_text(text=_('import-help'))
+    raise DispatcherHandlerStop()
+
+
+def import_document(update, context):
+    logger.debug('Import document')
+
+    document = update.message.document
+    document_format = importer.detect_format(document.file_name)
+    user = logbook.get_telegram_user(update.effective_user.id)
+    if document_format is None:
+        update.message.reply_text(text=_('import-help'))
+    elif not user['status']:
+        update.message.reply_text(text=_('import-not-registered'))
+    else:
+        # named after the content, sending the same document again resumes its import
+        os.makedirs(settings.IMPORT_DIR, exist_ok=True)
+        path = os.path.join(settings.IMPORT_DIR, f'{document.file_unique_id}.{document_format}')
+        document.get_file().download(custom_path=path)
+        update.message.reply_text(text=_('import-started {name}').format(name=document.file_name))
+        threading.Thread(target=run_import, args=(context.bot, update.effective_chat.id, path, user['data']['id']),
+                         name='import', daemon=True).start()
+    # admin command, the conversation never sees it
+    raise DispatcherHandlerStop()
+
+
+def run_import(bot, chat_id, path, user_id):
+    try:
+        report = importer.Import(path, user=user_id, batch_size=settings.IMPORT_BATCH_SIZE,
+                                 workers=settings.IMPORT_WORKERS).run()
+        text = '\n'.join(importer.summary(report))
+    except Exception as err:
+        logger.exception(f'Import of {path} failed')
+        text = _('import-failed {error}').format(error=err)
+    bot.send_message(chat_id=chat_id, text=text[:MESSAGE_SIZE], priority=BULK)
+
+
+def sync_topic_index(context):
+    result = logbook.sync_topic_index()
+    if not result['status']:
+        logger.error(f"Topic index sync {result['error']}")
+
+
 def error(update, context):
     logger.error(f'{context.error} with update \n{update}')
 
 
-def main():
-    updater = Updater(settings.TELEGRAM_TOKEN, use_context=True)
-    dp = updater.dispatcher
+def conversation():
+    """
+    Main conversation with the nested topic conversation, shared by main() and the benchmark
+    """
+    select_story_type = [
+        CallbackQueryHandler(ask_for_story, pattern=f'^{CALLBACK_TEXT}|{CALLBACK_PHOTO}|{CALLBACK_VIDEO}$'),
+        CallbackQueryHandler(browse_stories, pattern=f'^{CALLBACK_STORIES}$'),
+        CallbackQueryHandler(remove_topic, pattern=f'^{CALLBACK_REMOVE_TOPIC}$'),
+        CallbackQueryHandler(close_topic, pattern=f'^{CALLBACK_BACK}$')
+    ]
 
     # Edit topic stories conversation
     topic_conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(edit_topic, pattern='^\d+$')],
         states={
-            SELECT_STORY_TYPE: [
-                CallbackQueryHandler(ask_for_story, pattern=f'^{CALLBACK_TEXT}|{CALLBACK_PHOTO}|{CALLBACK_VIDEO}$'),
-                CallbackQueryHandler(remove_topic, pattern=f'^{CALLBACK_REMOVE_TOPIC}$'),
-                CallbackQueryHandler(close_topic, pattern=f'^{CALLBACK_BACK}$')
-            ],
+            SELECT_STORY_TYPE: select_story_type,
             VIDEO_STORY: [
                 MessageHandler(Filters.video, video_story),
                 MessageHandler(Filters.photo, invalid_attachment),
@@ -482,9 +847,15 @@ def main():
             ],
             PHOTO_STORY: [
                 MessageHandler(Filters.photo, photo_story),
-                MessageHandler(Filters.document, invalid_attachment)
+                MessageHandler(Filters.document, invalid_attachment),
+                # album photos keep the conversation here, its topic keyboard is answered from this state
+                *select_story_type
             ],
-            TEXT_STORY: [MessageHandler(Filters.text, text_story)]
+            TEXT_STORY: [MessageHandler(Filters.text, text_story)],
+            BROWSE_STORIES: [
+                CallbackQueryHandler(browse_stories, pattern=f'^{CALLBACK_NEXT}|{CALLBACK_PREVIOUS}$'),
+                CallbackQueryHandler(close_stories, pattern=f'^{CALLBACK_BACK}$')
+            ]
         },
         fallbacks=[
             CommandHandler(COMMAND_EXIT, close_nested),
@@ -493,7 +864,9 @@ def main():
         map_to_parent={
             STOPPING: STOPPING,
             ConversationHandler.END: SELECT_TOPIC
-        }
+        },
+        name='topic',
+        persistent=settings.PERSISTENCE_ENABLED
     )
 
     # Main conversation
@@ -502,6 +875,7 @@ def main():
         states={
             SELECT_TOPIC: [
                 topic_conv,
+                CallbackQueryHandler(browse_topics, pattern=f'^{CALLBACK_NEXT}|{CALLBACK_PREVIOUS}$'),
                 CallbackQueryHandler(search_topic_intro, pattern=f'^{CALLBACK_SEARCH}$'),
                 CallbackQueryHandler(create_topic_intro, pattern=f'^{CALLBACK_NEW}$'),
                 CallbackQueryHandler(lookup_story_intro, pattern=f'^{CALLBACK_LOOKUP}$'),
@@ -521,16 +895,161 @@ def main():
         fallbacks=[
             CommandHandler(COMMAND_EXIT, end),
             CommandHandler(COMMAND_HELP, help)
-        ]
+        ],
+        name='main',
+        persistent=settings.PERSISTENCE_ENABLED
     )
 
     main_conv.states[STOPPING] = main_conv.entry_points
+    if settings.API_DEADLINE:
+        # API calls of one update share a budget, a slow API can't hold a worker for retries of every call
+        wrap_callbacks(main_conv, lambda callback: resilience.budgeted(callback, settings.API_DEADLINE))
+    return main_conv
+
+
+def wrap_callbacks(handler, wrap, seen=None):
+    """
+    Replace every callback of a handler with wrap(callback), nested conversations included
+    """
+    seen = set() if seen is None else seen
+    if id(handler) in seen:
+        return
+    seen.add(id(handler))
+    if isinstance(handler, ConversationHandler):
+        for nested in handler.entry_points + handler.fallbacks:
+            wrap_callbacks(nested, wrap, seen)
+        for handlers in handler.states.values():
+            for nested in handlers:
+                wrap_callbacks(nested, wrap, seen)
+    else:
+        handler.callback = wrap(handler.callback)
+
+
+def conversation_handlers(handler):
+    """
+    The conversation and the conversations nested in it
+    """
+    found = [handler]
+    for handlers in handler.states.values():
+        for nested in handlers:
+            if isinstance(nested, ConversationHandler) and nested not in found:
+                found.extend(conversation_handlers(nested))
+    return found
+
+
+def main(worker=None):
+    """
+    Run the bot, as one of the cluster workers when worker is given, see cluster.py
+    """
+    owns = None
+    rate = settings.SENDER_RATE
+    if worker is not None:
+        partitions = cluster.size()
+        # users of other workers share the database, the telegram flood limit is shared by all workers
+        owns = lambda user_id: cluster.partition(user_id, partitions) == worker
+        rate = settings.SENDER_RATE / partitions
+        if settings.HTTP_CACHE_ENABLED:
+            logbook.open_http_cache(cluster.worker_path(settings.HTTP_CACHE_PATH, worker))
+    persistence = None
+    if settings.PERSISTENCE_ENABLED:
+        persistence = SqlitePersistence(settings.PERSISTENCE_PATH, settings.PERSISTENCE_FLUSH_INTERVAL, owns)
+    sender = None
+    if settings.SENDER_ENABLED:
+        sender = Sender(rate, settings.SENDER_CHAT_RATE, settings.SENDER_CHAT_BURST,
+                        settings.SENDER_WORKERS, settings.SENDER_MAX_RETRIES)
+    # connections for the dispatcher workers, the sender workers and the updater itself
+    request = Request(con_pool_size=settings.WORKERS + settings.SENDER_WORKERS + 4)
+    queued_bot = QueuedBot(settings.TELEGRAM_TOKEN, request=request, sender=sender)
+    updater = Updater(bot=queued_bot, use_context=True, workers=settings.WORKERS, persistence=persistence)
+    dp = updater.dispatcher
 
+    main_conv = conversation()
+    if settings.PROFILE_ENABLED:
+        wrap_callbacks(main_conv, profiler.profiled)
+        profiler.install_signal(settings.PROFILE_SECONDS, settings.PROFILE_DIR, settings.PROFILE_TOP)
+    if metrics.enabled:
+        wrap_callbacks(main_conv, metrics.timed)
+    # users evicted from memory are restored before any other handler sees their update
+    sessions = Sessions(dp, conversation_handlers(main_conv), settings.SESSIONS_TIMEOUT, settings.SESSIONS_MAX_IDLE,
+                        settings.SESSIONS_MAX_ENTRIES,
+                        cluster.worker_path(settings.SESSIONS_SPILL_PATH, worker) if settings.SESSIONS_SPILL else None,
+                        settings.SESSIONS_SPILL_TTL)
+    sessions.on_expired = session_expired
+    dp.bot_data['sessions'] = sessions
+    dp.add_handler(TypeHandler(Update, sessions.touch), group=-2)
+    dp.add_handler(CommandHandler(COMMAND_STATS, stats, filters=Filters.user(settings.ADMINS)), group=-1)
+    dp.add_handler(CommandHandler(COMMAND_SESSIONS, sessions_report, filters=Filters.user(settings.ADMINS)),
+                   group=-1)
+    if settings.PROFILE_ENABLED:
+        dp.add_handler(CommandHandler(COMMAND_PROFILE, profile, filters=Filters.user(settings.ADMINS)), group=-1)
+    dp.add_handler(CommandHandler(COMMAND_IMPORT, import_help, filters=Filters.user(settings.ADMINS)), group=-1)
+    dp.add_handler(MessageHandler(Filters.document & Filters.caption_regex(f'^/{COMMAND_IMPORT}\\b') &
+                                  Filters.user(settings.ADMINS), import_document), group=-1)
     dp.add_handler(main_conv)
     dp.add_error_handler(error)
-    updater.start_polling()
+    executor = None
+    # conversation handlers never run_async, a nested conversation can't map the state of a pending handler
+    if settings.HANDLERS in ('ordered', 'async'):
+        executor = workers.install(dp, settings.WORKERS)
+    if settings.ADMISSION_ENABLED:
+        # stale and repeated button presses are answered before they reach the workers
+        admission.install(dp, settings.ADMISSION_MAX_AGE, settings.ADMISSION_COLLAPSE, _('callback-expired'),
+                          executor.pending if executor else None)
+
+    # first run loads the index right after startup
+    updater.job_queue.run_repeating(sync_topic_index, interval=settings.SEARCH_SYNC_INTERVAL, first=1)
+    updater.job_queue.run_repeating(sessions.evict, interval=settings.SESSIONS_INTERVAL)
+
+    journal = None
+    if settings.JOURNAL_ENABLED:
+        # a journal of each worker, a shared one would be sent by all of them
+        journal = Journal(cluster.worker_path(settings.JOURNAL_PATH, worker), settings.JOURNAL_BATCH_SIZE,
+                          settings.JOURNAL_INTERVAL, settings.JOURNAL_MAX_ATTEMPTS, settings.JOURNAL_BACKOFF,
+                          settings.JOURNAL_WORKERS)
+        journal.on_created = lambda chat_id, pending_id, story: updater.bot.send_message(
+            chat_id=chat_id, text=_('story-created {id}').format(id=story['id']), priority=BULK)
+        journal.on_failed = lambda chat_id, pending_id, error: updater.bot.send_message(
+            chat_id=chat_id, text=_('could-not-create-story {id}').format(id=pending_id), priority=BULK)
+        dp.bot_data['journal'] = journal
+        journal.start()
+
+    file_ids = None
+    if settings.MEDIA_FILE_IDS_ENABLED:
+        file_ids = FileIds(settings.MEDIA_FILE_IDS_PATH)
+        dp.bot_data['file_ids'] = file_ids
+
+    metrics_server = None
+    if metrics.enabled:
+        logbook.register_metrics()
+        media.register_metrics()
+        metrics_server = metrics.start(settings.METRICS_PORT + (worker or 0))
+    if worker is not None:
+        server = cluster.listen(updater, worker)
+    else:
+        server = webhook.start(updater) if settings.WEBHOOK_ENABLED else None
+    if server is None:
+        updater.start_polling()
     updater.idle()
+    if server is not None:
+        server.shutdown()
+    if executor is not None:
+        # updates already handed to the workers are handled before what they use is closed
+        executor.shutdown()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if journal is not None:
+        journal.stop()
+    if sender is not None:
+        sender.stop()
+    if file_ids is not None:
+        file_ids.close()
+    sessions.close()
+    if persistence is not None:
+        persistence.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Logbook telegram bot')
+    parser.add_argument('--worker', type=int, help='run as cluster worker n, updates come from cluster.py')
+    args = parser.parse_args()
+    main(args.worker)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Cache:
+    """
+    Thread-safe LRU cache with per-entry TTL, bounded by entries count and approximate size in bytes
+    Keys are (resource, key) tuples so a whole resource can be invalidated at once
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._misses = {}
+
+    def get(self, resource, key):
+        with self._lock:
+            entry = self._entries.get((resource, key))
+            if entry and entry[2] > time.monotonic():
+                self._entries.move_to_end((resource, key))
+                self._hits[resource] = self._hits.get(resource, 0) + 1
+                return entry[0]
+            if entry:
+                self._remove((resource, key))
+            self._misses[resource] = self._misses.get(resource, 0) + 1
+            return None
+
+    def set(self, resource, key, value, ttl, size=0):
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if (resource, key) in self._entries:
+                self._remove((resource, key))
+            self._entries[(resource, key)] = (value, size, time.monotonic() + ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, resource, key=None):
+        with self._lock:
+            if key is not None:
+                if (resource, key) in self._entries:
+                    self._remove((resource, key))
+                return
+            for entry_key in [k for k in self._entries if k[0] == resource]:
+                self._remove(entry_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            resources = set(self._hits) | set(self._misses)
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'resources': {
+                    resource: {'hits': self._hits.get(resource, 0), 'misses': self._misses.get(resource, 0)}
+                    for resource in sorted(resources)
+                }
+            }
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key)
+        self._bytes -= entry[1]
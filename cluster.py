@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import requests
+from telegram import Bot
+from telegram.error import NetworkError, TelegramError
+from webhook import SECRET_HEADER, WebhookServer
+import webhook
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# seconds between attempts to reach a worker that is down or restarting
+RETRY_INTERVAL = 1
+# seconds between checks that the local worker processes are running
+RESTART_INTERVAL = 5
+
+
+def worker_urls():
+    """
+    Listeners of the workers, local worker processes unless [cluster] workers lists them
+    """
+    if settings.CLUSTER_WORKERS:
+        return settings.CLUSTER_WORKERS
+    return [f'http://{settings.CLUSTER_LISTEN}:{settings.CLUSTER_PORT + worker}{settings.WEBHOOK_PATH}'
+            for worker in range(settings.CLUSTER_PROCESSES)]
+
+
+def size():
+    return len(worker_urls())
+
+
+def partition(key, partitions):
+    return key % partitions
+
+
+def update_partition(update, partitions):
+    """
+    Worker of an update, all updates of a user go to the same worker so their conversation stays there
+    """
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return partition(key, partitions)
+
+
+def worker_path(path, worker):
+    """
+    Path of a file only one worker may use, journal-2.sqlite for journal.sqlite of worker 2
+    """
+    if worker is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}-{worker}{extension}'
+
+
+def listen(updater, worker):
+    """
+    Receive the updates the receiver forwards to this worker instead of getting them from telegram
+    """
+    port = settings.CLUSTER_PORT + worker
+    server = WebhookServer((settings.CLUSTER_LISTEN, port), updater.bot, updater.update_queue,
+                           settings.WEBHOOK_PATH, settings.WEBHOOK_SECRET)
+    webhook.run(updater, server)
+    logger.info(f'Worker {worker} listening on {settings.CLUSTER_LISTEN}:{port}{settings.WEBHOOK_PATH}')
+    return server
+
+
+class Forwarder:
+    """
+    Sends updates to the workers, one thread per worker so the updates of a user keep their order
+    Has the put() of a queue, the webhook listener hands its updates straight to it
+    """
+
+    def __init__(self, urls, secret='', max_pending=settings.CLUSTER_MAX_PENDING):
+        self.urls = urls
+        self.secret = secret
+        self._queues = [queue.Queue(max_pending) for url in urls]
+        # monotonic time stop() gives up on the updates still queued
+        self._deadline = None
+        self._threads = [
+            threading.Thread(target=self._forward, args=(url, updates), name=f'forward-{worker}', daemon=True)
+            for worker, (url, updates) in enumerate(zip(urls, self._queues))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, update):
+        worker = update_partition(update, len(self.urls))
+        try:
+            self._queues[worker].put_nowait(update)
+        except queue.Full:
+            # the worker has been down long enough, the receiver doesn't hold its updates in memory forever
+            logger.error(f'Worker {self.urls[worker]} has {self._queues[worker].maxsize} updates waiting, '
+                         f'update {update.update_id} dropped')
+
+    def pending(self):
+        return sum(updates.qsize() for updates in self._queues)
+
+    def stop(self, timeout=settings.CLUSTER_STOP_TIMEOUT):
+        """
+        Forward what is queued and stop, updates not forwarded within timeout seconds are dropped
+        """
+        self._deadline = time.monotonic() + timeout
+        for updates in self._queues:
+            updates.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _forward(self, url, updates):
+        session = requests.Session()
+        headers = {SECRET_HEADER: self.secret, 'Content-Type': 'application/json'}
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            if self._stopped():
+                logger.error(f'Worker {url} not reached before stop, update {update.update_id} dropped')
+                continue
+            body = json.dumps(update.to_dict()).encode()
+            # a worker that is down gets its updates once it is back, later ones wait behind them
+            while True:
+                try:
+                    response = session.post(url, data=body, headers=headers, timeout=settings.CLUSTER_TIMEOUT)
+                    if response.status_code == 200:
+                        break
+                    if response.status_code < 500:
+                        logger.error(f'Worker {url} rejected update {update.update_id} {response.status_code}')
+                        break
+                    logger.warning(f'Worker {url} answered {response.status_code}')
+                except requests.RequestException as err:
+                    logger.warning(f'Worker {url} unreachable {err}')
+                if self._stopped():
+                    logger.error(f'Worker {url} not reached before stop, update {update.update_id} dropped')
+                    break
+                time.sleep(RETRY_INTERVAL)
+
+    def _stopped(self):
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+
+def poll(bot, forwarder, stopped):
+    bot.delete_webhook()
+    offset = None
+    while not stopped.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=settings.CLUSTER_POLL_TIMEOUT)
+        except NetworkError as err:
+            logger.warning(f'Getting updates failed {err}')
+            stopped.wait(RETRY_INTERVAL)
+            continue
+        for update in updates:
+            forwarder.put(update)
+            offset = update.update_id + 1
+    if offset is not None:
+        # telegram forgets updates once a later offset is asked for, or sends the last batch again after a restart
+        try:
+            bot.get_updates(offset=offset, timeout=0)
+        except TelegramError as err:
+            logger.warning(f'Acknowledging updates before {offset} failed {err}')
+
+
+def receive(stopped):
+    """
+    Get updates from telegram, through the webhook or by polling, and forward them to the workers
+    """
+    bot = Bot(settings.TELEGRAM_TOKEN)
+    forwarder = Forwarder(worker_urls(), settings.WEBHOOK_SECRET)
+    server = None
+    if settings.WEBHOOK_ENABLED:
+        try:
+            server = WebhookServer((settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT), bot, forwarder,
+                                   settings.WEBHOOK_PATH, settings.WEBHOOK_SECRET)
+            bot.set_webhook(url=settings.WEBHOOK_URL, secret_token=settings.WEBHOOK_SECRET or None,
+                            max_connections=settings.WEBHOOK_MAX_CONNECTIONS)
+        except (OSError, TelegramError) as err:
+            logger.error(f'Webhook failed, falling back to polling {err}')
+            if server is not None:
+                server.server_close()
+                server = None
+    if server is not None:
+        threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+        stopped.wait()
+        server.shutdown()
+    else:
+        poll(bot, forwarder, stopped)
+    forwarder.stop()
+
+
+def start_worker(worker):
+    return subprocess.Popen([sys.executable, os.path.join(settings.BASE_DIR, 'bot.py'), '--worker', str(worker)],
+                            cwd=settings.BASE_DIR)
+
+
+def supervise(processes, stopped):
+    """
+    Start the local worker processes that exited again until stopped
+    """
+    while not stopped.wait(RESTART_INTERVAL):
+        for worker, process in enumerate(processes):
+            if process.poll() is not None:
+                logger.error(f'Worker {worker} exited with {process.returncode}, starting it again')
+                processes[worker] = start_worker(worker)
+
+
+def main():
+    """
+    Start the local worker processes and the receiver, workers on other hosts are started with bot.py --worker
+    """
+    processes = []
+    if not settings.CLUSTER_WORKERS:
+        processes = [start_worker(worker) for worker in range(settings.CLUSTER_PROCESSES)]
+
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    logger.info(f'Forwarding updates to {size()} workers')
+    supervisor = threading.Thread(target=supervise, args=(processes, stopped), name='supervisor', daemon=True)
+    supervisor.start()
+    try:
+        receive(stopped)
+    finally:
+        stopped.set()
+        supervisor.join()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.getLevelName(settings.LOGGING_LEVEL))
+    main()
@@ -0,0 +1,34 @@
+import json
+import sqlite3
+import threading
+
+
+class FileIds:
+    """
+    Telegram file_ids of story photos and videos kept in SQLite
+    Media sent by file_id is not fetched from the media server again
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS file_ids (story_id INTEGER PRIMARY KEY, file_ids TEXT)')
+        self._db.commit()
+
+    def get(self, story_id):
+        with self._lock:
+            row = self._db.execute('SELECT file_ids FROM file_ids WHERE story_id = ?', (story_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, story_id, file_ids):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO file_ids VALUES (?, ?)', (story_id, json.dumps(file_ids)))
+
+    def forget(self, story_id):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM file_ids WHERE story_id = ?', (story_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
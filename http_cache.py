@@ -0,0 +1,131 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+Response = namedtuple('Response', 'etag last_modified body expires')
+
+
+def cache_control(header):
+    """
+    How long a response may be used without asking the server, None when it must not be stored at all
+    """
+    header = (header or '').lower()
+    if 'no-store' in header:
+        return None
+    if 'no-cache' in header:
+        return 0
+    match = MAX_AGE_RE.search(header)
+    return int(match.group(1)) if match else 0
+
+
+def conditional_headers(response):
+    headers = {}
+    if response.etag:
+        headers['If-None-Match'] = response.etag
+    if response.last_modified:
+        headers['If-Modified-Since'] = response.last_modified
+    return headers
+
+
+def is_fresh(response):
+    return response.expires > time.time()
+
+
+class HttpCache:
+    """
+    API responses with their ETag and Last-Modified validators kept in SQLite, so they survive restarts
+    Stale responses are revalidated with a conditional GET, bounded by the total size of bodies
+    """
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # losing the last responses on power loss is fine, they are fetched again
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB, expires REAL, '
+                         'accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._db.commit()
+        self._bytes = self._db.execute('SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        with self._lock, self._db:
+            row = self._db.execute('SELECT etag, last_modified, body, expires FROM responses WHERE url = ?',
+                                   (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (time.time(), url))
+        return Response(*row)
+
+    def store(self, url, headers, body):
+        """
+        Keep a 200 response that has a validator or may be reused for a while
+        """
+        max_age = cache_control(headers.get('Cache-Control'))
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if max_age is None or len(body) > self.max_bytes or not (etag or last_modified or max_age):
+            self.forget(url)
+            return
+        with self._lock, self._db:
+            old = self._db.execute('SELECT LENGTH(body) FROM responses WHERE url = ?', (url,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                             (url, etag, last_modified, body, time.time() + max_age, time.time()))
+            self._bytes += len(body) - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def refresh(self, url, headers):
+        """
+        Server answered 304, the stored body is good for another max-age
+        """
+        max_age = cache_control(headers.get('Cache-Control'))
+        if max_age is None:
+            return self.forget(url)
+        with self._lock, self._db:
+            self._db.execute('UPDATE responses SET expires = ? WHERE url = ?', (time.time() + max_age, url))
+
+    def forget(self, url):
+        with self._lock, self._db:
+            old = self._db.execute('SELECT LENGTH(body) FROM responses WHERE url = ?', (url,)).fetchone()
+            if old:
+                self._db.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self._bytes -= old[0]
+
+    def expire(self):
+        """
+        Make every response revalidate on next use, after a write the server copy may have changed
+        """
+        with self._lock, self._db:
+            self._db.execute('UPDATE responses SET expires = 0 WHERE expires > ?', (time.time(),))
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'entries': entries, 'bytes': self._bytes}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self):
+        # least recently used first, down to 90% so every store doesn't evict again
+        target = self.max_bytes * 0.9
+        rows = self._db.execute('SELECT url, LENGTH(body) FROM responses ORDER BY accessed').fetchall()
+        for url, size in rows:
+            if self._bytes <= target:
+                break
+            self._db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self._bytes -= size
+        logger.debug(f'HTTP cache evicted down to {self._bytes} bytes')
@@ -0,0 +1,290 @@
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logbook
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('json', 'jsonl', 'csv')
+# story types by name, same numbers as bot.TYPE_*
+TYPES = {'photo': 1, 'album': 2, 'video': 3, 'text': 4}
+CHUNK_SIZE = 64 * 1024
+# largest JSON array item, a longer one is taken for a malformed document instead of buffering the rest of it
+MAX_ITEM_SIZE = 1024 * 1024
+# failures kept in the report, the count covers the rest
+MAX_FAILURES = 100
+
+
+def detect_format(name):
+    extension = os.path.splitext(name or '')[1].lower().lstrip('.')
+    if extension == 'ndjson':
+        return 'jsonl'
+    return extension if extension in FORMATS else None
+
+
+class InvalidRow:
+    """
+    Row that could not be decoded, it fails validation and the import goes on with the next one
+    """
+
+    def __init__(self, error):
+        self.error = error
+
+
+def read_rows(file, format):
+    """
+    Rows of a document one at a time, the document is never loaded whole
+    """
+    if format == 'csv':
+        yield from csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+    elif format == 'jsonl':
+        for number, line in enumerate(io.TextIOWrapper(file, encoding='utf-8'), 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as err:
+                yield InvalidRow(f'line {number}: invalid JSON {err}')
+    else:
+        yield from read_json_array(io.TextIOWrapper(file, encoding='utf-8'))
+
+
+def read_json_array(file):
+    """
+    Items of a top level JSON array, decoded as the chunks they span arrive
+    A malformed item is the last row, the array can't be followed past it
+    """
+    decoder = json.JSONDecoder()
+    buffer = file.read(CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('JSON document must be an array of stories')
+    buffer = buffer[1:]
+    item_number = 0
+    failed_at = None
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError as err:
+            # an item cut at the chunk end fails further on once the next chunk arrives, a malformed one doesn't
+            malformed = err.pos == failed_at and not err.msg.startswith('Unterminated string')
+            chunk = '' if malformed or len(buffer) > MAX_ITEM_SIZE else file.read(CHUNK_SIZE)
+            if not chunk:
+                yield InvalidRow(f'item {item_number + 1}: invalid JSON {err}, the rest of the document is not read')
+                return
+            failed_at = err.pos
+            buffer += chunk
+            continue
+        item_number += 1
+        failed_at = None
+        yield item
+        buffer = buffer[end:]
+        if not buffer.strip():
+            buffer += file.read(CHUNK_SIZE)
+            if not buffer.strip():
+                raise ValueError('JSON array is not closed')
+
+
+def scalar(row, name):
+    value = row.get(name)
+    if isinstance(value, (dict, list)):
+        raise ValueError(f'invalid {name} {json.dumps(value)[:40]}')
+    return value
+
+
+def validate(row, user=None):
+    """
+    Story to create from a document row, raises ValueError when the row is not usable
+    """
+    if isinstance(row, InvalidRow):
+        raise ValueError(row.error)
+    if not isinstance(row, dict):
+        raise ValueError('row is not an object')
+    try:
+        topic = int(scalar(row, 'topic') or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid topic {row.get('topic')}")
+    if topic <= 0:
+        raise ValueError('topic is missing')
+    kind = str(scalar(row, 'type') or 'text').strip().lower()
+    story_type = TYPES.get(kind) or (int(kind) if kind.isdigit() and int(kind) in TYPES.values() else None)
+    if story_type is None:
+        raise ValueError(f'unknown type {kind}')
+    content = row.get('content')
+    if not content:
+        raise ValueError('content is missing')
+    if not isinstance(content, str):
+        # album photos given as a list
+        content = json.dumps(content)
+    try:
+        user = int(scalar(row, 'user') or user or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid user {row.get('user')}")
+    if user <= 0:
+        raise ValueError('user is missing')
+    return {
+        'type': story_type,
+        'description': str(scalar(row, 'description') or ''),
+        'topic': topic,
+        'user': user,
+        'content': content
+    }
+
+
+class Import:
+    """
+    Creates the stories of a document through the API a batch at a time, several requests in flight
+    Progress is saved after every batch, the same document imported again resumes after the last saved row
+    and sends again the rows the API failed with errors other than a refusal
+    """
+
+    def __init__(self, path, format=None, user=None, batch_size=50, workers=4, progress_path=None):
+        self.path = path
+        self.format = format or detect_format(path)
+        if self.format is None:
+            raise ValueError(f'Unsupported document {path}, expected one of {", ".join(FORMATS)}')
+        self.user = user
+        self.batch_size = batch_size
+        self.workers = workers
+        self.progress_path = progress_path or path + '.progress'
+
+    def run(self, on_progress=None):
+        """
+        Import the document, returns a report of rows, created stories and failures
+        """
+        digest = self._digest()
+        progress = self._load_progress(digest)
+        resumed = progress['row']
+        retry = set(progress['retry'])
+        if resumed:
+            logger.info(f'Import of {self.path} resumes after row {resumed}, {len(retry)} failed rows sent again')
+        started = time.monotonic()
+        created = 0
+        row = 0
+        with open(self.path, 'rb') as file, ThreadPoolExecutor(max_workers=self.workers) as pool:
+            batch = []
+            try:
+                for row, data in enumerate(read_rows(file, self.format), 1):
+                    if row <= resumed:
+                        if row not in retry:
+                            continue
+                        self._forget(progress, row)
+                    try:
+                        batch.append((row, validate(data, self.user)))
+                    except ValueError as err:
+                        self._fail(progress, row, str(err))
+                    if len(batch) >= self.batch_size:
+                        created += self._send(pool, digest, batch, progress)
+                        self._save_progress(progress, row)
+                        batch = []
+                        if on_progress:
+                            on_progress(row, progress['created'])
+            finally:
+                # rows read before the document turned out unreadable are kept
+                if batch:
+                    created += self._send(pool, digest, batch, progress)
+                self._save_progress(progress, max(row, resumed))
+
+        seconds = time.monotonic() - started
+        return {
+            'rows': row,
+            'resumed': resumed,
+            'created': progress['created'],
+            'failed': progress['failed'],
+            'failures': progress['failures'],
+            'seconds': seconds,
+            'rate': (row - resumed) / seconds if seconds else 0.0,
+            'created_rate': created / seconds if seconds else 0.0
+        }
+
+    def _send(self, pool, digest, batch, progress):
+        stories = [story for row, story in batch]
+        keys = [f'import-{digest}-{row}' for row, story in batch]
+        results = pool.map(lambda story, key: logbook.create_story(story, idempotency_key=key), stories, keys)
+        created = 0
+        for (row, story), result in zip(batch, results):
+            if result['status']:
+                created += 1
+            else:
+                self._fail(progress, row, result['error'])
+                if not result.get('rejected'):
+                    # 5xx, timeouts and an open breaker, the row is sent again when the import resumes
+                    progress['retry'].append(row)
+        progress['created'] += created
+        return created
+
+    @staticmethod
+    def _fail(progress, row, error):
+        logger.warning(f'Import row {row} failed {error}')
+        progress['failed'] += 1
+        if len(progress['failures']) < MAX_FAILURES:
+            progress['failures'].append([row, error])
+
+    @staticmethod
+    def _forget(progress, row):
+        # failure of a row sent again, it counts again if the row fails again
+        progress['retry'].remove(row)
+        progress['failed'] -= 1
+        progress['failures'] = [failure for failure in progress['failures'] if failure[0] != row]
+
+    def _digest(self):
+        # idempotency keys and progress belong to the document content, not its name
+        sha = hashlib.sha1()
+        with open(self.path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _load_progress(self, digest):
+        try:
+            with open(self.progress_path) as file:
+                progress = json.load(file)
+            if progress.get('digest') == digest:
+                progress.setdefault('retry', [])
+                return progress
+        except (OSError, ValueError):
+            pass
+        return {'digest': digest, 'row': 0, 'created': 0, 'failed': 0, 'failures': [], 'retry': []}
+
+    def _save_progress(self, progress, row):
+        progress['row'] = row
+        temporary = self.progress_path + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(progress, file)
+        os.replace(temporary, self.progress_path)
+
+
+def summary(report):
+    lines = [
+        f"{report['rows']} rows, {report['created']} stories created, {report['failed']} failed",
+        f"{report['rate']:.1f} rows/s, {report['created_rate']:.1f} stories/s in {report['seconds']:.1f}s"
+    ]
+    if report['resumed']:
+        lines.append(f"resumed after row {report['resumed']}")
+    lines.extend(f'row {row}: {error}' for row, error in report['failures'])
+    return lines
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Create stories from a JSON, JSONL or CSV document')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=FORMATS, help='taken from the file extension by default')
+    parser.add_argument('--user', type=int, help='API user id of rows that have none')
+    parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=settings.IMPORT_WORKERS, help='requests in flight')
+    args = parser.parse_args()
+
+    report = Import(args.path, args.format, args.user, args.batch_size, args.workers).run(
+        on_progress=lambda row, created: logger.info(f'Row {row}, {created} stories created'))
+    print('\n'.join(summary(report)))
@@ -0,0 +1,113 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import logbook
+
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Durable queue of stories waiting to be created through the API
+    Stories are accepted immediately and a background worker sends them in batches, workers requests in flight,
+    retrying with backoff. Stories the API refuses are not retried
+    """
+
+    def __init__(self, path, batch_size=20, interval=2, max_attempts=10, backoff=5, workers=4):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.on_created = None
+        self.on_failed = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='journal')
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS stories ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE, story TEXT, chat_id INTEGER, '
+                         'attempts INTEGER DEFAULT 0, next_attempt REAL, error TEXT)')
+        self._db.commit()
+
+    def put(self, story, chat_id=None):
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT INTO stories (key, story, chat_id, next_attempt) VALUES (?, ?, ?, ?)',
+                (uuid.uuid4().hex, json.dumps(story), chat_id, time.time())
+            )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def flush(self):
+        """
+        Send one batch of due stories, returns number of stories created
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, key, story, chat_id, attempts FROM stories WHERE next_attempt <= ? ORDER BY id LIMIT ?',
+                (time.time(), self.batch_size)
+            ).fetchall()
+
+        results = self._pool.map(lambda row: logbook.create_story(json.loads(row[2]), idempotency_key=row[1]), rows)
+        created = 0
+        for (id, key, story, chat_id, attempts), result in zip(rows, results):
+            if result['status']:
+                created += 1
+                with self._lock, self._db:
+                    self._db.execute('DELETE FROM stories WHERE id = ?', (id,))
+                self._notify(self.on_created, chat_id, id, result['data'])
+            elif result.get('rejected') or attempts + 1 >= self.max_attempts:
+                logger.error(f"Pending story {id} dropped after {attempts + 1} attempts {result['error']}")
+                with self._lock, self._db:
+                    self._db.execute('DELETE FROM stories WHERE id = ?', (id,))
+                self._notify(self.on_failed, chat_id, id, result['error'])
+            else:
+                logger.warning(f"Pending story {id} attempt {attempts + 1} failed {result['error']}")
+                with self._lock, self._db:
+                    self._db.execute(
+                        'UPDATE stories SET attempts = ?, next_attempt = ?, error = ? WHERE id = ?',
+                        (attempts + 1, time.time() + self.backoff * 2 ** attempts, result['error'], id)
+                    )
+        return created
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, name='journal', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self._pool.shutdown()
+        self._db.close()
+
+    def _worker(self):
+        while not self._stopped.is_set():
+            try:
+                created = self.flush()
+            except Exception:
+                logger.exception('Journal flush failed')
+                created = 0
+            # a full batch means more stories are probably waiting
+            if created < self.batch_size:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    @staticmethod
+    def _notify(callback, chat_id, id, data):
+        if callback is None or chat_id is None:
+            return
+        try:
+            callback(chat_id, id, data)
+        except Exception:
+            logger.exception(f'Journal notification for pending story {id} failed')
@@ -1,18 +1,104 @@
+import contextvars
+import functools
 import requests
+import inspect
 import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+from cache import Cache
+from http_cache import HttpCache, conditional_headers, is_fresh
+from models import Model, Story, TopicTable, User, loads, stories, users
+from search import TopicIndex
+from resilience import CircuitBreaker, LatencyWindow, expired, remaining
+import metrics
+import profiler
 import settings
 
 
+logger = logging.getLogger(__name__)
+
 GET = 'get'
 POST = 'post'
 PUT = 'put'
 DELETE = 'delete'
 
+TIMEOUT = (settings.API_CONNECT_TIMEOUT, settings.API_READ_TIMEOUT)
+
+_session = None
+_session_lock = threading.Lock()
+
+# topic_id -> (stories count, expires at)
+_stories_counts = {}
+_stories_counts_lock = threading.Lock()
+
+cache = Cache(settings.CACHE_MAX_ENTRIES, settings.CACHE_MAX_BYTES)
+# responses with validators on disk, stale ones are revalidated with conditional GETs
+http_cache = HttpCache(settings.HTTP_CACHE_PATH, settings.HTTP_CACHE_MAX_BYTES) if settings.HTTP_CACHE_ENABLED \
+    else None
+# stale after missing a couple of syncs
+topic_index = TopicIndex(max_age=settings.SEARCH_SYNC_INTERVAL * 3)
+# every topic once, users' pages and the caches hold references to it
+topics = TopicTable()
+
+# cursors of pages served from the topic index start with this prefix, others are API urls
+INDEX_CURSOR = 'index:'
+_prefetch = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+
+# second GETs sent when the first one is slow
+_hedges = ThreadPoolExecutor(max_workers=settings.API_POOL_SIZE, thread_name_prefix='hedge')
+
+# endpoint -> (circuit breaker, recent latencies)
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+# url -> Future of the GET in flight, identical GETs made meanwhile wait for it instead of asking again
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def open_http_cache(path):
+    """
+    Keep the HTTP cache at path instead, cluster workers each keep one under the byte cap
+    """
+    global http_cache
+    if http_cache is not None:
+        http_cache.close()
+    http_cache = HttpCache(path, settings.HTTP_CACHE_MAX_BYTES)
+
+
+def cache_count(resource, kind):
+    return cache.stats()['resources'].get(resource, {}).get(kind, 0)
+
+
+def http_cache_stats():
+    return use_http_cache(http_cache.stats) or {'entries': 0, 'bytes': 0}
+
+
+def register_metrics():
+    """
+    Hits and misses of every cached resource and the size of both caches, read when metrics are served
+    """
+    for resource in settings.CACHE_TTL:
+        metrics.gauge(metrics.CACHE_HITS_METRIC, functools.partial(cache_count, resource, 'hits'),
+                      {'resource': resource})
+        metrics.gauge(metrics.CACHE_MISSES_METRIC, functools.partial(cache_count, resource, 'misses'),
+                      {'resource': resource})
+    metrics.gauge(metrics.CACHE_ENTRIES_METRIC, lambda: cache.stats()['entries'], {'cache': 'memory'})
+    metrics.gauge(metrics.CACHE_BYTES_METRIC, lambda: cache.stats()['bytes'], {'cache': 'memory'})
+    if http_cache is not None:
+        metrics.gauge(metrics.CACHE_ENTRIES_METRIC, lambda: http_cache_stats()['entries'], {'cache': 'http'})
+        metrics.gauge(metrics.CACHE_BYTES_METRIC, lambda: http_cache_stats()['bytes'], {'cache': 'http'})
+
 
 def get_telegram_user(id):
     url = f'{settings.API_HOST}/users?search={id}&format=json'
-    user = api(GET, url)
+    user = cached_get('users', url, url, users)
     if user['status']:
         if len(user['data']) == 0:
             user['status'] = False
@@ -21,84 +107,507 @@ def get_telegram_user(id):
     return user
 
 
-def get_latest_topics():
-    url = f'{settings.API_HOST}/topics?format=json'
-    return api(GET, url)
+def get_topics_page(cursor=None, search=None):
+    if cursor is None:
+        if search is not None and topic_index.is_fresh():
+            cursor = f'{INDEX_CURSOR}0:{search}'
+        elif search is not None:
+            cursor = f'{settings.API_HOST}/topics?search={search}&page_size={settings.PAGE_SIZE}&format=json'
+        else:
+            cursor = f'{settings.API_HOST}/topics?page_size={settings.PAGE_SIZE}&format=json'
+    if cursor.startswith(INDEX_CURSOR):
+        return get_index_page(cursor)
+    return get_page('topics', cursor)
+
+
+def get_stories_page(topic_id, cursor=None):
+    url = cursor or f'{settings.API_HOST}/stories/?topic={topic_id}&page_size={settings.PAGE_SIZE}&format=json'
+    return get_page('stories', url)
+
+
+def iter_topic_pages(search=None):
+    """
+    Topic pages fetched as they are consumed, a failed page is the last one
+    """
+    cursor = None
+    while True:
+        page = get_topics_page(cursor, search)
+        yield page
+        if not page['status'] or not page['data']['next']:
+            return
+        cursor = page['data']['next']
+
 
+def get_page(resource, url):
+    model = topics.topics if resource == 'topics' else stories
+    page = as_page(cached_get(resource, url, url, model))
+    # fetch the next page in the background so paging forward hits the cache
+    if page['status'] and page['data']['next'] and cache.get(resource, page['data']['next']) is None:
+        _prefetch.submit(cached_get, resource, page['data']['next'], page['data']['next'], model)
+    return page
 
-def search_topics(title):
-    url = f'{settings.API_HOST}/topics?search={title}&format=json'
-    return api(GET, url)
+
+def get_index_page(cursor):
+    offset, search = cursor[len(INDEX_CURSOR):].split(':', 1)
+    offset = int(offset)
+    topics = topic_index.search(search)
+    end = offset + settings.PAGE_SIZE
+    return {'status': True, 'data': {
+        'count': len(topics),
+        'next': f'{INDEX_CURSOR}{end}:{search}' if end < len(topics) else None,
+        'previous': f'{INDEX_CURSOR}{max(offset - settings.PAGE_SIZE, 0)}:{search}' if offset > 0 else None,
+        'results': topics[offset:end]
+    }}
+
+
+def as_page(result):
+    if result['status'] and isinstance(result['data'], list):
+        # server does not paginate, everything comes as one page
+        data = result['data']
+        result['data'] = {'count': len(data), 'next': None, 'previous': None, 'results': data}
+    return result
+
+
+def full_index_sync():
+    synced = topic_index.full_synced_at
+    return synced is None or time.monotonic() - synced >= settings.SEARCH_FULL_SYNC_INTERVAL
+
+
+def sync_topic_index(full=None):
+    """
+    Bring the search index up to date, every SEARCH_FULL_SYNC_INTERVAL seconds with all topic pages so renames
+    and removals made elsewhere are applied. In between pages, newest topic first, are read only until a topic
+    the index already has
+    """
+    newest = None if (full_index_sync() if full is None else full) else topic_index.newest()
+    topics = []
+    for page in iter_topic_pages():
+        if not page['status']:
+            return page
+        results = page['data']['results']
+        new = results if newest is None else [topic for topic in results if topic['id'] > newest]
+        topics.extend(new)
+        if len(new) < len(results):
+            break
+    topic_index.sync(topics, complete=newest is None)
+    return {'status': True, 'data': topics}
+
+
+def lookup_topic(id):
+    url = f'{settings.API_HOST}/topics/{id}/?format=json'
+    return cached_get('topics', url, url, topics.intern)
 
 
 def get_topic_stories(topic_id):
     url = f'{settings.API_HOST}/stories/?topic={topic_id}&format=json'
-    return api(GET, url)
+    return cached_get('stories', url, url, stories)
 
 
 def lookup_story(id):
     url = f'{settings.API_HOST}/stories/{id}?format=json'
-    return api(GET, url)
+    return cached_get('story', id, url, Story.from_json)
 
 
 def create_user(user):
     url = f'{settings.API_HOST}/users/?format=json'
-    return api(POST, url, user)
+    result = api(POST, url, user)
+    if result['status']:
+        cache.invalidate('users')
+        result['data'] = User.from_json(result['data'])
+    return result
 
 
-def remove_story(id):
+def remove_story(id, topic_id=None):
     url = f'{settings.API_HOST}/stories/{id}/?format=json'
-    return api(DELETE, url)
+    result = api(DELETE, url)
+    if result['status']:
+        cache.invalidate('story', id)
+        cache.invalidate('stories')
+        if topic_id is None:
+            clear_stories_counts()
+        else:
+            adjust_stories_count(topic_id, -1)
+    return result
 
 
 def remove_topic(id):
     url = f'{settings.API_HOST}/topics/{id}/?format=json'
-    return api(DELETE, url)
+    result = api(DELETE, url)
+    if result['status']:
+        cache.invalidate('topics')
+        cache.invalidate('stories')
+        topic_index.remove(id)
+        topics.remove(id)
+        forget_stories_count(id)
+    return result
 
 
 def update_story(id, data):
     url = f'{settings.API_HOST}/stories/{id}/?format=json'
-    return api(PUT, url, data)
+    result = api(PUT, url, data)
+    if result['status']:
+        cache.invalidate('story', id)
+        cache.invalidate('stories')
+    return result
 
 
 def create_topic(title):
     url = f'{settings.API_HOST}/topics/?format=json'
-    return api(POST, url, {'title': title})
+    result = api(POST, url, {'title': title})
+    if result['status']:
+        cache.invalidate('topics')
+        result['data'] = topics.intern(result['data'])
+        topic_index.add(result['data'])
+    return result
 
 
-def create_story(story):
+def create_story(story, idempotency_key=None):
     url = f'{settings.API_HOST}/stories/?format=json'
-    return api(POST, url, story)
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    result = api(POST, url, story, headers)
+    if result['status']:
+        cache.invalidate('stories')
+        adjust_stories_count(story['topic'], 1)
+    return result
+
+
+def upload_story(story, body, content_type):
+    url = f'{settings.API_HOST}/stories/?format=json'
+    result = api(POST, url, body, {'Content-Type': content_type})
+    if result['status']:
+        cache.invalidate('stories')
+        adjust_stories_count(story['topic'], 1)
+    return result
+
+
+def cached_get(resource, key, url, model=None):
+    """
+    Cached GET, model turns the decoded data into models before it is cached
+    """
+    result = cache.get(resource, key)
+    if result is None:
+        result = api(GET, url)
+        if result['status'] and model is not None:
+            result['data'] = model(result['data'])
+        remember(resource, key, result)
+    # callers are free to modify the returned dict
+    return dict(result)
+
+
+def remember(resource, key, result):
+    # stale copies are served while the API is failing, they are not worth keeping
+    if result['status'] and not result.get('stale'):
+        size = len(json.dumps(result['data'], separators=(',', ':'), default=Model.to_dict))
+        cache.set(resource, key, result, settings.CACHE_TTL[resource], size)
+
+
+class BodyError(Exception):
+    """
+    A streamed request body failed while it was sent, the API endpoint is not to blame
+    """
+
+
+class DeadlineRetry(Retry):
+    """
+    Retry that gives up once the handler's deadline has passed
+    """
+
+    def is_exhausted(self):
+        return expired() or super().is_exhausted()
 
 
-def api(method, url, data=None):
-    headers = {'Authorization': 'Token ' + settings.API_TOKEN}
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # only idempotent GETs are retried, writes fail straight away
+                retry = DeadlineRetry(
+                    total=settings.API_RETRIES,
+                    backoff_factor=settings.API_BACKOFF,
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.API_POOL_SIZE,
+                    max_retries=retry,
+                    pool_block=True
+                )
+                session = requests.Session()
+                session.headers['Authorization'] = 'Token ' + settings.API_TOKEN
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+@profiler.profiled
+def api(method, url, data=None, headers=None):
+    if method == GET and headers is None:
+        return shared_get(url)
+    result = request(method, url, data, headers)
+    if method != GET:
+        # reads started before a write may return old data, later reads must not join them
+        with _flights_lock:
+            _flights.clear()
+        if http_cache is not None:
+            use_http_cache(http_cache.expire)
+    return result
+
+
+def use_http_cache(call, *args):
+    """
+    Call a method of the HTTP cache, a failing cache is no cache, the error is logged and None returned
+    """
+    try:
+        return call(*args)
+    except sqlite3.Error as err:
+        logger.error(f'HTTP cache {call.__name__} failed {err}')
+        return None
+
+
+def shared_get(url, retry=True):
+    """
+    GET joining an identical request already in flight, only the first caller talks to the API
+    A follower with time left after the first caller ran out of its own sends the GET once more
+    """
+    with _flights_lock:
+        flight = _flights.get(url)
+        leader = flight is None
+        if leader:
+            flight = _flights[url] = Future()
+    if not leader:
+        metrics.count_coalesced(GET, url)
+        try:
+            result = flight.result(budget())
+        except FutureTimeoutError:
+            return {'status': False, 'error': 'API deadline exceeded'}
+        if retry and outlived(result):
+            return shared_get(url, retry=False)
+        # callers are free to modify the returned dict
+        return dict(result)
+
+    try:
+        result = hedged_get(url)
+    except BaseException as err:
+        _land(url, flight)
+        flight.set_exception(err)
+        raise
+    # gone before the followers wake, one that sends it again doesn't join this flight
+    _land(url, flight)
+    flight.set_result(result)
+    return dict(result)
+
+
+def _land(url, flight):
+    with _flights_lock:
+        if _flights.get(url) is flight:
+            del _flights[url]
+
+
+def outlived(result):
+    """
+    Whether a shared result is the deadline of another caller while this one still has time
+    """
+    left = remaining()
+    return result.get('error') == 'API deadline exceeded' and (left is None or left > 0)
+
+
+def hedged_get(url):
+    """
+    GET sent a second time when the first is slower than the endpoint's p95, the second answers when the first fails
+    The first is sent from the caller's thread, only the second waits for a hedge thread
+    """
+    delay = endpoint_state(metrics.endpoint(url))[1].p95() if settings.API_HEDGE else None
+    if delay is None:
+        return request(GET, url)
+
+    first_done = threading.Event()
+    # the copy keeps the caller's deadline, time it waits for a hedge thread delays it rather than fires it
+    second = _hedges.submit(contextvars.copy_context().run, hedge, url, first_done, delay)
+    try:
+        result = request(GET, url)
+    finally:
+        first_done.set()
+    if result['status'] or second.cancel():
+        return result
+    try:
+        hedged = second.result(budget())
+    except FutureTimeoutError:
+        return result
+    return hedged if hedged is not None and hedged['status'] else result
+
+
+def hedge(url, first_done, delay):
+    if first_done.wait(delay):
+        return None
+    metrics.increment(metrics.HEDGED_METRIC, {'endpoint': metrics.endpoint(url)})
+    return request(GET, url)
+
+
+def request(method, url, data=None, headers=None):
+    left = remaining()
+    if left is not None and left <= 0:
+        return {'status': False, 'error': 'API deadline exceeded'}
+
+    # streamed bodies always go through requests, aiohttp only takes async iterables
+    if settings.API_CLIENT == 'aiohttp' and not inspect.isgenerator(data):
+        # sync shim over the shared event loop of the async client
+        import logbook_async
+        try:
+            # GETs were joined with identical ones already, a hedge must reach the API
+            call = logbook_async.request if method == GET else logbook_async.api
+            return logbook_async.run(call(method, url, data, headers), left)
+        except FutureTimeoutError:
+            return {'status': False, 'error': 'API deadline exceeded'}
+
+    stored = None
+    if method == GET and http_cache is not None:
+        stored = use_http_cache(http_cache.get, url)
+        if stored is not None and is_fresh(stored):
+            return {'status': True, 'data': loads(stored.body)}
+        if stored is not None:
+            headers = {**conditional_headers(stored), **(headers or {})}
+
+    endpoint = metrics.endpoint(url)
+    breaker, latencies = endpoint_state(endpoint)
+    if not breaker.allow():
+        metrics.increment(metrics.REJECTED_METRIC, {'endpoint': endpoint})
+        return degraded(stored, f'API unavailable, {endpoint} is failing')
+
+    # never wait past the handler's deadline
+    timeout = TIMEOUT if left is None else (min(TIMEOUT[0], left), min(TIMEOUT[1], left))
+    session = get_session()
+    started = time.perf_counter()
+    status = 'error'
+    # called once the request ends, neither a success nor a failure unless it is settled below
+    settle = breaker.release
     try:
         if method == POST:
-            response = requests.post(url, data=data, headers=headers)
+            response = session.post(url, data=data, headers=headers, timeout=timeout)
         elif method == PUT:
-            response = requests.put(url, data=data, headers=headers)
+            response = session.put(url, data=data, headers=headers, timeout=timeout)
         elif method == DELETE:
-            response = requests.delete(url, headers=headers)
+            response = session.delete(url, headers=headers, timeout=timeout)
         else:
-            response = requests.get(url, headers=headers)
+            response = session.get(url, headers=headers, timeout=timeout)
+        status = response.status_code
         response.raise_for_status()
     except HTTPError as http_err:
-        return {'status': False, 'error': f'HTTP error occurred: {http_err}'}
+        if status >= 500:
+            settle = breaker.failure
+            return degraded(stored, f'HTTP error occurred: {http_err}')
+        settle = breaker.success
+        # refused by the API, the same request sent again fails again
+        return {'status': False, 'error': f'HTTP error occurred: {http_err}', 'rejected': True}
+    except BodyError:
+        # neither a success nor a failure of the endpoint, the caller reports it
+        raise
     except Exception as err:
-        return {'status': False, 'error': f'API error occurred: {err}'}
+        # running out of the handler's budget says nothing about the endpoint
+        if expired():
+            return degraded(stored, 'API deadline exceeded')
+        settle = breaker.failure
+        return degraded(stored, f'API error occurred: {err}')
     else:
-        data = json.loads(response.text) if response.text else None
+        settle = breaker.success
+        body = response.content
+        if stored is not None and response.status_code == 304:
+            use_http_cache(http_cache.refresh, url, response.headers)
+            body = stored.body
+        elif method == GET and http_cache is not None:
+            use_http_cache(http_cache.store, url, response.headers, body)
+        data = loads(body) if body else None
         return {'status': True, 'data': data}
+    finally:
+        settle()
+        seconds = time.perf_counter() - started
+        metrics.observe_request(method, url, status, seconds)
+        if method == GET and status in (200, 304):
+            latencies.add(seconds)
+
+
+def budget():
+    """
+    Seconds a caller may still wait for a result, None without a deadline
+    """
+    left = remaining()
+    return None if left is None else max(left, 0)
+
 
+def endpoint_state(endpoint):
+    state = _endpoints.get(endpoint)
+    if state is None:
+        with _endpoints_lock:
+            state = _endpoints.get(endpoint)
+            if state is None:
+                breaker = CircuitBreaker(settings.API_BREAKER_FAILURES, settings.API_BREAKER_RESET)
+                state = _endpoints[endpoint] = (breaker, LatencyWindow())
+    return state
 
-def get_topic_by_id(topics, id):
-    return next((topic for topic in topics if topic['id'] == id), None)
+
+def degraded(stored, error):
+    """
+    Stale copy of a GET response when there is one, the error otherwise
+    """
+    if stored is not None:
+        return {'status': True, 'data': loads(stored.body), 'stale': True}
+    return {'status': False, 'error': error}
+
+
+def get_topic_by_id(id):
+    return topics.get(id)
 
 
 def get_topic_stories_count(topic_id):
-    stories = get_topic_stories(topic_id)
-    count = 0
-    if stories['status']:
-        count = len(stories['data'])
-    return count
\ No newline at end of file
+    count = get_cached_stories_count(topic_id)
+    if count is not None:
+        return count
+
+    # ask for a single story and read the paginated total
+    url = f'{settings.API_HOST}/stories/?topic={topic_id}&page_size=1&format=json'
+    stories = api(GET, url)
+    if not stories['status']:
+        stories = get_topic_stories(topic_id)
+    if not stories['status']:
+        return 0
+
+    return remember_stories_count(topic_id, stories['data'])
+
+
+def get_cached_stories_count(topic_id):
+    with _stories_counts_lock:
+        cached = _stories_counts.get(topic_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def remember_stories_count(topic_id, data):
+    if isinstance(data, dict) and 'count' in data:
+        count = data['count']
+    else:
+        # server does not paginate, the whole list came back
+        count = len(data)
+    with _stories_counts_lock:
+        _stories_counts[topic_id] = (count, time.monotonic() + settings.API_COUNT_TTL)
+    return count
+
+
+def adjust_stories_count(topic_id, delta):
+    with _stories_counts_lock:
+        cached = _stories_counts.get(topic_id)
+        if cached:
+            _stories_counts[topic_id] = (max(cached[0] + delta, 0), cached[1])
+
+
+def forget_stories_count(topic_id):
+    with _stories_counts_lock:
+        _stories_counts.pop(topic_id, None)
+
+
+def clear_stories_counts():
+    with _stories_counts_lock:
+        _stories_counts.clear()
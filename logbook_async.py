@@ -0,0 +1,380 @@
+import asyncio
+import atexit
+import concurrent.futures
+import inspect
+import threading
+import time
+import aiohttp
+import logbook
+import metrics
+from logbook import GET, POST, PUT, DELETE, INDEX_CURSOR, as_page, cache, get_index_page, topic_index, topics
+from http_cache import conditional_headers, is_fresh
+from models import Story, User, loads, stories, users
+from resilience import expired, remaining
+import settings
+
+
+RETRY_STATUSES = (502, 503, 504)
+
+_loop = None
+_loop_lock = threading.Lock()
+_session = None
+_semaphore = None
+# url -> task of the GET in flight, only touched from the event loop thread
+_flights = {}
+# next pages being fetched in the background, referenced until they are done
+_prefetches = set()
+
+
+def get_loop():
+    """
+    Event loop shared by all async API calls, running in a daemon thread
+    """
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='logbook-api', daemon=True).start()
+                atexit.register(shutdown)
+                _loop = loop
+    return _loop
+
+
+def shutdown():
+    if _loop is not None and _loop.is_running():
+        run(close(), timeout=5)
+
+
+def run(coro, timeout=None):
+    """
+    Run a coroutine on the shared loop and wait for its result from a synchronous caller
+    The coroutine is cancelled when it takes longer than timeout
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
+async def get_session():
+    global _session, _semaphore
+    if _session is None:
+        connector = aiohttp.TCPConnector(limit=settings.API_POOL_SIZE)
+        timeout = aiohttp.ClientTimeout(sock_connect=settings.API_CONNECT_TIMEOUT,
+                                        sock_read=settings.API_READ_TIMEOUT)
+        headers = {'Authorization': 'Token ' + settings.API_TOKEN}
+        _semaphore = asyncio.Semaphore(settings.API_CONCURRENCY)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def get_telegram_user(id):
+    url = f'{settings.API_HOST}/users?search={id}&format=json'
+    user = await cached_get('users', url, url, users)
+    if user['status']:
+        if len(user['data']) == 0:
+            user['status'] = False
+        else:
+            user['data'] = user['data'][0]
+    return user
+
+
+async def get_topics_page(cursor=None, search=None):
+    if cursor is None:
+        if search is not None and topic_index.is_fresh():
+            cursor = f'{INDEX_CURSOR}0:{search}'
+        elif search is not None:
+            cursor = f'{settings.API_HOST}/topics?search={search}&page_size={settings.PAGE_SIZE}&format=json'
+        else:
+            cursor = f'{settings.API_HOST}/topics?page_size={settings.PAGE_SIZE}&format=json'
+    if cursor.startswith(INDEX_CURSOR):
+        return get_index_page(cursor)
+    return await get_page('topics', cursor)
+
+
+async def get_stories_page(topic_id, cursor=None):
+    url = cursor or f'{settings.API_HOST}/stories/?topic={topic_id}&page_size={settings.PAGE_SIZE}&format=json'
+    return await get_page('stories', url)
+
+
+async def iter_topic_pages(search=None):
+    """
+    Topic pages fetched as they are consumed, a failed page is the last one
+    """
+    cursor = None
+    while True:
+        page = await get_topics_page(cursor, search)
+        yield page
+        if not page['status'] or not page['data']['next']:
+            return
+        cursor = page['data']['next']
+
+
+async def get_page(resource, url):
+    model = topics.topics if resource == 'topics' else stories
+    page = as_page(await cached_get(resource, url, url, model))
+    # fetch the next page in the background so paging forward hits the cache
+    if page['status'] and page['data']['next'] and cache.get(resource, page['data']['next']) is None:
+        prefetch = asyncio.ensure_future(cached_get(resource, page['data']['next'], page['data']['next'], model))
+        _prefetches.add(prefetch)
+        prefetch.add_done_callback(_prefetches.discard)
+    return page
+
+
+async def sync_topic_index(full=None):
+    newest = None if (logbook.full_index_sync() if full is None else full) else topic_index.newest()
+    topics = []
+    async for page in iter_topic_pages():
+        if not page['status']:
+            return page
+        results = page['data']['results']
+        new = results if newest is None else [topic for topic in results if topic['id'] > newest]
+        topics.extend(new)
+        if len(new) < len(results):
+            break
+    topic_index.sync(topics, complete=newest is None)
+    return {'status': True, 'data': topics}
+
+
+async def lookup_topic(id):
+    url = f'{settings.API_HOST}/topics/{id}/?format=json'
+    return await cached_get('topics', url, url, topics.intern)
+
+
+async def get_topic_stories(topic_id):
+    url = f'{settings.API_HOST}/stories/?topic={topic_id}&format=json'
+    return await cached_get('stories', url, url, stories)
+
+
+async def lookup_story(id):
+    url = f'{settings.API_HOST}/stories/{id}?format=json'
+    return await cached_get('story', id, url, Story.from_json)
+
+
+async def create_user(user):
+    url = f'{settings.API_HOST}/users/?format=json'
+    result = await api(POST, url, user)
+    if result['status']:
+        cache.invalidate('users')
+        result['data'] = User.from_json(result['data'])
+    return result
+
+
+async def remove_story(id, topic_id=None):
+    url = f'{settings.API_HOST}/stories/{id}/?format=json'
+    result = await api(DELETE, url)
+    if result['status']:
+        cache.invalidate('story', id)
+        cache.invalidate('stories')
+        if topic_id is None:
+            logbook.clear_stories_counts()
+        else:
+            logbook.adjust_stories_count(topic_id, -1)
+    return result
+
+
+async def remove_topic(id):
+    url = f'{settings.API_HOST}/topics/{id}/?format=json'
+    result = await api(DELETE, url)
+    if result['status']:
+        cache.invalidate('topics')
+        cache.invalidate('stories')
+        topic_index.remove(id)
+        topics.remove(id)
+        logbook.forget_stories_count(id)
+    return result
+
+
+async def update_story(id, data):
+    url = f'{settings.API_HOST}/stories/{id}/?format=json'
+    result = await api(PUT, url, data)
+    if result['status']:
+        cache.invalidate('story', id)
+        cache.invalidate('stories')
+    return result
+
+
+async def create_topic(title):
+    url = f'{settings.API_HOST}/topics/?format=json'
+    result = await api(POST, url, {'title': title})
+    if result['status']:
+        cache.invalidate('topics')
+        result['data'] = topics.intern(result['data'])
+        topic_index.add(result['data'])
+    return result
+
+
+async def create_story(story, idempotency_key=None):
+    url = f'{settings.API_HOST}/stories/?format=json'
+    headers = {'Idempotency-Key': idempotency_key} if idempotency_key else None
+    result = await api(POST, url, story, headers)
+    if result['status']:
+        cache.invalidate('stories')
+        logbook.adjust_stories_count(story['topic'], 1)
+    return result
+
+
+async def upload_story(story, body, content_type):
+    if inspect.isgenerator(body):
+        # aiohttp only streams async iterables, the sync client sends a generator body off the loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, logbook.upload_story, story, body, content_type)
+    url = f'{settings.API_HOST}/stories/?format=json'
+    result = await api(POST, url, body, {'Content-Type': content_type})
+    if result['status']:
+        cache.invalidate('stories')
+        logbook.adjust_stories_count(story['topic'], 1)
+    return result
+
+
+async def get_topic_stories_count(topic_id):
+    count = logbook.get_cached_stories_count(topic_id)
+    if count is not None:
+        return count
+
+    url = f'{settings.API_HOST}/stories/?topic={topic_id}&page_size=1&format=json'
+    stories = await api(GET, url)
+    if not stories['status']:
+        stories = await get_topic_stories(topic_id)
+    if not stories['status']:
+        return 0
+
+    return logbook.remember_stories_count(topic_id, stories['data'])
+
+
+async def cached_get(resource, key, url, model=None):
+    result = cache.get(resource, key)
+    if result is None:
+        result = await api(GET, url)
+        if result['status'] and model is not None:
+            result['data'] = model(result['data'])
+        logbook.remember(resource, key, result)
+    return dict(result)
+
+
+async def api(method, url, data=None, headers=None):
+    if method == GET and headers is None:
+        return await shared_get(url)
+    result = await request(method, url, data, headers)
+    if method != GET:
+        # reads started before a write may return old data, later reads must not join them
+        _flights.clear()
+        if logbook.http_cache is not None:
+            await use_http_cache(logbook.http_cache.expire)
+    return result
+
+
+async def shared_get(url, retry=True):
+    """
+    GET joining an identical request already in flight, only the first caller talks to the API
+    A follower with time left after the first caller ran out of its own sends the GET once more
+    """
+    flight = _flights.get(url)
+    leader = flight is None
+    if leader:
+        flight = _flights[url] = asyncio.ensure_future(request(GET, url))
+        flight.add_done_callback(lambda done: _land(url, done))
+    else:
+        metrics.count_coalesced(GET, url)
+    # a cancelled caller must not cancel the request the others wait for
+    result = await asyncio.shield(flight)
+    if not leader and retry and logbook.outlived(result):
+        return await shared_get(url, retry=False)
+    return dict(result)
+
+
+async def use_http_cache(call, *args):
+    # SQLite blocks, the loop keeps serving the other requests while it works in a thread
+    return await asyncio.get_running_loop().run_in_executor(None, logbook.use_http_cache, call, *args)
+
+
+def _land(url, flight):
+    if _flights.get(url) is flight:
+        del _flights[url]
+
+
+async def request(method, url, data=None, headers=None):
+    stored = None
+    if method == GET and logbook.http_cache is not None:
+        stored = await use_http_cache(logbook.http_cache.get, url)
+        if stored is not None and is_fresh(stored):
+            return {'status': True, 'data': loads(stored.body)}
+        if stored is not None:
+            headers = {**conditional_headers(stored), **(headers or {})}
+
+    endpoint = metrics.endpoint(url)
+    breaker, latencies = logbook.endpoint_state(endpoint)
+    if not breaker.allow():
+        metrics.increment(metrics.REJECTED_METRIC, {'endpoint': endpoint})
+        return logbook.degraded(stored, f'API unavailable, {endpoint} is failing')
+
+    # called once the request ends, neither a success nor a failure unless an attempt settles it, so a
+    # trial cut short by the deadline or a cancelled task doesn't leave the breaker half open
+    settle = breaker.release
+    try:
+        session = await get_session()
+        attempts = settings.API_RETRIES + 1 if method == GET else 1
+        async with _semaphore:
+            for attempt in range(attempts):
+                if attempt:
+                    await asyncio.sleep(settings.API_BACKOFF * 2 ** (attempt - 1))
+                # the deadline of the handler that made the call travels with the task
+                left = remaining()
+                if left is not None and left <= 0:
+                    return logbook.degraded(stored, 'API deadline exceeded')
+                timeout = aiohttp.ClientTimeout(total=left) if left is not None else None
+                started = time.perf_counter()
+                status = 'error'
+                try:
+                    async with session.request(method.upper(), url, data=data, headers=headers,
+                                               timeout=timeout) as response:
+                        status = response.status
+                        if response.status in RETRY_STATUSES and attempt + 1 < attempts:
+                            continue
+                        response.raise_for_status()
+                        body = await response.read()
+                        settle = breaker.success
+                        if stored is not None and response.status == 304:
+                            await use_http_cache(logbook.http_cache.refresh, url, response.headers)
+                            body = stored.body
+                        elif method == GET and logbook.http_cache is not None:
+                            await use_http_cache(logbook.http_cache.store, url, response.headers, body)
+                except aiohttp.ClientResponseError as http_err:
+                    if http_err.status >= 500:
+                        settle = breaker.failure
+                        return logbook.degraded(stored, f'HTTP error occurred: {http_err}')
+                    settle = breaker.success
+                    # refused by the API, the same request sent again fails again
+                    return {'status': False, 'error': f'HTTP error occurred: {http_err}', 'rejected': True}
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                    # running out of the handler's budget says nothing about the endpoint
+                    if expired():
+                        return logbook.degraded(stored, 'API deadline exceeded')
+                    if attempt + 1 < attempts:
+                        continue
+                    settle = breaker.failure
+                    return logbook.degraded(stored, f'API error occurred: {err}')
+                except Exception as err:
+                    settle = breaker.failure
+                    return logbook.degraded(stored, f'API error occurred: {err}')
+                else:
+                    data = loads(body) if body else None
+                    return {'status': True, 'data': data}
+                finally:
+                    # every attempt is recorded, retries included
+                    seconds = time.perf_counter() - started
+                    metrics.observe_request(method, url, status, seconds)
+                    if method == GET and status in (200, 304):
+                        latencies.add(seconds)
+    finally:
+        settle()
@@ -0,0 +1,117 @@
+import functools
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import requests
+import logbook
+import metrics
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# multipart field the file is sent in, same field that otherwise holds the telegram file path
+FILE_FIELD = 'content'
+PROGRESS_STEP = 5 * 1024 * 1024
+# telegram file urls carry the bot token, https://api.telegram.org/file/bot<token>/<file path>
+TOKEN_PATH = re.compile(r'/file/bot[^/]+/')
+
+_semaphore = threading.BoundedSemaphore(settings.MEDIA_MAX_TRANSFERS)
+# telegram downloads get a session of their own, the API session carries our API token
+_session = requests.Session()
+_stats_lock = threading.Lock()
+_stats = {'transfers': 0, 'active': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0}
+
+
+def upload_story(story, file_url):
+    """
+    Stream a telegram file into a multipart story upload, chunk by chunk, without holding it in memory
+    """
+    with _semaphore:
+        _count('active', 1)
+        started = time.monotonic()
+        transferred = [0]
+        try:
+            with _session.get(file_url, stream=True, timeout=(settings.API_CONNECT_TIMEOUT, settings.MEDIA_TIMEOUT)) \
+                    as download:
+                download.raise_for_status()
+                boundary = uuid.uuid4().hex
+                chunks = _progress(download.iter_content(settings.MEDIA_CHUNK_SIZE), transferred, file_url)
+                body = multipart(story, os.path.basename(file_url), chunks, boundary)
+                result = logbook.upload_story(story, body, f'multipart/form-data; boundary={boundary}')
+        except (requests.RequestException, logbook.BodyError) as err:
+            # a download failing mid-stream is raised from the upload body, the API breaker doesn't count it
+            result = {'status': False, 'error': f'Media download error occurred: {redact(str(err))}'}
+        finally:
+            _count('active', -1)
+
+        seconds = time.monotonic() - started
+        with _stats_lock:
+            _stats['transfers'] += 1
+            _stats['bytes'] += transferred[0]
+            _stats['seconds'] += seconds
+            if not result['status']:
+                _stats['failed'] += 1
+        logger.debug(f'Streamed {transferred[0]} bytes in {seconds:.2f}s {redact(file_url)}')
+        return result
+
+
+def redact(text):
+    """
+    Text with the bot token of telegram file urls replaced, for logs and error messages
+    """
+    return TOKEN_PATH.sub('/file/bot<token>/', text)
+
+
+def multipart(fields, filename, chunks, boundary):
+    for name, value in fields.items():
+        if value is None or name == FILE_FIELD:
+            continue
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{FILE_FIELD}"; filename="{filename}"\r\n'
+           f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result['throughput'] = result['bytes'] / result['seconds'] if result['seconds'] else 0
+    return result
+
+
+def register_metrics():
+    """
+    Transfer counters served with the other metrics, throughput is bytes over seconds
+    """
+    for metric, key in ((metrics.MEDIA_TRANSFERS_METRIC, 'transfers'), (metrics.MEDIA_FAILED_METRIC, 'failed'),
+                        (metrics.MEDIA_ACTIVE_METRIC, 'active'), (metrics.MEDIA_BYTES_METRIC, 'bytes'),
+                        (metrics.MEDIA_SECONDS_METRIC, 'seconds')):
+        metrics.gauge(metric, functools.partial(_read, key))
+
+
+def _read(key):
+    with _stats_lock:
+        return _stats[key]
+
+
+def _progress(chunks, transferred, file_url):
+    reported = 0
+    try:
+        for chunk in chunks:
+            transferred[0] += len(chunk)
+            if transferred[0] - reported >= PROGRESS_STEP:
+                reported = transferred[0]
+                logger.debug(f'Streaming {redact(file_url)} {reported // 1024} KB')
+            yield chunk
+    except requests.RequestException as err:
+        raise logbook.BodyError(err) from err
+
+
+def _count(key, delta):
+    with _stats_lock:
+        _stats[key] += delta
@@ -0,0 +1,283 @@
+import functools
+import logging
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+import profiler
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+HANDLER_METRIC = 'logbook_handler_seconds'
+API_METRIC = 'logbook_api_seconds'
+COALESCED_METRIC = 'logbook_api_coalesced_total'
+SEND_DELAY_METRIC = 'logbook_send_delay_seconds'
+SEND_DEPTH_METRIC = 'logbook_send_queue_depth'
+SEND_COALESCED_METRIC = 'logbook_send_coalesced_total'
+SEND_RETRY_AFTER_METRIC = 'logbook_send_retry_after_total'
+HEDGED_METRIC = 'logbook_api_hedged_total'
+REJECTED_METRIC = 'logbook_api_rejected_total'
+SESSIONS_METRIC = 'logbook_sessions'
+SESSIONS_EVICTED_METRIC = 'logbook_sessions_evicted_total'
+UPDATE_AGE_METRIC = 'logbook_update_age_seconds'
+UPDATE_QUEUE_METRIC = 'logbook_update_queue_depth'
+SHED_METRIC = 'logbook_updates_shed_total'
+CACHE_HITS_METRIC = 'logbook_cache_hits_total'
+CACHE_MISSES_METRIC = 'logbook_cache_misses_total'
+CACHE_ENTRIES_METRIC = 'logbook_cache_entries'
+CACHE_BYTES_METRIC = 'logbook_cache_bytes'
+MEDIA_TRANSFERS_METRIC = 'logbook_media_transfers_total'
+MEDIA_FAILED_METRIC = 'logbook_media_failed_total'
+MEDIA_ACTIVE_METRIC = 'logbook_media_active_transfers'
+MEDIA_BYTES_METRIC = 'logbook_media_bytes_total'
+MEDIA_SECONDS_METRIC = 'logbook_media_seconds_total'
+HELP = {
+    HANDLER_METRIC: 'Conversation handler latency',
+    API_METRIC: 'Logbook API request latency',
+    COALESCED_METRIC: 'GET requests answered by an identical request already in flight',
+    SEND_DELAY_METRIC: 'Time outgoing messages waited in the send queue',
+    SEND_DEPTH_METRIC: 'Outgoing messages waiting in the send queue',
+    SEND_COALESCED_METRIC: 'Message edits replaced by a newer edit before they were sent',
+    SEND_RETRY_AFTER_METRIC: 'Flood limit responses from telegram',
+    HEDGED_METRIC: 'Slow GET requests sent a second time',
+    REJECTED_METRIC: 'API requests failed fast by an open circuit breaker',
+    SESSIONS_METRIC: 'Users whose state is kept in memory',
+    SESSIONS_EVICTED_METRIC: 'Users whose state was evicted from memory',
+    UPDATE_AGE_METRIC: 'Age of updates when the dispatcher takes them, callback queries by the age of their keyboard',
+    UPDATE_QUEUE_METRIC: 'Updates received and not processed yet',
+    SHED_METRIC: 'Updates answered without running handlers, stale or repeated callback queries',
+    CACHE_HITS_METRIC: 'Reads answered by the memory cache',
+    CACHE_MISSES_METRIC: 'Reads the memory cache could not answer',
+    CACHE_ENTRIES_METRIC: 'Responses kept by the memory and the HTTP cache',
+    CACHE_BYTES_METRIC: 'Approximate size of the responses kept by the memory and the HTTP cache',
+    MEDIA_TRANSFERS_METRIC: 'Telegram files streamed into story uploads',
+    MEDIA_FAILED_METRIC: 'Telegram files whose download or upload failed',
+    MEDIA_ACTIVE_METRIC: 'Telegram files being streamed now',
+    MEDIA_BYTES_METRIC: 'Bytes of telegram files streamed into story uploads',
+    MEDIA_SECONDS_METRIC: 'Seconds spent streaming telegram files'
+}
+ID_RE = re.compile(r'/\d+(?=/|$)')
+
+enabled = settings.METRICS_ENABLED
+_lock = threading.Lock()
+_histograms = {}
+# counters are only bumped on rare events, so they are kept even when metrics are disabled
+_counters = {}
+# (metric, labels) -> function returning the current value, read when metrics are served
+_gauges = {}
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Estimated from the buckets, linear within the bucket the quantile falls into, never above the slowest
+        """
+        rank = q * self.count
+        seen = 0
+        lower = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            if count and seen + count >= rank:
+                upper = min(bound, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+
+def observe(metric, labels, seconds):
+    key = (metric, tuple(labels.items()))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(metric, labels):
+    key = (metric, tuple(labels.items()))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + 1
+
+
+def gauge(metric, value, labels=None):
+    """
+    Register a function returning the current value, metrics named _total are served as counters
+    """
+    with _lock:
+        _gauges[(metric, tuple((labels or {}).items()))] = value
+
+
+def observe_request(method, url, status, seconds):
+    if enabled:
+        observe(API_METRIC, {'method': method.upper(), 'endpoint': endpoint(url), 'status': str(status)}, seconds)
+
+
+def endpoint(url):
+    """
+    Path with ids replaced, so /stories/15/ and /stories/16/ are one endpoint
+    """
+    return ID_RE.sub('/{id}', urlsplit(url).path)
+
+
+def count_coalesced(method, url):
+    increment(COALESCED_METRIC, {'method': method.upper(), 'endpoint': endpoint(url)})
+
+
+def timed(callback):
+    """
+    Wrap a handler callback to record its latency
+    """
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            result = callback(update, context)
+            status = 'ok'
+            return result
+        finally:
+            observe(HANDLER_METRIC, {'handler': callback.__name__, 'status': status}, time.perf_counter() - started)
+
+    return wrapper
+
+
+def snapshot():
+    with _lock:
+        return [(metric, labels, histogram.buckets[:], histogram.count, histogram.sum,
+                 histogram.quantile(0.5), histogram.quantile(0.95))
+                for (metric, labels), histogram in sorted(_histograms.items())]
+
+
+def counters():
+    with _lock:
+        return sorted(_counters.items())
+
+
+def gauges():
+    with _lock:
+        values = sorted(_gauges.items(), key=lambda item: item[0])
+    return [(metric, labels, value()) for (metric, labels), value in values]
+
+
+def exposition():
+    """
+    Histograms in the Prometheus text format
+    """
+    lines = []
+    current = None
+    for metric, labels, buckets, count, total, p50, p95 in snapshot():
+        if metric != current:
+            current = metric
+            lines.append(f'# HELP {metric} {HELP[metric]}')
+            lines.append(f'# TYPE {metric} histogram')
+        names = ','.join(f'{name}="{value}"' for name, value in labels)
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, buckets):
+            cumulative += bucket
+            le = '+Inf' if bound == float('inf') else bound
+            lines.append(f'{metric}_bucket{{{names},le="{le}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{names}}} {total}')
+        lines.append(f'{metric}_count{{{names}}} {count}')
+    for (metric, labels), count in counters():
+        if metric != current:
+            current = metric
+            lines.append(f'# HELP {metric} {HELP[metric]}')
+            lines.append(f'# TYPE {metric} counter')
+        names = ','.join(f'{name}="{value}"' for name, value in labels)
+        lines.append(f'{metric}{{{names}}} {count}' if names else f'{metric} {count}')
+    for metric, labels, value in gauges():
+        if metric != current:
+            current = metric
+            lines.append(f'# HELP {metric} {HELP[metric]}')
+            lines.append(f"# TYPE {metric} {'counter' if metric.endswith('_total') else 'gauge'}")
+        names = ','.join(f'{name}="{label}"' for name, label in labels)
+        lines.append(f'{metric}{{{names}}} {value}' if names else f'{metric} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """
+    Short per handler and per endpoint report for the /stats command
+    """
+    lines = []
+    for metric, labels, buckets, count, total, p50, p95 in snapshot():
+        name = ' '.join(value for label, value in labels)
+        lines.append(f'{name}: {count}x avg {total / count * 1000:.0f}ms '
+                     f'p50 {p50 * 1000:.0f}ms p95 {p95 * 1000:.0f}ms')
+    for (metric, labels), count in counters():
+        name = ' '.join(value for label, value in labels)
+        lines.append(f"{name}: {count}x {metric[len('logbook_'):-len('_total')].replace('_', ' ')}".lstrip(': '))
+    for metric, labels, value in gauges():
+        name = ' '.join(label for name, label in labels)
+        lines.append(f"{name} {metric[len('logbook_'):].replace('_', ' ')}: {value}".lstrip())
+    return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            status, body = 200, exposition().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif url.path == '/profile' and settings.PROFILE_ENABLED and settings.PROFILE_HTTP:
+            status, body = self.profile(parse_qs(url.query))
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def profile(query):
+        try:
+            seconds = int(query.get('seconds', [settings.PROFILE_SECONDS])[0])
+        except ValueError:
+            return 400, b'seconds must be a number\n'
+        report = profiler.sample(max(1, min(seconds, settings.PROFILE_MAX_SECONDS)), settings.PROFILE_TOP)
+        if report is None:
+            return 409, b'a profile is already running\n'
+        return 200, report.encode()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start(port=settings.METRICS_PORT):
+    """
+    Serve /metrics in a daemon thread, returns None when the listener can't start
+    """
+    try:
+        server = ThreadingHTTPServer((settings.METRICS_LISTEN, port), MetricsHandler)
+    except OSError as err:
+        logger.error(f'Metrics listener failed {err}')
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Metrics listening on {settings.METRICS_LISTEN}:{port}/metrics')
+    return server
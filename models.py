@@ -0,0 +1,123 @@
+import json
+import sys
+import threading
+
+try:
+    # several times faster on API payloads, the standard library is used when it is not installed
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+class Model:
+    """
+    Slotted record of an API object, read like the dict it was decoded from
+    Fields the bot doesn't use are dropped, so a model takes a fraction of the memory of its dict
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**data)
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in self.__slots__ else None
+        return default if value is None else value
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()})'
+
+    # pickled with user_data as a dict, persisted users still load after fields are added
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+
+
+class Topic(Model):
+    __slots__ = ('id', 'title')
+
+
+class Story(Model):
+    __slots__ = ('id', 'type', 'description', 'topic', 'user', 'content')
+
+
+class User(Model):
+    __slots__ = ('id', 'telegram_id', 'first_name', 'last_name', 'username')
+
+
+def stories(data):
+    """
+    Stories of a list or a page of them
+    """
+    if isinstance(data, dict):
+        return {**data, 'results': [Story.from_json(story) for story in data['results']]}
+    return [Story.from_json(story) for story in data]
+
+
+def users(data):
+    return [User.from_json(user) for user in data]
+
+
+class TopicTable:
+    """
+    The one copy of every topic seen, shared by all users and caches and looked up by id
+    """
+
+    def __init__(self):
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def intern(self, data):
+        """
+        Topic of the decoded data, the known one when its title did not change
+        """
+        topic = self._topics.get(data['id'])
+        if topic is not None and topic.title == data['title']:
+            return topic
+        topic = Topic(id=data['id'], title=sys.intern(data['title'] or ''))
+        with self._lock:
+            self._topics[topic.id] = topic
+        return topic
+
+    def topics(self, data):
+        """
+        Topics of a list or a page of them
+        """
+        if isinstance(data, dict):
+            return {**data, 'results': [self.intern(topic) for topic in data['results']]}
+        return [self.intern(topic) for topic in data]
+
+    def get(self, id):
+        return self._topics.get(id)
+
+    def remove(self, id):
+        with self._lock:
+            self._topics.pop(id, None)
+
+    def __len__(self):
+        return len(self._topics)
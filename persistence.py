@@ -0,0 +1,140 @@
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+from telegram.ext.utils.promise import Promise
+
+
+logger = logging.getLogger(__name__)
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Stores user_data and conversation states in SQLite
+    Updates are collected in memory and written in one transaction every flush_interval seconds
+    Processes sharing the database pass owns(user_id), each one reads and writes only the users it owns
+    """
+
+    def __init__(self, path, flush_interval=5, owns=None):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.owns = owns or (lambda user_id: True)
+        self._user_data = {}
+        self._conversations = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        # other processes may hold the write lock for a flush
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS conversations '
+                         '(name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key))')
+        self._db.commit()
+
+        threading.Thread(target=self._flusher, name='persistence', daemon=True).start()
+
+    def get_user_data(self):
+        with self._flush_lock:
+            rows = self._db.execute('SELECT user_id, data FROM user_data').fetchall()
+        user_data = defaultdict(dict)
+        for user_id, data in rows:
+            if self.owns(user_id):
+                user_data[user_id] = pickle.loads(data)
+        logger.info(f'Loaded user data of {len(user_data)} users')
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        with self._flush_lock:
+            rows = self._db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+        # keys end with the user id, conversations are per chat and user
+        conversations = {tuple(json.loads(key)): state for key, state in rows}
+        return {key: pickle.loads(state) for key, state in conversations.items() if self.owns(key[-1])}
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            # handler still running, keep the state it started from
+            new_state = new_state[0]
+        with self._lock:
+            self._conversations[(name, json.dumps(key))] = new_state
+
+    def update_user_data(self, user_id, data):
+        if not self.owns(user_id):
+            # a stale copy, the process that owns the user writes it
+            return
+        with self._lock:
+            # shallow copy, handlers replace values rather than mutate them
+            self._user_data[user_id] = dict(data)
+
+    def drop_user_data(self, user_id):
+        """
+        Delete the stored user_data of a user no longer kept in memory, startup doesn't load it again
+        """
+        with self._lock:
+            self._user_data[user_id] = None
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self):
+        with self._lock:
+            user_data, self._user_data = self._user_data, {}
+            conversations, self._conversations = self._conversations, {}
+        if not user_data and not conversations:
+            return
+
+        try:
+            with self._flush_lock, self._db:
+                self._db.executemany(
+                    'DELETE FROM user_data WHERE user_id = ?',
+                    [(user_id,) for user_id, data in user_data.items() if data is None]
+                )
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                    [(user_id, pickle.dumps(data)) for user_id, data in user_data.items() if data is not None]
+                )
+                self._db.executemany(
+                    'DELETE FROM conversations WHERE name = ? AND key = ?',
+                    [key for key, state in conversations.items() if state is None]
+                )
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                    [(*key, pickle.dumps(state)) for key, state in conversations.items() if state is not None]
+                )
+        except Exception:
+            # put the batch back unless newer updates arrived meanwhile
+            with self._lock:
+                for user_id, data in user_data.items():
+                    self._user_data.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._conversations.setdefault(key, state)
+            raise
+        logger.debug(f'Flushed {len(user_data)} users and {len(conversations)} conversations')
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self.flush()
+        self._db.close()
+
+    def _flusher(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Persistence flush failed')
@@ -0,0 +1,206 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+# the running sampling, wrapped functions only check it when profiling is off
+_active = None
+_lock = threading.Lock()
+_local = threading.local()
+
+# seconds calls in flight at the end of a sampling get to finish and be counted
+GRACE = 5
+# frames kept for every allocation while sampling
+TRACE_FRAMES = 1
+# frames of every thread in the dump
+STACK_LIMIT = 12
+# characters of a call argument shown in the in-flight dump
+ARGUMENT_SIZE = 80
+OWN_MODULES = (cProfile, pstats, tracemalloc, sys.modules[__name__])
+
+
+def profiled(function):
+    """
+    Wrap a handler callback or an API function to be profiled while a sampling runs
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        sampling = _active
+        if sampling is None:
+            return function(*args, **kwargs)
+        return sampling.call(function, args, kwargs)
+
+    return wrapper
+
+
+def describe(function, args):
+    arguments = ', '.join(arg[:ARGUMENT_SIZE] if isinstance(arg, str) else type(arg).__name__ for arg in args)
+    return f'{function.__name__}({arguments})'
+
+
+class Sampling:
+    """
+    CPU profile of the wrapped calls, top allocations and the calls in flight of a few seconds of the live process
+    """
+
+    def __init__(self, seconds, top=30):
+        self.seconds = seconds
+        self.top = top
+        self.calls = 0
+        self._stats = pstats.Stats()
+        # call id -> (thread name, call, monotonic start) of the calls running now
+        self._running = {}
+        self._ids = 0
+        self._finished = threading.Condition()
+        self._done = False
+
+    def call(self, function, args, kwargs):
+        with self._finished:
+            self._ids += 1
+            call_id = self._ids
+            self._running[call_id] = (threading.current_thread().name, describe(function, args), time.monotonic())
+        # a thread runs one profiler, API calls of a profiled handler are part of its profile
+        outer = not getattr(_local, 'profiling', False)
+        profile = cProfile.Profile() if outer else None
+        try:
+            if profile is None:
+                return function(*args, **kwargs)
+            _local.profiling = True
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                _local.profiling = False
+        finally:
+            with self._finished:
+                del self._running[call_id]
+                if profile is not None and not self._done:
+                    self._stats.add(profile)
+                    self.calls += 1
+                self._finished.notify_all()
+
+    def run(self):
+        """
+        Sample for seconds and return the report
+        """
+        traced = not tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.start(TRACE_FRAMES)
+        started = time.time()
+        time.sleep(self.seconds)
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        threads = self._threads()
+        running = self._in_flight()
+        if traced:
+            tracemalloc.stop()
+        with self._finished:
+            self._finished.wait_for(lambda: not self._running, GRACE)
+            self._done = True
+            unfinished = len(self._running)
+
+        lines = [f'Profile of process {os.getpid()}, {self.seconds}s from '
+                 f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))}', '']
+        lines.append(f'== CPU, {self.calls} handler and API calls, {unfinished} still running not counted ==')
+        lines.append(self._cpu())
+        lines.append('== Memory, top allocations made while sampling and still alive ==')
+        lines.extend(self._memory(snapshot))
+        lines.append('')
+        lines.append(f'== Calls in flight at the end, {len(running)} ==')
+        lines.extend(running)
+        lines.append('')
+        lines.append('== Threads ==')
+        lines.extend(threads)
+        return '\n'.join(lines) + '\n'
+
+    def _cpu(self):
+        if not self.calls:
+            return 'no calls\n'
+        out = io.StringIO()
+        self._stats.stream = out
+        self._stats.strip_dirs().sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+    def _memory(self, snapshot):
+        if snapshot is None:
+            return ['tracemalloc unavailable']
+        # allocations of the profiler itself are not the process'
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, module.__file__) for module in OWN_MODULES])
+        return [f'{stat.size / 1024:.1f} KiB in {stat.count} blocks {stat.traceback[0]}'
+                for stat in snapshot.statistics('lineno')[:self.top]]
+
+    def _in_flight(self):
+        with self._finished:
+            running = sorted(self._running.values(), key=lambda call: call[2])
+            now = time.monotonic()
+        return [f'{now - started:.2f}s {thread}: {call}' for thread, call, started in running]
+
+    @staticmethod
+    def _threads():
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        lines = []
+        for ident, frame in sys._current_frames().items():
+            lines.append(f'{names.get(ident, ident)}:')
+            lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame, STACK_LIMIT))
+        return lines
+
+
+def sample(seconds, top=30):
+    """
+    Profile the process for seconds, returns the report or None when a sampling is already running
+    """
+    global _active
+    sampling = Sampling(seconds, top)
+    with _lock:
+        if _active is not None:
+            return None
+        _active = sampling
+    try:
+        return sampling.run()
+    finally:
+        _active = None
+
+
+def file_name():
+    return f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.txt'
+
+
+def save(report, directory):
+    """
+    Write a report to a file of its own in directory, returns its path
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, file_name())
+    with open(path, 'w') as file:
+        file.write(report)
+    return path
+
+
+def install_signal(seconds, directory, top=30, signum=signal.SIGUSR1):
+    """
+    Profile the process for seconds when it receives signum, the report is written to directory
+    """
+    def sample_to_disk():
+        report = sample(seconds, top)
+        if report is None:
+            logger.warning('Profile requested while one is running')
+            return
+        try:
+            logger.warning(f'Profile written to {save(report, directory)}')
+        except OSError as err:
+            # the report is not lost with the directory, the log has it
+            logger.warning(f'Profile not written to {directory} {err}\n{report}')
+
+    signal.signal(signum, lambda signum, frame: threading.Thread(target=sample_to_disk, name='profile',
+                                                                 daemon=True).start())
@@ -0,0 +1,122 @@
+import contextvars
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+# monotonic time the current handler has to be done by, None when there's no budget
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Give the calls made inside the block a time budget, an outer budget is never extended
+    """
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Seconds left of the current budget, None without one
+    """
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def budgeted(callback, seconds):
+    """
+    Wrap a handler callback so the API calls it makes share one time budget
+    """
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        with deadline(seconds):
+            return callback(update, context)
+
+    return wrapper
+
+
+class LatencyWindow:
+    """
+    Latencies of the last requests, p95 is recomputed every few samples
+    """
+
+    def __init__(self, size=200, min_samples=20, every=10):
+        self.min_samples = min_samples
+        self.every = every
+        self._samples = deque(maxlen=size)
+        self._added = 0
+        self._p95 = None
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._added += 1
+            if len(self._samples) >= self.min_samples and (self._p95 is None or self._added % self.every == 0):
+                samples = sorted(self._samples)
+                self._p95 = samples[int(len(samples) * 0.95) - 1]
+
+    def p95(self):
+        return self._p95
+
+
+class CircuitBreaker:
+    """
+    Fails fast after consecutive failures, lets one trial request through every reset_after seconds
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, reset_after=30):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self._failed = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_after:
+                # the first caller after the pause tries the endpoint, the others still fail fast
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failed = 0
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == self.HALF_OPEN or self._failed >= self.failures:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """
+        A request ended without telling whether the endpoint works, a trial is tried again after reset_after
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
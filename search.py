@@ -0,0 +1,155 @@
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+
+TOKEN_RE = re.compile(r'\w+')
+MIN_SIMILARITY = 0.5
+
+
+def normalize(text):
+    """
+    Lower case and strip accents, so 'Café' and 'cafe' match
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def trigrams(text):
+    padded = f'  {normalize(text)} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TopicIndex:
+    """
+    In-memory search index over topic titles with token, prefix and trigram matching
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.synced_at = None
+        # monotonic time of the last sync with every topic, renames and removals are applied by those only
+        self.full_synced_at = None
+        self._topics = {}
+        self._tokens = defaultdict(set)
+        self._vocabulary = []
+        self._trigrams = defaultdict(set)
+        self._trigram_counts = {}
+        self._lock = threading.RLock()
+
+    def is_fresh(self):
+        return self.synced_at is not None and time.monotonic() - self.synced_at < self.max_age
+
+    def newest(self):
+        with self._lock:
+            return max(self._topics, default=None)
+
+    def sync(self, topics, complete=True):
+        """
+        Apply a topics list, only changed topics are reindexed, topics missing from a complete list are removed
+        """
+        with self._lock:
+            ids = set()
+            for topic in topics:
+                ids.add(topic['id'])
+                current = self._topics.get(topic['id'])
+                if current is None or current['title'] != topic['title']:
+                    self.add(topic)
+            now = time.monotonic()
+            if complete:
+                for id in set(self._topics) - ids:
+                    self.remove(id)
+                self.full_synced_at = now
+            self.synced_at = now
+
+    def add(self, topic):
+        with self._lock:
+            if topic['id'] in self._topics:
+                self.remove(topic['id'])
+            self._topics[topic['id']] = topic
+            for token in set(tokenize(topic['title'])):
+                if not self._tokens[token]:
+                    bisect.insort(self._vocabulary, token)
+                self._tokens[token].add(topic['id'])
+            title_trigrams = trigrams(topic['title'])
+            self._trigram_counts[topic['id']] = len(title_trigrams)
+            for trigram in title_trigrams:
+                self._trigrams[trigram].add(topic['id'])
+
+    def remove(self, id):
+        with self._lock:
+            topic = self._topics.pop(id, None)
+            if topic is None:
+                return
+            del self._trigram_counts[id]
+            for token in set(tokenize(topic['title'])):
+                self._tokens[token].discard(id)
+                if not self._tokens[token]:
+                    del self._tokens[token]
+                    del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+            for trigram in trigrams(topic['title']):
+                self._trigrams[trigram].discard(id)
+                if not self._trigrams[trigram]:
+                    del self._trigrams[trigram]
+
+    def search(self, query, limit=None):
+        """
+        Topics ranked by relevance, every query word has to match a title word or its prefix,
+        when nothing matches titles close enough by trigrams are returned to tolerate typos
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            postings = []
+            for token in tokens:
+                exact = self._tokens.get(token, set())
+                prefixed = [self._tokens[word] for word in self._prefixed(token)]
+                postings.append((exact, prefixed, len(exact) + sum(map(len, prefixed))))
+
+            # start from the rarest word and only filter the candidates for the others
+            postings.sort(key=lambda posting: posting[2])
+            exact, prefixed, size = postings[0]
+            matched = exact.union(*prefixed)
+            for exact, prefixed, size in postings[1:]:
+                matched = {id for id in matched if id in exact or any(id in ids for ids in prefixed)}
+
+            if matched:
+                results = [
+                    (sum(3 if id in exact else 2 for exact, prefixed, size in postings), self._topics[id])
+                    for id in matched
+                ]
+            else:
+                results = self._similar(query)
+
+        # shorter titles are the more specific match
+        results.sort(key=lambda result: (-result[0], len(result[1]['title']), result[1]['title']))
+        return [topic for score, topic in results[:limit]]
+
+    def _similar(self, query):
+        query_trigrams = trigrams(query)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for id in self._trigrams.get(trigram, ()):
+                shared[id] += 1
+        results = []
+        for id, count in shared.items():
+            # share of the query found in the title, penalised a little for longer titles
+            similarity = count / len(query_trigrams) - self._trigram_counts[id] / 1000
+            if similarity >= MIN_SIMILARITY:
+                results.append((similarity, self._topics[id]))
+        return results
+
+    def _prefixed(self, token):
+        index = bisect.bisect_right(self._vocabulary, token)
+        while index < len(self._vocabulary) and self._vocabulary[index].startswith(token):
+            yield self._vocabulary[index]
+            index += 1
@@ -0,0 +1,280 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.ext import ExtBot
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# interactive replies go before bulk notifications
+INTERACTIVE = 0
+BULK = 1
+PRIORITIES = ('interactive', 'bulk')
+
+# chats that sent nothing for this long are forgotten, their rate limit has long recovered
+PRUNE_INTERVAL = 60
+
+
+class Bucket:
+    """
+    Token bucket, refilled with rate tokens a second up to burst
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Outgoing:
+    __slots__ = ('method', 'args', 'kwargs', 'priority', 'key', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, method, args, kwargs, priority, key):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.key = key
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class Chat:
+    __slots__ = ('queue', 'bucket', 'busy')
+
+    def __init__(self, bucket):
+        self.queue = deque()
+        self.bucket = bucket
+        self.busy = False
+
+
+class Sender:
+    """
+    Queue of outgoing Bot API calls sent within telegram flood limits, globally and per chat
+    Calls to one chat are sent one at a time in order, a pending edit of a message is replaced by a newer edit
+    """
+
+    def __init__(self, rate=30, chat_rate=1, chat_burst=3, workers=4, max_retries=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = Bucket(rate, rate)
+        self._chats = {}
+        # chat ids with calls waiting and none in flight, by priority of their first call
+        self._ready = tuple(deque() for priority in PRIORITIES)
+        self._depth = 0
+        self._paused_until = 0
+        self._pruned_at = time.monotonic()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sender')
+        self._thread = threading.Thread(target=self._scheduler, name='sender-scheduler', daemon=True)
+        self._thread.start()
+        metrics.gauge(metrics.SEND_DEPTH_METRIC, self.depth)
+
+    def submit(self, chat_id, method, args, kwargs, priority=INTERACTIVE, key=None):
+        """
+        Queue a Bot API call, returns a Future of its result
+        """
+        with self._condition:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = Chat(Bucket(self.chat_rate, self.chat_burst))
+            if key is not None:
+                for pending in chat.queue:
+                    if pending.key == key:
+                        # the newer edit supersedes the one still waiting
+                        pending.method, pending.args, pending.kwargs = method, args, kwargs
+                        metrics.increment(metrics.SEND_COALESCED_METRIC, {})
+                        return pending.future
+            outgoing = Outgoing(method, args, kwargs, priority, key)
+            chat.queue.append(outgoing)
+            self._depth += 1
+            if len(chat.queue) == 1 and not chat.busy:
+                self._ready[priority].append(chat_id)
+                self._condition.notify()
+        return outgoing.future
+
+    def depth(self):
+        return self._depth
+
+    def stop(self, timeout=10):
+        """
+        Send what is queued, waiting up to timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._depth and time.monotonic() < deadline:
+                self._condition.wait(0.1)
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        self._pool.shutdown()
+
+    def _scheduler(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                chat_id, outgoing, wait = self._next(now)
+                if outgoing is None:
+                    self._condition.wait(wait)
+                    continue
+            if metrics.enabled:
+                metrics.observe(metrics.SEND_DELAY_METRIC, {'priority': PRIORITIES[outgoing.priority]},
+                                now - outgoing.enqueued)
+            self._pool.submit(self._send, chat_id, outgoing)
+
+    def _next(self, now):
+        if now >= self._pruned_at + PRUNE_INTERVAL:
+            self._prune(now)
+        if now < self._paused_until:
+            return None, None, self._paused_until - now
+        wait = self._global.wait(now)
+        if wait:
+            return None, None, wait
+
+        soonest = None
+        for ready in self._ready:
+            for _ in range(len(ready)):
+                chat_id = ready.popleft()
+                chat = self._chats[chat_id]
+                wait = chat.bucket.wait(now)
+                if not wait:
+                    chat.busy = True
+                    chat.bucket.take(now)
+                    self._global.take(now)
+                    self._depth -= 1
+                    return chat_id, chat.queue.popleft(), None
+                ready.append(chat_id)
+                soonest = wait if soonest is None else min(soonest, wait)
+        return None, None, soonest
+
+    def _send(self, chat_id, outgoing):
+        retry = False
+        try:
+            outgoing.attempts += 1
+            outgoing.future.set_result(outgoing.method(*outgoing.args, **outgoing.kwargs))
+        except RetryAfter as err:
+            logger.warning(f'Flood limit reached, sending paused for {err.retry_after}s')
+            metrics.increment(metrics.SEND_RETRY_AFTER_METRIC, {})
+            with self._condition:
+                self._paused_until = max(self._paused_until, time.monotonic() + err.retry_after)
+            retry = True
+        except BadRequest as err:
+            if 'not modified' in str(err):
+                # a repeated edit with the same text, nothing to show
+                outgoing.future.set_result(None)
+            else:
+                logger.error(f'Send to {chat_id} failed {err}')
+                outgoing.future.set_exception(err)
+        except TimedOut as err:
+            if outgoing.key is None:
+                # telegram may have got the call, a message sent again would show twice
+                logger.error(f'Send to {chat_id} timed out {err}')
+                outgoing.future.set_exception(err)
+            else:
+                # an edit made twice shows the same text
+                logger.warning(f'Send to {chat_id} attempt {outgoing.attempts} timed out {err}')
+                retry = True
+        except NetworkError as err:
+            # the connection failed, the call is tried again
+            logger.warning(f'Send to {chat_id} attempt {outgoing.attempts} failed {err}')
+            retry = True
+        except TelegramError as err:
+            logger.error(f'Send to {chat_id} failed {err}')
+            outgoing.future.set_exception(err)
+        except Exception as err:
+            logger.exception(f'Send to {chat_id} failed')
+            outgoing.future.set_exception(err)
+
+        if retry and outgoing.attempts > self.max_retries:
+            logger.error(f'Send to {chat_id} dropped after {outgoing.attempts} attempts')
+            outgoing.future.set_exception(TelegramError('Send attempts exhausted'))
+            retry = False
+
+        with self._condition:
+            chat = self._chats[chat_id]
+            chat.busy = False
+            if retry:
+                chat.queue.appendleft(outgoing)
+                self._depth += 1
+            if chat.queue:
+                self._ready[chat.queue[0].priority].append(chat_id)
+            self._condition.notify_all()
+
+    def _prune(self, now):
+        self._pruned_at = now
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.queue and not chat.busy and chat.bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+
+class QueuedBot(ExtBot):
+    """
+    Bot whose messages, media and message edits go through the Sender queue, they return a Future instead of a Message
+    Pass priority=BULK for notifications nobody is waiting for, without a sender calls are made directly
+    """
+
+    def __init__(self, *args, sender=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sender = sender
+
+    def send_message(self, *args, priority=INTERACTIVE, **kwargs):
+        return self._submit(super().send_message, args, kwargs, priority)
+
+    def send_photo(self, *args, priority=INTERACTIVE, **kwargs):
+        return self._submit(super().send_photo, args, kwargs, priority)
+
+    def send_video(self, *args, priority=INTERACTIVE, **kwargs):
+        return self._submit(super().send_video, args, kwargs, priority)
+
+    def send_media_group(self, *args, priority=INTERACTIVE, **kwargs):
+        return self._submit(super().send_media_group, args, kwargs, priority)
+
+    def send_document(self, *args, priority=INTERACTIVE, **kwargs):
+        return self._submit(super().send_document, args, kwargs, priority)
+
+    def edit_message_text(self, *args, priority=INTERACTIVE, **kwargs):
+        if self.sender is None:
+            return super().edit_message_text(*args, **kwargs)
+        chat_id = kwargs.get('chat_id')
+        message_id = kwargs.get('message_id') or kwargs.get('inline_message_id')
+        return self.sender.submit(chat_id, super().edit_message_text, args, kwargs, priority,
+                                  key=('edit', message_id))
+
+    def _submit(self, method, args, kwargs, priority):
+        if self.sender is None:
+            return method(*args, **kwargs)
+        chat_id = kwargs.get('chat_id', args[0] if args else None)
+        return self.sender.submit(chat_id, method, args, kwargs, priority)
+
+
+def sent(result):
+    """
+    Result of a QueuedBot call, waits for it when the call went through the Sender queue
+    """
+    return result.result() if isinstance(result, Future) else result
@@ -0,0 +1,221 @@
+import logging
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from telegram.ext.utils.promise import Promise
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# users listed by size in the report
+REPORT_LARGEST = 5
+
+
+def deep_size(value, seen=None):
+    """
+    Approximate bytes held by a value and everything it references, shared objects counted once
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif hasattr(value, '__slots__'):
+        size += sum(deep_size(getattr(value, name, None), seen) for name in value.__slots__)
+    return size
+
+
+def is_running(state):
+    # a run_async handler is still working on the conversation
+    return isinstance(state, tuple) and len(state) == 2 and isinstance(state[1], Promise)
+
+
+class Sessions:
+    """
+    Bounds the users kept in memory, user_data and conversation states of the dispatcher
+    Conversations idle for timeout seconds are ended, users idle for max_idle seconds or least recently
+    active beyond max_entries are evicted. Evicted state is spilled to SQLite and restored on the user's
+    next update, it leaves the persistence so startup loads only the users in memory
+    """
+
+    def __init__(self, dispatcher, conversations, timeout=0, max_idle=86400, max_entries=10000, spill_path=None,
+                 spill_ttl=30 * 86400):
+        self.dispatcher = dispatcher
+        self.conversations = conversations
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_entries = max_entries
+        self.spill_ttl = spill_ttl
+        # called with the update and context of a user whose conversation timed out, on their next update
+        self.on_expired = None
+        self.evicted = 0
+        self.restored = 0
+        self.expired = 0
+        # user id -> monotonic time of the last update, least recently active first
+        self._seen = OrderedDict()
+        self._expired = set()
+        self._spilled = set()
+        self._lock = threading.Lock()
+        self._db = None
+        if spill_path:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                             'user_id INTEGER PRIMARY KEY, user_data BLOB, conversations BLOB, spilled_at REAL)')
+            self._db.execute('DELETE FROM sessions WHERE spilled_at < ?', (time.time() - spill_ttl,))
+            self._db.commit()
+            self._spilled = {row[0] for row in self._db.execute('SELECT user_id FROM sessions')}
+
+        # users loaded by persistence count as active at startup
+        now = time.monotonic()
+        for user_id in list(dispatcher.user_data):
+            self._seen[user_id] = now
+        metrics.gauge(metrics.SESSIONS_METRIC, self.count)
+
+    def count(self):
+        return len(self._seen)
+
+    def touch(self, update, context):
+        """
+        Handler callback run before all others, restores a spilled user before the conversation sees the update
+        """
+        user = update.effective_user
+        if user is None:
+            return
+        with self._lock:
+            self._seen[user.id] = time.monotonic()
+            self._seen.move_to_end(user.id)
+            expired = user.id in self._expired
+            self._expired.discard(user.id)
+            spilled = user.id in self._spilled
+            self._spilled.discard(user.id)
+        if spilled:
+            self._restore(user.id)
+        elif expired and self.on_expired is not None:
+            self.on_expired(update, context)
+
+    def evict(self, context=None):
+        """
+        Job callback, ends timed out conversations and evicts idle users
+        """
+        now = time.monotonic()
+        with self._lock:
+            seen = list(self._seen.items())
+        keys = self._conversation_keys()
+        over = len(seen) - self.max_entries
+        evicted = expired = 0
+        for user_id, last in seen:
+            idle = now - last
+            if over <= 0 and idle <= self.max_idle and (not self.timeout or idle <= self.timeout):
+                # least recently active first, everyone after is more recent
+                break
+            if any(is_running(handler.conversations.get(key)) for handler, key in keys[user_id]):
+                continue
+            if over > 0 or idle > self.max_idle:
+                if self._evict(user_id, last, keys[user_id]):
+                    evicted += 1
+                    over -= 1
+            elif keys[user_id] and self._end(user_id, last, keys[user_id]):
+                expired += 1
+        if evicted or expired:
+            logger.info(f'Sessions evicted {evicted} users, ended {expired} idle conversations, '
+                        f'{len(self._seen)} in memory')
+
+    def report(self):
+        """
+        Short report of users in memory and their approximate memory for the /sessions command
+        """
+        now = time.monotonic()
+        with self._lock:
+            oldest = now - next(iter(self._seen.values())) if self._seen else 0
+        sizes = sorted(((deep_size(data), user_id) for user_id, data in list(self.dispatcher.user_data.items())),
+                       reverse=True)
+        total = sum(size for size, user_id in sizes)
+        states = sum(len(handler.conversations) for handler in self.conversations)
+        lines = [
+            f'users in memory: {len(self._seen)}, user_data entries: {len(sizes)}, conversations: {states}',
+            f'user_data: ~{total / 1024:.0f} KiB, ~{total / len(sizes) if sizes else 0:.0f} bytes per user',
+            f'spilled: {len(self._spilled)}, evicted: {self.evicted}, restored: {self.restored}, '
+            f'timed out: {self.expired}',
+            f'least recently active: {oldest:.0f}s ago'
+        ]
+        lines.extend(f'user {user_id}: ~{size} bytes' for size, user_id in sizes[:REPORT_LARGEST])
+        return lines
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+
+    def _conversation_keys(self):
+        # conversation keys end with the user id, one pass over all conversations for every user
+        keys = defaultdict(list)
+        for handler in self.conversations:
+            for key in list(handler.conversations):
+                keys[key[-1]].append((handler, key))
+        return keys
+
+    def _evict(self, user_id, last, keys):
+        with self._lock:
+            if self._seen.get(user_id) != last:
+                # an update arrived since the snapshot, its handler may be using the user's state
+                return False
+            del self._seen[user_id]
+            self._expired.discard(user_id)
+            data = self.dispatcher.user_data.pop(user_id, None)
+            states = {}
+            for handler, key in keys:
+                state = handler.conversations.pop(key, None)
+                if state is not None:
+                    states[(handler.name, key)] = state
+                if handler.persistent and handler.persistence:
+                    handler.persistence.update_conversation(handler.name, key, None)
+            persistence = self.dispatcher.persistence
+            if persistence is not None and persistence.store_user_data:
+                persistence.drop_user_data(user_id)
+            if self._db is not None and (data or states):
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                                     (user_id, pickle.dumps(data), pickle.dumps(states), time.time()))
+                self._spilled.add(user_id)
+        self.evicted += 1
+        metrics.increment(metrics.SESSIONS_EVICTED_METRIC, {})
+        return True
+
+    def _end(self, user_id, last, keys):
+        with self._lock:
+            if self._seen.get(user_id) != last:
+                return False
+            for handler, key in keys:
+                handler.conversations.pop(key, None)
+                if handler.persistent and handler.persistence:
+                    handler.persistence.update_conversation(handler.name, key, None)
+            self._expired.add(user_id)
+        self.expired += 1
+        return True
+
+    def _restore(self, user_id):
+        with self._lock:
+            row = self._db.execute('SELECT user_data, conversations FROM sessions WHERE user_id = ?',
+                                   (user_id,)).fetchone()
+            with self._db:
+                self._db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        if row is None:
+            return
+        data, states = pickle.loads(row[0]), pickle.loads(row[1])
+        # the update's context already holds this user's dict, it is filled in place
+        self.dispatcher.user_data[user_id].update(data or {})
+        handlers = {handler.name: handler for handler in self.conversations}
+        for (name, key), state in states.items():
+            if name in handlers:
+                handlers[name].conversations.setdefault(key, state)
+        self.restored += 1
+        logger.debug(f'Session of {user_id} restored')
@@ -5,13 +5,118 @@ from configparser import RawConfigParser
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 env = RawConfigParser()
-env.read(BASE_DIR + '/env.ini')
+# LOGBOOK_ENV points the tests at their own settings
+env.read(os.environ.get('LOGBOOK_ENV', BASE_DIR + '/env.ini'))
 
 TELEGRAM_TOKEN = env['telegram']['token']
 API_HOST = env['api']['host']
 API_TOKEN = env['api']['token']
 REGISTRATION_CODE = env['telegram']['code']
+ADMINS = [int(id) for id in env.get('telegram', 'admins', fallback='').split(',') if id.strip()]
+
+API_CLIENT = env.get('api', 'client', fallback='requests')
+API_CONCURRENCY = env.getint('api', 'concurrency', fallback=100)
+API_POOL_SIZE = env.getint('api', 'pool_size', fallback=10)
+API_CONNECT_TIMEOUT = env.getfloat('api', 'connect_timeout', fallback=3.05)
+API_READ_TIMEOUT = env.getfloat('api', 'read_timeout', fallback=10)
+API_RETRIES = env.getint('api', 'retries', fallback=3)
+API_BACKOFF = env.getfloat('api', 'backoff', fallback=0.3)
+API_COUNT_TTL = env.getint('api', 'count_ttl', fallback=300)
+API_DEADLINE = env.getfloat('api', 'deadline', fallback=8)
+API_HEDGE = env.getboolean('api', 'hedge', fallback=False)
+API_BREAKER_FAILURES = env.getint('api', 'breaker_failures', fallback=5)
+API_BREAKER_RESET = env.getfloat('api', 'breaker_reset', fallback=30)
+
+CACHE_MAX_ENTRIES = env.getint('cache', 'max_entries', fallback=1000)
+CACHE_MAX_BYTES = env.getint('cache', 'max_bytes', fallback=16 * 1024 * 1024)
+CACHE_TTL = {
+    'users': env.getint('cache', 'users_ttl', fallback=3600),
+    'topics': env.getint('cache', 'topics_ttl', fallback=60),
+    'stories': env.getint('cache', 'stories_ttl', fallback=60),
+    'story': env.getint('cache', 'story_ttl', fallback=300)
+}
+
+HTTP_CACHE_ENABLED = env.getboolean('cache', 'http_enabled', fallback=False)
+HTTP_CACHE_PATH = env.get('cache', 'http_path', fallback=BASE_DIR + '/http_cache.sqlite')
+HTTP_CACHE_MAX_BYTES = env.getint('cache', 'http_max_bytes', fallback=64 * 1024 * 1024)
+
+SEARCH_SYNC_INTERVAL = env.getint('search', 'sync_interval', fallback=300)
+SEARCH_FULL_SYNC_INTERVAL = env.getint('search', 'full_sync_interval', fallback=3600)
+
+METRICS_ENABLED = env.getboolean('metrics', 'enabled', fallback=False)
+METRICS_LISTEN = env.get('metrics', 'listen', fallback='127.0.0.1')
+METRICS_PORT = env.getint('metrics', 'port', fallback=9108)
+
+PROFILE_ENABLED = env.getboolean('profile', 'enabled', fallback=True)
+PROFILE_SECONDS = env.getint('profile', 'seconds', fallback=30)
+PROFILE_MAX_SECONDS = env.getint('profile', 'max_seconds', fallback=300)
+PROFILE_TOP = env.getint('profile', 'top', fallback=30)
+PROFILE_DIR = env.get('profile', 'dir', fallback=BASE_DIR + '/profiles')
+PROFILE_HTTP = env.getboolean('profile', 'http', fallback=False)
+
+WEBHOOK_ENABLED = env.getboolean('webhook', 'enabled', fallback=False)
+WEBHOOK_URL = env.get('webhook', 'url', fallback='')
+WEBHOOK_LISTEN = env.get('webhook', 'listen', fallback='127.0.0.1')
+WEBHOOK_PORT = env.getint('webhook', 'port', fallback=8443)
+WEBHOOK_PATH = env.get('webhook', 'path', fallback='/telegram')
+WEBHOOK_SECRET = env.get('webhook', 'secret', fallback='')
+WEBHOOK_MAX_CONNECTIONS = env.getint('webhook', 'max_connections', fallback=40)
+
+CLUSTER_PROCESSES = env.getint('cluster', 'processes', fallback=4)
+CLUSTER_LISTEN = env.get('cluster', 'listen', fallback='127.0.0.1')
+CLUSTER_PORT = env.getint('cluster', 'port', fallback=8600)
+CLUSTER_WORKERS = [url.strip() for url in env.get('cluster', 'workers', fallback='').split(',') if url.strip()]
+CLUSTER_TIMEOUT = env.getfloat('cluster', 'timeout', fallback=10)
+CLUSTER_POLL_TIMEOUT = env.getint('cluster', 'poll_timeout', fallback=10)
+CLUSTER_STOP_TIMEOUT = env.getfloat('cluster', 'stop_timeout', fallback=30)
+CLUSTER_MAX_PENDING = env.getint('cluster', 'max_pending', fallback=10000)
+
+SENDER_ENABLED = env.getboolean('sender', 'enabled', fallback=True)
+SENDER_RATE = env.getfloat('sender', 'rate', fallback=30)
+SENDER_CHAT_RATE = env.getfloat('sender', 'chat_rate', fallback=1)
+SENDER_CHAT_BURST = env.getint('sender', 'chat_burst', fallback=3)
+SENDER_WORKERS = env.getint('sender', 'workers', fallback=4)
+SENDER_MAX_RETRIES = env.getint('sender', 'max_retries', fallback=3)
 
 LANG = env['settings']['language']
 LOGGING_LEVEL = env['settings']['logging_level']
 SITE = env['settings']['site']
+HANDLERS = env.get('settings', 'handlers', fallback='sync')
+WORKERS = env.getint('settings', 'workers', fallback=4)
+PAGE_SIZE = env.getint('settings', 'page_size', fallback=20)
+ALBUM_WINDOW = env.getfloat('settings', 'album_window', fallback=1.5)
+
+PERSISTENCE_ENABLED = env.getboolean('persistence', 'enabled', fallback=True)
+PERSISTENCE_PATH = env.get('persistence', 'path', fallback=BASE_DIR + '/bot.sqlite')
+PERSISTENCE_FLUSH_INTERVAL = env.getfloat('persistence', 'flush_interval', fallback=5)
+
+SESSIONS_TIMEOUT = env.getfloat('sessions', 'timeout', fallback=0)
+SESSIONS_MAX_IDLE = env.getfloat('sessions', 'max_idle', fallback=7 * 86400)
+SESSIONS_MAX_ENTRIES = env.getint('sessions', 'max_entries', fallback=10000)
+SESSIONS_INTERVAL = env.getfloat('sessions', 'interval', fallback=300)
+SESSIONS_SPILL = env.getboolean('sessions', 'spill', fallback=True)
+SESSIONS_SPILL_PATH = env.get('sessions', 'spill_path', fallback=BASE_DIR + '/sessions.sqlite')
+SESSIONS_SPILL_TTL = env.getfloat('sessions', 'spill_ttl', fallback=30 * 86400)
+
+ADMISSION_ENABLED = env.getboolean('admission', 'enabled', fallback=True)
+ADMISSION_MAX_AGE = env.getfloat('admission', 'max_age', fallback=1800)
+ADMISSION_COLLAPSE = env.getfloat('admission', 'collapse', fallback=1.0)
+
+JOURNAL_ENABLED = env.getboolean('journal', 'enabled', fallback=False)
+JOURNAL_PATH = env.get('journal', 'path', fallback=BASE_DIR + '/journal.sqlite')
+JOURNAL_BATCH_SIZE = env.getint('journal', 'batch_size', fallback=20)
+JOURNAL_INTERVAL = env.getfloat('journal', 'interval', fallback=2)
+JOURNAL_MAX_ATTEMPTS = env.getint('journal', 'max_attempts', fallback=10)
+JOURNAL_BACKOFF = env.getfloat('journal', 'backoff', fallback=5)
+JOURNAL_WORKERS = env.getint('journal', 'workers', fallback=4)
+
+MEDIA_STREAM = env.getboolean('media', 'stream', fallback=False)
+MEDIA_MAX_TRANSFERS = env.getint('media', 'max_transfers', fallback=2)
+MEDIA_CHUNK_SIZE = env.getint('media', 'chunk_size', fallback=64 * 1024)
+MEDIA_TIMEOUT = env.getfloat('media', 'timeout', fallback=60)
+MEDIA_FILE_IDS_ENABLED = env.getboolean('media', 'file_ids_enabled', fallback=True)
+MEDIA_FILE_IDS_PATH = env.get('media', 'file_ids_path', fallback=BASE_DIR + '/file_ids.sqlite')
+
+IMPORT_DIR = env.get('import', 'dir', fallback=BASE_DIR + '/imports')
+IMPORT_BATCH_SIZE = env.getint('import', 'batch_size', fallback=50)
+IMPORT_WORKERS = env.getint('import', 'workers', fallback=4)
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+
+# settings are read when modules are imported, tests never see a local env.ini
+os.environ['LOGBOOK_ENV'] = os.path.join(ROOT, 'tests', 'env.ini')
+sys.path.insert(0, ROOT)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = json.dumps(self.server.body).encode()
+        try:
+            self.send_response(self.server.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # the client gave up waiting
+            pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.posted += 1
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api_server():
+    """
+    Local stand-in of the API answering every GET with body after delay seconds, POSTs are counted
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+    server.daemon_threads = True
+    server.delay = 0
+    server.status = 200
+    server.body = []
+    server.posted = 0
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
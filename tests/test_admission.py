@@ -0,0 +1,97 @@
+import time
+from queue import Queue
+import pytest
+from telegram import Update
+import admission
+from bench.updates import FakeBot, callback, message
+
+
+class AnsweringBot(FakeBot):
+    """
+    Bot that keeps the callback query answers it is asked to send
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.answers = []
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        if endpoint == 'answerCallbackQuery':
+            self.answers.append(data)
+        return super()._post(endpoint, data, timeout, api_kwargs)
+
+
+class Dispatcher:
+    def __init__(self):
+        self.bot = AnsweringBot()
+        self.update_queue = Queue()
+        self.processed = []
+
+    def process_update(self, update):
+        self.processed.append(update.update_id)
+
+    def run_async(self, fn, *args):
+        fn(*args)
+
+
+@pytest.fixture
+def dispatcher():
+    return Dispatcher()
+
+
+def receive(dispatcher, data, age=0):
+    if age:
+        data['callback_query']['message']['date'] -= age
+    update = Update.de_json(data, dispatcher.bot)
+    dispatcher.update_queue.put(update)
+    return update
+
+
+def dispatch(dispatcher):
+    while not dispatcher.update_queue.empty():
+        dispatcher.process_update(dispatcher.update_queue.get())
+
+
+def test_press_on_an_old_keyboard_is_answered(dispatcher):
+    gate = admission.install(dispatcher, max_age=60, collapse=0, expired_text='Expired')
+    stale = receive(dispatcher, callback(7, 'next'), age=120)
+    fresh = receive(dispatcher, callback(7, 'next'))
+    dispatch(dispatcher)
+    assert dispatcher.processed == [fresh.update_id]
+    assert gate.shed == {admission.STALE: 1, admission.COLLAPSED: 0}
+    assert dispatcher.bot.answers == [{'callback_query_id': stale.callback_query.id, 'text': 'Expired',
+                                       'show_alert': True}]
+
+
+def test_press_that_waited_in_the_queue_is_stale(dispatcher, monkeypatch):
+    gate = admission.install(dispatcher, max_age=60, collapse=0)
+    waited = receive(dispatcher, callback(7, 'next'))
+    later = time.monotonic() + 120
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: later)
+    dispatch(dispatcher)
+    assert dispatcher.processed == []
+    assert gate.shed[admission.STALE] == 1
+    assert dispatcher.bot.answers == [{'callback_query_id': waited.callback_query.id}]
+
+
+def test_repeated_press_is_collapsed(dispatcher):
+    gate = admission.install(dispatcher, max_age=60, collapse=5)
+    first = receive(dispatcher, callback(7, 'next'))
+    receive(dispatcher, callback(7, 'next'))
+    other = receive(dispatcher, callback(7, 'previous'))
+    text = receive(dispatcher, message(7, 'hello'))
+    dispatch(dispatcher)
+    assert dispatcher.processed == [first.update_id, other.update_id, text.update_id]
+    assert gate.shed == {admission.STALE: 0, admission.COLLAPSED: 1}
+    # the spinner stops without an alert
+    assert len(dispatcher.bot.answers) == 1 and 'text' not in dispatcher.bot.answers[0]
+
+
+def test_updates_never_admitted_are_forgotten(dispatcher, monkeypatch):
+    gate = admission.install(dispatcher, max_age=60)
+    for update_id in range(1000):
+        gate.received(Update(update_id))
+    later = time.monotonic() + admission.FORGET_AFTER
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: later)
+    gate.received(Update(1000))
+    assert list(gate._received) == [1000]
@@ -0,0 +1,141 @@
+from queue import Queue
+from types import SimpleNamespace
+import pytest
+from telegram import Update
+from telegram.error import BadRequest, NetworkError
+from telegram.ext import Dispatcher
+import bot
+import logbook
+import settings
+from bench.stub_api import StubApi
+from bench.updates import FakeBot, callback, message
+
+
+class Message:
+    def __init__(self):
+        self.groups = []
+        self.texts = []
+
+    def reply_media_group(self, group):
+        self.groups.append([media.media for media in group])
+        return [SimpleNamespace(photo=photo) for photo in group]
+
+    def reply_text(self, text, reply_markup=None):
+        self.texts.append(text)
+
+
+def test_album_is_sent_in_media_groups():
+    message = Message()
+    photos = [f'photo-{number}' for number in range(bot.MEDIA_GROUP_SIZE + 2)]
+
+    sent = bot.send_media(SimpleNamespace(message=message), bot.TYPE_ALBUM, photos, 'Carpathians', None)
+
+    assert message.groups == [photos[:bot.MEDIA_GROUP_SIZE], photos[bot.MEDIA_GROUP_SIZE:]]
+    assert len(sent) == len(photos)
+    assert message.texts == ['Carpathians']
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    api = StubApi(topics=5, stories=2).start()
+    monkeypatch.setattr(settings, 'API_HOST', api.url)
+    logbook.cache.clear()
+    yield api
+    logbook.cache.clear()
+    api.shutdown()
+    api.server_close()
+
+
+def test_exit_from_the_topic_conversation(stub_api):
+    dispatcher = Dispatcher(FakeBot(), Queue())
+    main_conv = bot.conversation()
+    topic_conv = main_conv.states[bot.SELECT_TOPIC][0]
+    dispatcher.add_handler(main_conv)
+    user_id = 815700001
+    topic = stub_api.random_topic()
+
+    def send(data):
+        dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+        return main_conv.conversations.get((user_id, user_id)), topic_conv.conversations.get((user_id, user_id))
+
+    assert send(message(user_id, f'/{bot.COMMAND_START}')) == (bot.REGISTER, None)
+    assert send(message(user_id, settings.REGISTRATION_CODE)) == (bot.SELECT_TOPIC, None)
+    assert send(callback(user_id, str(topic['id']))) == (bot.SELECT_TOPIC, bot.SELECT_STORY_TYPE)
+    assert send(message(user_id, f'/{bot.COMMAND_EXIT}')) == (bot.STOPPING, None)
+    # the nested conversation ended, the next topic is opened again
+    assert send(message(user_id, f'/{bot.COMMAND_START}')) == (bot.SELECT_TOPIC, None)
+    assert send(callback(user_id, str(topic['id']))) == (bot.SELECT_TOPIC, bot.SELECT_STORY_TYPE)
+    assert send(message(user_id, f'/{bot.COMMAND_EXIT}')) == (bot.STOPPING, None)
+    assert send(message(user_id, f'/{bot.COMMAND_EXIT}')) == (None, None)
+
+
+class FileIds:
+    def __init__(self, stored):
+        self.stored = stored
+
+    def get(self, story_id):
+        return self.stored.get(story_id)
+
+    def put(self, story_id, file_ids):
+        self.stored[story_id] = file_ids
+
+    def forget(self, story_id):
+        self.stored.pop(story_id, None)
+
+
+def test_album_falls_back_to_urls_only_for_groups_not_sent():
+    urls = [f'https://logbook.test/photo-{number}.jpg' for number in range(bot.MEDIA_GROUP_SIZE + 2)]
+    file_ids = [f'id-{number}' for number in range(len(urls))]
+    message = Message()
+
+    def reply_media_group(group):
+        # the second group's file_ids are refused, as after a change of the bot token
+        if group[0].media == file_ids[bot.MEDIA_GROUP_SIZE]:
+            raise BadRequest('Wrong file identifier/http url specified')
+        message.groups.append([media.media for media in group])
+        return [SimpleNamespace(photo=[SimpleNamespace(file_id=f'new-{media.media}')]) for media in group]
+
+    message.reply_media_group = reply_media_group
+    store = FileIds({9: file_ids})
+    story = {'id': 9, 'type': bot.TYPE_ALBUM}
+
+    assert bot.reply_media(SimpleNamespace(message=message), SimpleNamespace(bot_data={'file_ids': store}), story,
+                           urls, 'Carpathians', None)
+    assert message.groups == [file_ids[:bot.MEDIA_GROUP_SIZE], urls[bot.MEDIA_GROUP_SIZE:]]
+    assert store.stored[9] == [f'new-{media}' for media in file_ids[:bot.MEDIA_GROUP_SIZE] +
+                               urls[bot.MEDIA_GROUP_SIZE:]]
+
+
+def test_album_whose_files_fail_is_answered(monkeypatch):
+    def get_file():
+        raise NetworkError('Connection reset by peer')
+
+    photo = SimpleNamespace(file_id='photo-1', get_file=get_file)
+    album = {'chat_id': 42, 'user_id': 7, 'description': None,
+             'messages': [SimpleNamespace(message_id=1, photo=[photo])]}
+    sent = []
+    context = SimpleNamespace(
+        bot_data={'albums': {'group-1': album}},
+        job=SimpleNamespace(context='group-1'),
+        dispatcher=SimpleNamespace(user_data={7: {'topic_id': 3, 'user': {'id': 5}}}),
+        bot=SimpleNamespace(send_message=lambda **kwargs: sent.append(kwargs))
+    )
+    monkeypatch.setattr(bot, 'topic_info', lambda user_data, flash=None: (flash, None))
+    monkeypatch.setattr(bot, 'save_story', lambda *args, **kwargs: pytest.fail('album saved without its photos'))
+
+    bot.create_album(context)
+    assert sent == [{'chat_id': 42, 'text': bot.trans.gettext('could-not-create-story'), 'reply_markup': None}]
+    assert context.bot_data['albums'] == {}
+
+
+def test_profile_is_sent_when_it_cant_be_written(monkeypatch, tmp_path):
+    # a file where the directory should be, as unwritable as a missing /srv
+    (tmp_path / 'profiles').write_text('')
+    monkeypatch.setattr(settings, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    monkeypatch.setattr(bot.profiler, 'sample', lambda seconds, top: 'Profile of process 1\n')
+    documents = []
+
+    bot.run_profile(SimpleNamespace(send_document=lambda **kwargs: documents.append(kwargs)), 42, 1)
+    assert len(documents) == 1
+    assert documents[0]['document'] == b'Profile of process 1\n'
+    assert documents[0]['filename'].startswith('profile-')
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from telegram import Update
+import cluster
+import logbook
+import settings
+
+
+def test_worker_keeps_its_own_http_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(logbook, 'http_cache', None)
+    logbook.open_http_cache(cluster.worker_path(str(tmp_path / 'http_cache.sqlite'), 2))
+    logbook.http_cache.store('http://api/topics/1', {'ETag': '"1"'}, b'{"id": 1}')
+    logbook.http_cache.close()
+    assert os.path.exists(tmp_path / 'http_cache-2.sqlite')
+    assert not os.path.exists(tmp_path / 'http_cache.sqlite')
+
+
+def test_stop_drops_updates_of_a_worker_that_is_down(monkeypatch):
+    monkeypatch.setattr(cluster, 'RETRY_INTERVAL', 0.05)
+    forwarder = cluster.Forwarder(['http://127.0.0.1:9/webhook'])
+    for update_id in range(3):
+        forwarder.put(Update(update_id))
+    started = time.monotonic()
+    forwarder.stop(timeout=0.3)
+    assert time.monotonic() - started < 5
+    assert forwarder.pending() == 0
+
+
+def test_stop_forwards_what_is_queued(api_server):
+    forwarder = cluster.Forwarder([api_server.url])
+    for update_id in range(3):
+        forwarder.put(Update(update_id))
+    forwarder.stop(timeout=5)
+    assert forwarder.pending() == 0
+    assert api_server.posted == 3
+
+
+def test_queue_of_a_worker_that_is_down_is_bounded(monkeypatch):
+    monkeypatch.setattr(cluster, 'RETRY_INTERVAL', 0.05)
+    forwarder = cluster.Forwarder(['http://127.0.0.1:9/webhook'], max_pending=2)
+    for update_id in range(10):
+        forwarder.put(Update(update_id))
+    assert forwarder.pending() <= 2
+    forwarder.stop(timeout=0.1)
+
+
+class PollingBot:
+    def __init__(self, stopped):
+        self.stopped = stopped
+        self.offsets = []
+
+    def delete_webhook(self):
+        pass
+
+    def get_updates(self, offset=None, timeout=None):
+        self.offsets.append(offset)
+        if offset is None:
+            return [Update(5), Update(6)]
+        self.stopped.set()
+        return []
+
+
+def test_poll_acknowledges_the_last_batch_on_stop():
+    stopped = threading.Event()
+    bot = PollingBot(stopped)
+    forwarded = []
+    forwarder = type('Forwarder', (), {'put': lambda self, update: forwarded.append(update.update_id)})()
+    cluster.poll(bot, forwarder, stopped)
+    assert forwarded == [5, 6]
+    assert bot.offsets[-1] == 7 and len(bot.offsets) == 3
+
+
+class Process:
+    def __init__(self, returncode=None):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+
+def test_exited_worker_is_started_again(monkeypatch):
+    monkeypatch.setattr(cluster, 'RESTART_INTERVAL', 0.01)
+    started = []
+    stopped = threading.Event()
+
+    def start_worker(worker):
+        started.append(worker)
+        stopped.set()
+        return Process()
+
+    monkeypatch.setattr(cluster, 'start_worker', start_worker)
+    processes = [Process(), Process(returncode=1)]
+    cluster.supervise(processes, stopped)
+    assert started == [1]
+    assert processes[1].returncode is None
+
+
+def test_worker_starts_from_the_project_directory(monkeypatch):
+    commands = []
+    monkeypatch.setattr(cluster.subprocess, 'Popen', lambda args, cwd=None: commands.append((args, cwd)))
+    cluster.start_worker(3)
+    assert commands == [([cluster.sys.executable, os.path.join(settings.BASE_DIR, 'bot.py'), '--worker', '3'],
+                         settings.BASE_DIR)]
@@ -0,0 +1,151 @@
+import io
+import json
+import pytest
+import importer
+import logbook
+from importer import Import, validate
+
+
+@pytest.fixture
+def created(monkeypatch):
+    stories = []
+
+    def create_story(story, idempotency_key=None):
+        stories.append((idempotency_key, story))
+        return {'status': True, 'data': {'id': len(stories), **story}}
+
+    monkeypatch.setattr(logbook, 'create_story', create_story)
+    return stories
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_valid_row():
+    story = validate({'topic': '3', 'type': 'album', 'content': ['a.jpg', 'b.jpg'], 'description': 'Hike'}, user=7)
+    assert story == {'type': importer.TYPES['album'], 'description': 'Hike', 'topic': 3, 'user': 7,
+                     'content': '["a.jpg", "b.jpg"]'}
+
+
+@pytest.mark.parametrize('row', [
+    {'topic': [1], 'content': 'x'},
+    {'topic': {'id': 1}, 'content': 'x'},
+    {'topic': 1, 'type': ['text'], 'content': 'x'},
+    {'topic': 1, 'user': [7], 'content': 'x'},
+    {'topic': 1, 'description': {'text': 'x'}, 'content': 'x'},
+    {'topic': 'one', 'content': 'x'},
+    {'topic': 1},
+    ['topic', 1],
+])
+def test_invalid_rows_are_rejected(row):
+    with pytest.raises(ValueError):
+        validate(row, user=7)
+
+
+def test_bad_jsonl_line_fails_only_that_row(tmp_path, created):
+    lines = [json.dumps({'topic': 1, 'content': 'first'}), '{"topic": 1, "content": ', '',
+             json.dumps({'topic': [1], 'content': 'nested'}), json.dumps({'topic': 2, 'content': 'last'})]
+    path = write(tmp_path, 'stories.jsonl', '\n'.join(lines) + '\n')
+
+    report = Import(path, user=7, batch_size=2, workers=1).run()
+
+    assert [story['content'] for key, story in created] == ['first', 'last']
+    assert report['rows'] == 4
+    assert report['created'] == 2
+    assert report['failed'] == 2
+    assert report['failures'][0][0] == 2
+    assert report['failures'][0][1].startswith('line 2: invalid JSON')
+    assert report['failures'][1][0] == 3
+
+
+def test_truncated_document_keeps_progress_of_rows_read(tmp_path, created):
+    rows = [{'topic': 1, 'content': f'story {row}'} for row in range(3)]
+    path = write(tmp_path, 'stories.json', json.dumps(rows)[:-1] + ', {"topic": ')
+
+    report = Import(path, user=7, batch_size=10, workers=1).run()
+    assert len(created) == 3
+    assert report['failures'][0][0] == 4
+    assert report['failures'][0][1].startswith('item 4: invalid JSON')
+    with open(path + '.progress') as file:
+        assert json.load(file)['row'] == 4
+
+    # importing it again resumes after the rows already created
+    created.clear()
+    Import(path, user=7, batch_size=10, workers=1).run()
+    assert created == []
+
+
+def test_malformed_item_stops_the_import_without_reading_on(tmp_path, created, monkeypatch):
+    monkeypatch.setattr(importer, 'CHUNK_SIZE', 64)
+    rows = [json.dumps({'topic': 1, 'content': f'story {row}'}) for row in range(200)]
+    rows[2] = '{"topic": 1, "content": "broken" "story"}'
+    path = write(tmp_path, 'stories.json', '[' + ', '.join(rows) + ']')
+    reads = []
+
+    class Reader:
+        def __init__(self, file):
+            self.file = file
+
+        def read(self, size):
+            reads.append(size)
+            return self.file.read(size)
+
+    with open(path) as file:
+        items = list(importer.read_json_array(Reader(file)))
+    assert len(items) == 3
+    assert items[2].error.startswith('item 3: invalid JSON')
+    assert len(reads) < 10
+
+    report = Import(path, user=7, batch_size=10, workers=1).run()
+    assert report['rows'] == 3
+    assert report['created'] == 2
+    assert report['failures'][0][0] == 3
+
+
+def test_long_item_is_read_across_chunks(monkeypatch):
+    monkeypatch.setattr(importer, 'CHUNK_SIZE', 16)
+    rows = [{'topic': 1, 'content': 'x' * 100, 'description': 'true story'}, {'topic': 2, 'content': [1, 2]}]
+    assert list(importer.read_json_array(io.StringIO(json.dumps(rows)))) == rows
+
+
+def test_rows_the_api_failed_are_sent_again_on_resume(tmp_path, monkeypatch):
+    results = {'story 1': {'status': False, 'error': '503 Server Error'},
+               'story 2': {'status': False, 'error': '400 Client Error', 'rejected': True}}
+    sent = []
+
+    def create_story(story, idempotency_key=None):
+        sent.append(story['content'])
+        return results.get(story['content'], {'status': True, 'data': story})
+
+    monkeypatch.setattr(logbook, 'create_story', create_story)
+    rows = [{'topic': 1, 'content': f'story {row}'} for row in range(4)]
+    path = write(tmp_path, 'stories.json', json.dumps(rows))
+
+    report = Import(path, user=7, batch_size=2, workers=1).run()
+    assert report['created'] == 2 and report['failed'] == 2
+
+    # the API is back, the refused row stays failed
+    results.pop('story 1')
+    sent.clear()
+    report = Import(path, user=7, batch_size=2, workers=1).run()
+    assert sent == ['story 1']
+    assert report['created'] == 3
+    assert report['failed'] == 1
+    assert report['failures'] == [[3, '400 Client Error']]
+
+
+def test_import_resumes_after_saved_row(tmp_path, created):
+    rows = [{'topic': 1, 'content': f'story {row}'} for row in range(5)]
+    path = write(tmp_path, 'stories.json', json.dumps(rows))
+    with open(path + '.progress', 'w') as file:
+        json.dump({'digest': Import(path)._digest(), 'row': 3, 'created': 3, 'failed': 0, 'failures': []}, file)
+
+    report = Import(path, user=7, batch_size=2, workers=1).run()
+
+    assert [story['content'] for key, story in created] == ['story 3', 'story 4']
+    assert report['resumed'] == 3
+    assert report['created'] == 5
+    assert created[0][0].endswith('-4')
@@ -0,0 +1,46 @@
+import threading
+import pytest
+import logbook
+from journal import Journal
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.sqlite'), batch_size=3, max_attempts=5, backoff=60, workers=3)
+    journal.created, journal.failed = [], []
+    journal.on_created = lambda chat_id, id, story: journal.created.append(id)
+    journal.on_failed = lambda chat_id, id, error: journal.failed.append(id)
+    yield journal
+    journal.stop()
+
+
+def pending(journal):
+    return journal._db.execute('SELECT id, attempts FROM stories ORDER BY id').fetchall()
+
+
+def test_batch_is_sent_concurrently(journal, monkeypatch):
+    # every create waits for the other two, sent one at a time they would time out
+    together = threading.Barrier(3, timeout=5)
+
+    def create_story(story, idempotency_key=None):
+        together.wait()
+        return {'status': True, 'data': dict(story, id=story['n'])}
+
+    monkeypatch.setattr(logbook, 'create_story', create_story)
+    ids = [journal.put({'n': n}, chat_id=1) for n in range(3)]
+    assert journal.flush() == 3
+    assert sorted(journal.created) == ids
+    assert pending(journal) == []
+
+
+def test_refused_story_fails_at_once(journal, monkeypatch):
+    results = {
+        'bad': {'status': False, 'error': 'HTTP error occurred: 400 Client Error', 'rejected': True},
+        'down': {'status': False, 'error': 'HTTP error occurred: 503 Server Error'}
+    }
+    monkeypatch.setattr(logbook, 'create_story', lambda story, idempotency_key=None: results[story['n']])
+    bad = journal.put({'n': 'bad'}, chat_id=1)
+    down = journal.put({'n': 'down'}, chat_id=1)
+    assert journal.flush() == 0
+    assert journal.failed == [bad]
+    assert pending(journal) == [(down, 1)]
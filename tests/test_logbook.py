@@ -0,0 +1,226 @@
+import sqlite3
+import threading
+import time
+import pytest
+import logbook
+import metrics
+import settings
+from resilience import deadline
+from bench.stub_api import StubApi
+
+
+class LockedCache:
+    """
+    HTTP cache whose database another process holds locked
+    """
+
+    def __getattr__(self, name):
+        def locked(*args):
+            raise sqlite3.OperationalError('database is locked')
+
+        locked.__name__ = name
+        return locked
+
+
+@pytest.fixture
+def client(request, monkeypatch):
+    monkeypatch.setattr(settings, 'API_CLIENT', request.param)
+    logbook._endpoints.clear()
+    yield request.param
+    logbook._endpoints.clear()
+
+
+@pytest.mark.parametrize('client', ['requests', 'aiohttp'], indirect=True)
+def test_failing_http_cache_is_no_cache(client, api_server, monkeypatch):
+    monkeypatch.setattr(logbook, 'http_cache', LockedCache())
+    api_server.body = [{'id': 1, 'title': 'Carpathians'}]
+
+    assert logbook.request(logbook.GET, f'{api_server.url}/topics/') == {'status': True, 'data': api_server.body}
+    assert logbook.api(logbook.POST, f'{api_server.url}/topics/', data=b'{}') == {'status': True, 'data': None}
+
+
+
+@pytest.mark.parametrize('client', ['requests', 'aiohttp'], indirect=True)
+def test_refused_request_is_marked_rejected(client, api_server):
+    api_server.status = 400
+    result = logbook.api(logbook.POST, f'{api_server.url}/stories/', data=b'{}')
+    assert result['status'] is False and result['rejected']
+    api_server.status = 503
+    assert 'rejected' not in logbook.api(logbook.POST, f'{api_server.url}/stories/', data=b'{}')
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    api = StubApi(topics=45, stories=0).start()
+    monkeypatch.setattr(settings, 'API_HOST', api.url)
+    monkeypatch.setattr(settings, 'PAGE_SIZE', 20)
+    logbook.cache.clear()
+    yield api
+    logbook.cache.clear()
+    api.shutdown()
+    api.server_close()
+
+
+def test_topic_pages_are_fetched_as_they_are_consumed(stub_api):
+    pages = logbook.iter_topic_pages()
+    first = next(pages)
+    assert stub_api.requests['GET /topics'] == 1
+    assert len(first['data']['results']) == 20
+    assert [len(page['data']['results']) for page in pages] == [20, 5]
+
+
+def test_sync_topic_index_reads_every_page(stub_api):
+    result = logbook.sync_topic_index(full=True)
+    assert result['status']
+    assert sorted(topic.id for topic in result['data']) == sorted(stub_api.topics)
+    assert logbook.topic_index.is_fresh()
+
+
+def test_sync_topic_index_keeps_the_index_when_a_page_fails(stub_api, monkeypatch):
+    pages = logbook.iter_topic_pages
+    monkeypatch.setattr(logbook, 'iter_topic_pages', lambda search=None: (
+        page if number < 1 else {'status': False, 'error': 'HTTP error occurred: 503'}
+        for number, page in enumerate(pages(search))))
+    synced = []
+    monkeypatch.setattr(logbook.topic_index, 'sync', synced.append)
+
+    assert logbook.sync_topic_index(full=True) == {'status': False, 'error': 'HTTP error occurred: 503'}
+    assert synced == []
+
+
+def test_sync_topic_index_reads_only_new_topics_in_between(stub_api, monkeypatch):
+    logbook.sync_topic_index(full=True)
+    logbook.cache.clear()
+    removed = stub_api.random_topic()
+    with stub_api.lock:
+        del stub_api.topics[removed['id']]
+    added = stub_api.add('topics', {'title': 'Carpathians trail'})
+    pages = logbook.iter_topic_pages
+    read = []
+    monkeypatch.setattr(logbook, 'iter_topic_pages', lambda search=None: (
+        read.append(page) or page for page in pages(search)))
+
+    result = logbook.sync_topic_index()
+    assert [topic['id'] for topic in result['data']] == [added['id']]
+    assert len(read) == 1
+    assert [topic['id'] for topic in logbook.topic_index.search('carpathians')] == [added['id']]
+    assert removed['id'] in [topic['id'] for topic in logbook.topic_index.search(removed['title'])]
+
+    logbook.sync_topic_index(full=True)
+    assert removed['id'] not in [topic['id'] for topic in logbook.topic_index.search(removed['title'])]
+
+
+def in_flight(api, endpoint, count=1):
+    # the request reached the API, the handler is still sleeping its latency
+    while api.requests[endpoint] < count:
+        time.sleep(0.01)
+
+
+def test_identical_reads_share_one_request(stub_api, monkeypatch):
+    monkeypatch.setattr(metrics, '_counters', {})
+    stub_api.latency = 0.3
+    url = f"{settings.API_HOST}/topics/{stub_api.random_topic()['id']}/?format=json"
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(logbook.api(logbook.GET, url))) for i in range(5)]
+    readers[0].start()
+    in_flight(stub_api, 'GET /topics/{id}')
+    for reader in readers[1:]:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    assert stub_api.requests['GET /topics/{id}'] == 1
+    assert all(result == results[0] for result in results)
+    # every caller owns its copy
+    assert len({id(result) for result in results}) == 5
+    results[0]['status'] = False
+    assert results[1]['status']
+    assert sum(count for (metric, labels), count in metrics.counters() if metric == metrics.COALESCED_METRIC) == 4
+
+
+def test_write_detaches_reads_in_flight(stub_api):
+    stub_api.latency = 0.5
+    url = f"{settings.API_HOST}/topics/{stub_api.random_topic()['id']}/?format=json"
+    leader = threading.Thread(target=logbook.api, args=(logbook.GET, url))
+    leader.start()
+    in_flight(stub_api, 'GET /topics/{id}')
+    stub_api.latency = 0
+    logbook.api(logbook.POST, f'{settings.API_HOST}/topics/', data=b'{"title": "Carpathians"}')
+    # the read started before the write is not joined, a new one is sent
+    assert logbook.api(logbook.GET, url)['status']
+    assert stub_api.requests['GET /topics/{id}'] == 2
+    assert leader.is_alive()
+    leader.join()
+
+
+def test_follower_with_time_left_reads_again(stub_api):
+    stub_api.latency = 0.5
+    url = f"{settings.API_HOST}/topics/{stub_api.random_topic()['id']}/?format=json"
+    results = {}
+
+    def lead():
+        with deadline(0.2):
+            results['leader'] = logbook.api(logbook.GET, url)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    in_flight(stub_api, 'GET /topics/{id}')
+    results['follower'] = logbook.api(logbook.GET, url)
+    leader.join()
+
+    assert results['leader'] == {'status': False, 'error': 'API deadline exceeded'}
+    assert results['follower']['status']
+    assert stub_api.requests['GET /topics/{id}'] == 2
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(settings, 'API_HEDGE', True)
+    monkeypatch.setattr(metrics, '_counters', {})
+    logbook._endpoints.clear()
+    url = 'http://api/topics/1/?format=json'
+    latencies = logbook.endpoint_state(metrics.endpoint(url))[1]
+    for i in range(latencies.min_samples):
+        latencies.add(0.05)
+    sent = []
+
+    def request(method, url, data=None, headers=None):
+        # answers in the order the requests are sent, each after its delay
+        delay, result = answers[len(sent)]
+        sent.append(threading.current_thread())
+        time.sleep(delay)
+        return result
+
+    answers = []
+    monkeypatch.setattr(logbook, 'request', request)
+    yield url, answers, sent
+    logbook._endpoints.clear()
+
+
+def hedged():
+    return sum(count for (metric, labels), count in metrics.counters() if metric == metrics.HEDGED_METRIC)
+
+
+def test_fast_read_is_not_hedged(hedging):
+    url, answers, sent = hedging
+    answers.append((0, {'status': True, 'data': 1}))
+    assert logbook.hedged_get(url) == {'status': True, 'data': 1}
+    time.sleep(0.1)
+    assert sent == [threading.current_thread()]
+    assert hedged() == 0
+
+
+def test_slow_read_is_hedged_from_its_own_thread(hedging):
+    url, answers, sent = hedging
+    answers.extend([(0.3, {'status': True, 'data': 1}), (0, {'status': True, 'data': 2})])
+    assert logbook.hedged_get(url) == {'status': True, 'data': 1}
+    assert sent[0] is threading.current_thread()
+    assert sent[1].name.startswith('hedge')
+    assert hedged() == 1
+
+
+def test_hedge_answers_when_the_first_fails(hedging):
+    url, answers, sent = hedging
+    answers.extend([(0.3, {'status': False, 'error': 'API error occurred: timed out'}),
+                    (0, {'status': True, 'data': 2})])
+    assert logbook.hedged_get(url) == {'status': True, 'data': 2}
+    assert hedged() == 1
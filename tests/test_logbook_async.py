@@ -0,0 +1,151 @@
+import asyncio
+import inspect
+import threading
+import pytest
+import logbook
+import logbook_async
+import metrics
+import settings
+from resilience import deadline
+from bench.stub_api import StubApi
+
+
+# functions of the sync client handlers call, the async client has each of them as a coroutine
+SURFACE = ('get_telegram_user', 'get_topics_page', 'get_stories_page', 'lookup_topic', 'get_topic_stories',
+           'lookup_story', 'create_user', 'remove_story', 'remove_topic', 'update_story', 'create_topic',
+           'create_story', 'upload_story', 'sync_topic_index', 'get_topic_stories_count', 'cached_get', 'api')
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    api = StubApi(topics=45, stories=30).start()
+    monkeypatch.setattr(settings, 'API_HOST', api.url)
+    monkeypatch.setattr(settings, 'PAGE_SIZE', 20)
+    logbook.cache.clear()
+    yield api
+    logbook.cache.clear()
+    api.shutdown()
+    api.server_close()
+
+
+@pytest.mark.parametrize('name', SURFACE)
+def test_async_client_has_the_sync_surface(name):
+    assert callable(getattr(logbook, name))
+    assert inspect.iscoroutinefunction(getattr(logbook_async, name))
+
+
+def test_async_iter_topic_pages():
+    assert inspect.isasyncgenfunction(logbook_async.iter_topic_pages)
+
+
+def test_pages(stub_api):
+    page = logbook_async.run(logbook_async.get_topics_page())
+    assert page['status'] and len(page['data']['results']) == 20
+    second = logbook_async.run(logbook_async.get_topics_page(page['data']['next']))
+    assert second['data']['previous']
+
+    topic = stub_api.random_topic()
+    stories = logbook_async.run(logbook_async.get_stories_page(topic['id']))
+    assert {story.topic for story in stories['data']['results']} == {topic['id']}
+
+
+def test_sync_topic_index(stub_api):
+    result = logbook_async.run(logbook_async.sync_topic_index(full=True))
+    assert sorted(topic.id for topic in result['data']) == sorted(stub_api.topics)
+    assert logbook.topic_index.is_fresh()
+
+
+@pytest.mark.parametrize('body', [b'{}', (chunk for chunk in [b'{', b'}'])], ids=['bytes', 'generator'])
+def test_upload_story(stub_api, body):
+    story = {'topic': stub_api.random_topic()['id']}
+    result = logbook_async.run(logbook_async.upload_story(story, body, 'application/json'))
+    assert result['status']
+
+
+class RecordingCache:
+    """
+    HTTP cache that remembers the threads it was used from
+    """
+
+    def __init__(self):
+        self.threads = set()
+
+    def get(self, url):
+        self.threads.add(threading.current_thread().name)
+        return None
+
+    def store(self, url, headers, body):
+        self.threads.add(threading.current_thread().name)
+
+    def expire(self):
+        self.threads.add(threading.current_thread().name)
+
+
+def test_http_cache_is_used_off_the_event_loop(stub_api, monkeypatch):
+    cache = RecordingCache()
+    monkeypatch.setattr(logbook, 'http_cache', cache)
+    url = f'{stub_api.url}/topics?format=json'
+
+    assert logbook_async.run(logbook_async.request(logbook.GET, url))['status']
+    assert logbook_async.run(logbook_async.api(logbook.POST, f'{stub_api.url}/topics/', b'{"title": "x"}'))
+    assert cache.threads and 'logbook-api' not in cache.threads
+
+
+def test_sync_topic_index_reads_only_new_topics_in_between(stub_api):
+    logbook_async.run(logbook_async.sync_topic_index(full=True))
+    logbook.cache.clear()
+    added = stub_api.add('topics', {'title': 'Carpathians trail'})
+    result = logbook_async.run(logbook_async.sync_topic_index())
+    assert [topic['id'] for topic in result['data']] == [added['id']]
+
+
+def test_identical_reads_share_one_request(stub_api, monkeypatch):
+    monkeypatch.setattr(metrics, '_counters', {})
+    stub_api.latency = 0.2
+    url = f"{stub_api.url}/topics/{stub_api.random_topic()['id']}/?format=json"
+
+    async def read():
+        return await asyncio.gather(*(logbook_async.api(logbook.GET, url) for i in range(5)))
+
+    results = logbook_async.run(read())
+    assert stub_api.requests['GET /topics/{id}'] == 1
+    assert all(result == results[0] for result in results)
+    assert len({id(result) for result in results}) == 5
+    assert sum(count for (metric, labels), count in metrics.counters() if metric == metrics.COALESCED_METRIC) == 4
+
+
+def test_write_detaches_reads_in_flight(stub_api):
+    stub_api.latency = 0.5
+    url = f"{stub_api.url}/topics/{stub_api.random_topic()['id']}/?format=json"
+
+    async def read_around_a_write():
+        leader = asyncio.ensure_future(logbook_async.api(logbook.GET, url))
+        await asyncio.sleep(0.1)
+        stub_api.latency = 0
+        await logbook_async.api(logbook.POST, f'{stub_api.url}/topics/', b'{"title": "Carpathians"}')
+        # the read started before the write is not joined, a new one is sent
+        assert (await logbook_async.api(logbook.GET, url))['status']
+        assert not leader.done()
+        await leader
+
+    logbook_async.run(read_around_a_write())
+    assert stub_api.requests['GET /topics/{id}'] == 2
+
+
+def test_follower_with_time_left_reads_again(stub_api):
+    stub_api.latency = 0.4
+    url = f"{stub_api.url}/topics/{stub_api.random_topic()['id']}/?format=json"
+
+    async def lead():
+        with deadline(0.2):
+            return await logbook_async.api(logbook.GET, url)
+
+    async def read():
+        leader = asyncio.ensure_future(lead())
+        await asyncio.sleep(0.05)
+        return await asyncio.gather(leader, logbook_async.api(logbook.GET, url))
+
+    leader, follower = logbook_async.run(read())
+    assert leader == {'status': False, 'error': 'API deadline exceeded'}
+    assert follower['status']
+    assert stub_api.requests['GET /topics/{id}'] == 2
@@ -0,0 +1,84 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import logbook
+import media
+import metrics
+import settings
+from bench.stub_api import StubApi
+
+TOKEN = '123:secret'
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'x' * self.server.size
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # a broken download stops half way and drops the connection
+        self.wfile.write(body[:len(body) // 2] if self.server.broken else body)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def telegram():
+    """
+    Local stand-in of the telegram file server
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.daemon_threads = True
+    server.size = 300 * 1024
+    server.broken = False
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/file/bot{TOKEN}/photos/file_1.jpg'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    api = StubApi(topics=1, stories=0).start()
+    monkeypatch.setattr(settings, 'API_HOST', api.url)
+    monkeypatch.setattr(settings, 'API_CLIENT', 'requests')
+    monkeypatch.setattr(settings, 'API_BREAKER_FAILURES', 1)
+    logbook._endpoints.clear()
+    yield api
+    logbook._endpoints.clear()
+    api.shutdown()
+    api.server_close()
+
+
+def story(api):
+    return {'type': 2, 'description': 'Carpathians', 'topic': api.random_topic()['id'], 'user': None,
+            'content': None}
+
+
+def test_file_is_streamed_into_the_upload(telegram, stub_api):
+    transfers = media.stats()['transfers']
+    result = media.upload_story(story(stub_api), telegram.url)
+    assert result['status']
+    # the multipart body holds the whole file
+    assert int(result['data']['content'].split()[0]) > telegram.size
+    assert media.stats()['transfers'] == transfers + 1
+
+
+def test_broken_download_is_not_an_api_failure(telegram, stub_api, caplog):
+    telegram.broken = True
+    caplog.set_level(logging.DEBUG, logger='media')
+    result = media.upload_story(story(stub_api), telegram.url)
+    assert not result['status']
+    assert result['error'].startswith('Media download error occurred')
+    breaker = logbook.endpoint_state(metrics.endpoint(f'{stub_api.url}/stories/?format=json'))[0]
+    assert breaker.state == breaker.CLOSED
+    assert TOKEN not in result['error'] and TOKEN not in caplog.text
+
+
+def test_token_is_redacted():
+    assert media.redact(f'404 Client Error for url: https://api.telegram.org/file/bot{TOKEN}/videos/file_2.mp4') == \
+        '404 Client Error for url: https://api.telegram.org/file/bot<token>/videos/file_2.mp4'
@@ -0,0 +1,58 @@
+import pytest
+import logbook
+import media
+import metrics
+from cache import Cache
+from http_cache import HttpCache
+from test_logbook import LockedCache
+
+
+@pytest.fixture
+def gauges(monkeypatch):
+    monkeypatch.setattr(metrics, '_gauges', {})
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_histograms', {})
+
+
+def test_cache_counters_are_served(gauges, monkeypatch, tmp_path):
+    monkeypatch.setattr(logbook, 'cache', Cache(100, 1024 * 1024))
+    monkeypatch.setattr(logbook, 'http_cache', HttpCache(str(tmp_path / 'http_cache.sqlite'), 1024 * 1024))
+    logbook.register_metrics()
+    logbook.cache.set('topics', 1, {'id': 1}, 60, 100)
+    logbook.cache.get('topics', 1)
+    logbook.cache.get('topics', 1)
+    logbook.cache.get('users', 7)
+    logbook.http_cache.store('http://api/topics/1', {'ETag': '"1"'}, b'{"id": 1}')
+
+    served = metrics.exposition().splitlines()
+    assert '# TYPE logbook_cache_hits_total counter' in served
+    assert 'logbook_cache_hits_total{resource="topics"} 2' in served
+    assert 'logbook_cache_misses_total{resource="users"} 1' in served
+    assert 'logbook_cache_misses_total{resource="topics"} 0' in served
+    assert '# TYPE logbook_cache_entries gauge' in served
+    assert 'logbook_cache_entries{cache="memory"} 1' in served
+    assert 'logbook_cache_entries{cache="http"} 1' in served
+    assert 'logbook_cache_bytes{cache="memory"} 100' in served
+    assert served.count('# HELP logbook_cache_hits_total Reads answered by the memory cache') == 1
+    assert 'topics cache hits total: 2' in metrics.summary()
+    logbook.http_cache.close()
+
+
+def test_failing_http_cache_is_served_empty(gauges, monkeypatch):
+    monkeypatch.setattr(logbook, 'http_cache', LockedCache())
+    logbook.register_metrics()
+    assert 'logbook_cache_entries{cache="http"} 0' in metrics.exposition().splitlines()
+
+
+def test_media_counters_are_served(gauges, monkeypatch):
+    monkeypatch.setattr(media, '_stats', {'transfers': 3, 'active': 1, 'failed': 1, 'bytes': 2048, 'seconds': 1.5})
+    media.register_metrics()
+    served = metrics.exposition().splitlines()
+    assert '# TYPE logbook_media_transfers_total counter' in served
+    assert 'logbook_media_transfers_total 3' in served
+    assert 'logbook_media_failed_total 1' in served
+    assert '# TYPE logbook_media_active_transfers gauge' in served
+    assert 'logbook_media_active_transfers 1' in served
+    assert 'logbook_media_bytes_total 2048' in served
+    assert 'logbook_media_seconds_total 1.5' in served
+    assert 'media transfers total: 3' in metrics.summary()
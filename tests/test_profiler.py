@@ -0,0 +1,23 @@
+import logging
+import os
+import signal
+import threading
+import profiler
+
+
+def test_signal_profile_is_logged_when_it_cant_be_written(monkeypatch, tmp_path, caplog):
+    (tmp_path / 'profiles').write_text('')
+    monkeypatch.setattr(profiler, 'sample', lambda seconds, top: 'Profile of process 1\n')
+    previous = signal.getsignal(signal.SIGUSR2)
+    profiler.install_signal(1, str(tmp_path / 'profiles'), signum=signal.SIGUSR2)
+    try:
+        os.kill(os.getpid(), signal.SIGUSR2)
+    finally:
+        signal.signal(signal.SIGUSR2, previous)
+    for thread in threading.enumerate():
+        if thread.name == 'profile':
+            thread.join()
+    warnings = [record.getMessage() for record in caplog.records if record.levelno == logging.WARNING]
+    assert len(warnings) == 1
+    assert warnings[0].startswith(f"Profile not written to {tmp_path / 'profiles'}")
+    assert warnings[0].endswith('Profile of process 1\n')
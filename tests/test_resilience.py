@@ -0,0 +1,82 @@
+import time
+import pytest
+import logbook
+import metrics
+import resilience
+import settings
+from resilience import CircuitBreaker
+
+
+def wait_for(condition, timeout=2):
+    until = time.monotonic() + timeout
+    while not condition() and time.monotonic() < until:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_breaker_opens_after_failures_and_closes_after_a_good_trial():
+    breaker = CircuitBreaker(failures=2, reset_after=0.05)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # one trial at a time
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_released_trial_is_tried_again_after_reset():
+    breaker = CircuitBreaker(failures=1, reset_after=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_release_leaves_a_closed_breaker_closed():
+    breaker = CircuitBreaker()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.fixture
+def client(request, monkeypatch):
+    monkeypatch.setattr(settings, 'API_CLIENT', request.param)
+    monkeypatch.setattr(settings, 'API_HEDGE', False)
+    logbook._endpoints.clear()
+    yield request.param
+    logbook._endpoints.clear()
+
+
+@pytest.mark.parametrize('client', ['requests', 'aiohttp'], indirect=True)
+def test_trial_cut_short_by_the_deadline_does_not_stick(client, api_server):
+    url = f'{api_server.url}/topics/'
+    breaker = logbook.endpoint_state(metrics.endpoint(url))[0]
+    breaker.reset_after = 0.1
+    for _ in range(breaker.failures):
+        breaker.failure()
+    time.sleep(0.11)
+
+    api_server.delay = 0.5
+    with resilience.deadline(0.2):
+        result = logbook.request(logbook.GET, url)
+    assert not result['status']
+    # the aiohttp task is cancelled on the event loop, it settles shortly after
+    assert wait_for(lambda: breaker.state == CircuitBreaker.OPEN)
+
+    api_server.delay = 0
+    time.sleep(0.11)
+    assert logbook.request(logbook.GET, url) == {'status': True, 'data': []}
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,86 @@
+import time
+from search import TopicIndex, normalize, tokenize, trigrams
+
+TOPICS = [
+    {'id': 1, 'title': 'Café de Flore'},
+    {'id': 2, 'title': 'Carpathians in winter'},
+    {'id': 3, 'title': 'Carpathians'},
+    {'id': 4, 'title': 'Winter garden, Kyiv'},
+]
+
+
+def index(topics=TOPICS):
+    topic_index = TopicIndex(max_age=60)
+    topic_index.sync([dict(topic) for topic in topics])
+    return topic_index
+
+
+def ids(topics):
+    return [topic['id'] for topic in topics]
+
+
+def test_text_is_normalized_and_tokenized():
+    assert normalize('Café ÉTÉ') == 'cafe ete'
+    assert tokenize('Winter garden, Kyiv!') == ['winter', 'garden', 'kyiv']
+    assert trigrams('ab') == {'  a', ' ab', 'ab '}
+
+
+def test_every_word_has_to_match():
+    assert ids(index().search('winter carpathians')) == [2]
+    assert ids(index().search('winter kyiv')) == [4]
+    assert index().search('!!') == []
+
+
+def test_accents_and_case_are_ignored():
+    assert ids(index().search('CAFE')) == [1]
+    assert ids(index().search('flöre')) == [1]
+
+
+def test_prefixes_match_ranked_below_whole_words():
+    assert ids(index().search('carp')) == [3, 2]
+    assert ids(index().search('winter')) == [4, 2]
+    # a whole word beats a prefix, shorter titles come first among equals
+    assert ids(index().search('garden win')) == [4]
+
+
+def test_typos_fall_back_to_trigrams():
+    assert ids(index().search('carpathains')) == [3, 2]
+    assert index().search('zzzz') == []
+
+
+def test_limit():
+    assert ids(index().search('carpathians', limit=1)) == [3]
+
+
+def test_sync_reindexes_renames_and_removes_missing_topics():
+    topic_index = index()
+    topic_index.sync([{'id': 2, 'title': 'Tatras in winter'}, {'id': 4, 'title': 'Winter garden, Kyiv'}])
+    assert ids(topic_index.search('carpathians')) == []
+    assert ids(topic_index.search('tatras')) == [2]
+    assert topic_index.newest() == 4
+
+
+def test_incomplete_sync_only_adds():
+    topic_index = index()
+    full_synced_at = topic_index.full_synced_at
+    topic_index.sync([{'id': 5, 'title': 'Carpathian lakes'}], complete=False)
+    assert ids(topic_index.search('carpathian')) == [5, 3, 2]
+    assert topic_index.newest() == 5
+    assert topic_index.full_synced_at == full_synced_at
+
+
+def test_freshness():
+    topic_index = TopicIndex(max_age=0.1)
+    assert not topic_index.is_fresh() and topic_index.newest() is None
+    topic_index.sync(TOPICS)
+    assert topic_index.is_fresh()
+    time.sleep(0.15)
+    assert not topic_index.is_fresh()
+
+
+def test_removed_words_leave_the_vocabulary():
+    topic_index = index()
+    topic_index.remove(1)
+    topic_index.remove(1)
+    assert topic_index.search('caf') == []
+    assert 'cafe' not in topic_index._vocabulary
@@ -0,0 +1,71 @@
+from concurrent.futures import Future
+import pytest
+from telegram.error import NetworkError, TimedOut
+from sender import QueuedBot, Sender, sent
+
+
+class RecordingSender:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, chat_id, method, args, kwargs, priority=0, key=None):
+        self.submitted.append((chat_id, method.__name__, kwargs))
+        future = Future()
+        future.set_result(method.__name__)
+        return future
+
+
+@pytest.mark.parametrize('method, kwargs', [
+    ('send_message', {'text': 'Carpathians'}),
+    ('send_photo', {'photo': 'file-id'}),
+    ('send_video', {'video': 'file-id'}),
+    ('send_media_group', {'media': []}),
+    ('send_document', {'document': b'report', 'filename': 'profile.txt'}),
+])
+def test_sends_go_through_the_sender(method, kwargs):
+    sender = RecordingSender()
+    bot = QueuedBot('123:test', sender=sender)
+    assert sent(getattr(bot, method)(chat_id=42, **kwargs)) == method
+    assert sender.submitted == [(42, method, dict(kwargs, chat_id=42))]
+
+
+class Flaky:
+    """
+    Bot API call failing with errors before it succeeds
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'sent'
+
+
+@pytest.fixture
+def sender():
+    sender = Sender(rate=100, chat_rate=100, chat_burst=100, workers=1, max_retries=3)
+    yield sender
+    sender.stop(1)
+
+
+def test_connection_error_is_retried(sender):
+    call = Flaky(NetworkError('Connection reset by peer'))
+    assert sender.submit(1, call, (), {}).result(5) == 'sent'
+    assert call.calls == 2
+
+
+def test_timed_out_message_is_not_sent_again(sender):
+    call = Flaky(TimedOut())
+    with pytest.raises(TimedOut):
+        sender.submit(1, call, (), {}).result(5)
+    assert call.calls == 1
+
+
+def test_timed_out_edit_is_retried(sender):
+    call = Flaky(TimedOut())
+    assert sender.submit(1, call, (), {}, key=('edit', 7)).result(5) == 'sent'
+    assert call.calls == 2
@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+import pytest
+from telegram.ext import ConversationHandler
+from persistence import SqlitePersistence
+from sessions import Sessions
+
+
+@pytest.fixture
+def persistence(tmp_path):
+    persistence = SqlitePersistence(str(tmp_path / 'persistence.sqlite'), flush_interval=3600)
+    yield persistence
+    persistence.close()
+
+
+def test_evicted_user_leaves_the_persistence(persistence, tmp_path):
+    for user_id in (1, 2):
+        persistence.update_user_data(user_id, {'story_id': user_id})
+        persistence.update_conversation('main', (user_id, user_id), 'EDIT_STORY')
+    persistence.flush()
+
+    handler = ConversationHandler(entry_points=[], states={}, fallbacks=[], name='main', persistent=True)
+    handler.persistence = persistence
+    handler.conversations = persistence.get_conversations('main')
+    dispatcher = SimpleNamespace(user_data=persistence.get_user_data(), persistence=persistence)
+    sessions = Sessions(dispatcher, [handler], max_entries=1, spill_path=str(tmp_path / 'sessions.sqlite'))
+    sessions.evict()
+    persistence.flush()
+
+    restarted = SqlitePersistence(persistence.path)
+    assert dict(restarted.get_user_data()) == {2: {'story_id': 2}}
+    assert restarted.get_conversations('main') == {(2, 2): 'EDIT_STORY'}
+    restarted.close()
+
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1))
+    sessions.touch(update, None)
+    assert dispatcher.user_data[1] == {'story_id': 1}
+    assert handler.conversations[(1, 1)] == 'EDIT_STORY'
+    sessions.close()
+
+
+def test_user_active_since_the_snapshot_is_not_evicted(persistence, tmp_path):
+    dispatcher = SimpleNamespace(user_data={1: {'story_id': 1}, 2: {'story_id': 2}}, persistence=persistence)
+    sessions = Sessions(dispatcher, [], max_entries=1, spill_path=str(tmp_path / 'sessions.sqlite'))
+    keys = sessions._conversation_keys
+
+    def update_arrives():
+        # user 1 sends an update after evict() took its snapshot
+        sessions.touch(SimpleNamespace(effective_user=SimpleNamespace(id=1)), None)
+        return keys()
+
+    sessions._conversation_keys = update_arrives
+    sessions.evict()
+    assert dispatcher.user_data == {1: {'story_id': 1}}
+    assert sessions.count() == 1
+    sessions.close()
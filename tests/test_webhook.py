@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+from queue import Queue
+import pytest
+import requests
+from telegram import Bot
+from conftest import FIXTURES
+import webhook
+from webhook import SECRET_HEADER, WebhookServer
+
+
+PATH = '/telegram'
+SECRET = 'test-secret'
+
+
+@pytest.fixture
+def server():
+    server = WebhookServer(('127.0.0.1', 0), Bot('123:test'), Queue(), PATH, SECRET)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server):
+    return f'http://127.0.0.1:{server.server_address[1]}{PATH}'
+
+
+def post(server, body, secret=SECRET):
+    return requests.post(url(server), data=body, headers={SECRET_HEADER: secret}, timeout=5)
+
+
+def test_recorded_updates_reach_the_queue(server, capsys):
+    webhook.replay(os.path.join(FIXTURES, 'updates.jsonl'), url(server), SECRET)
+
+    updates = [server.update_queue.get(timeout=1) for _ in range(3)]
+    assert [update.update_id for update in updates] == [815700001, 815700002, 815700003]
+    assert updates[0].message.text == '/start'
+    assert updates[1].callback_query.data == '\x13'
+    assert capsys.readouterr().out.count('200 ') == 3
+
+
+def test_invalid_secret_is_rejected(server):
+    assert post(server, b'{"update_id": 1}', secret='wrong').status_code == 403
+    assert server.update_queue.empty()
+
+
+@pytest.mark.parametrize('body', [b'[]', b'1', b'"update"', b'null', b'{not json', b'{"message": {}}'])
+def test_invalid_updates_are_rejected(server, body):
+    assert post(server, body).status_code == 400
+    assert server.update_queue.empty()
+
+
+def test_unknown_path_is_not_found(server):
+    response = requests.post(url(server) + '/other', data=json.dumps({'update_id': 1}), timeout=5)
+    assert response.status_code == 404
+
+
+def test_listener_needs_a_secret():
+    with pytest.raises(ValueError):
+        WebhookServer(('127.0.0.1', 0), Bot('123:test'), Queue(), PATH, '')
+
+
+def test_oversized_body_closes_the_connection(server):
+    with requests.Session() as session:
+        response = session.post(url(server), data=b'{' + b' ' * webhook.MAX_BODY_SIZE + b'}',
+                                headers={SECRET_HEADER: SECRET}, timeout=5)
+        assert response.status_code == 400
+        assert response.headers['Connection'] == 'close'
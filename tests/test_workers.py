@@ -0,0 +1,48 @@
+import threading
+import time
+from workers import ChatExecutor
+
+
+def test_tasks_of_a_chat_keep_their_order():
+    executor = ChatExecutor(4)
+    done = []
+
+    def task(number):
+        # later tasks are quicker, run in parallel they would finish first
+        time.sleep(0.05 - number * 0.01)
+        done.append(number)
+
+    for number in range(5):
+        executor.submit(1, task, number)
+    executor.shutdown()
+    assert done == [0, 1, 2, 3, 4]
+
+
+def test_chats_run_in_parallel():
+    executor = ChatExecutor(3)
+    # every task waits for the other two, run one at a time they would time out
+    together = threading.Barrier(3, timeout=5)
+    passed = []
+    for chat in range(3):
+        executor.submit(chat, lambda: passed.append(together.wait()))
+    executor.shutdown()
+    assert len(passed) == 3
+
+
+def test_shutdown_runs_what_is_queued():
+    executor = ChatExecutor(2)
+    done = []
+    for number in range(10):
+        executor.submit(number % 2, lambda number: (time.sleep(0.01), done.append(number)), number)
+    executor.shutdown()
+    assert sorted(done) == list(range(10))
+    assert executor.pending() == 0
+
+
+def test_failing_task_doesnt_stop_the_chat():
+    executor = ChatExecutor(1)
+    done = []
+    executor.submit(1, lambda: 1 / 0)
+    executor.submit(1, done.append, 'next')
+    executor.shutdown()
+    assert done == ['next']
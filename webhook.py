@@ -0,0 +1,124 @@
+import argparse
+import hmac
+import json
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telegram import Update
+from telegram.error import TelegramError
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, bot, update_queue, path, secret):
+        if not secret:
+            # anyone reaching the listener could post updates, as any user admins included
+            raise ValueError('Webhook secret is not set, updates are not accepted without one')
+        super().__init__(address, WebhookHandler)
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.secret = secret
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        # a rejected body is left unread, the connection can't be reused for the next request
+        if self.path != self.server.path:
+            return self.reply(404, close=True)
+        secret = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret, self.server.secret):
+            logger.warning(f'Webhook request with invalid secret from {self.client_address[0]}')
+            return self.reply(403, close=True)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_BODY_SIZE:
+            return self.reply(400, close=True)
+        try:
+            data = json.loads(self.rfile.read(length))
+            if not isinstance(data, dict):
+                raise ValueError('update is not an object')
+            update = Update.de_json(data, self.server.bot)
+        except (ValueError, KeyError, TypeError) as err:
+            logger.warning(f'Webhook request with invalid update {err}')
+            return self.reply(400)
+        self.server.update_queue.put(update)
+        self.reply(200)
+
+    def reply(self, code, close=False):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start(updater):
+    """
+    Receive updates through the webhook listener, returns None when the webhook can't be used
+    """
+    try:
+        server = WebhookServer((settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT), updater.bot, updater.update_queue,
+                               settings.WEBHOOK_PATH, settings.WEBHOOK_SECRET)
+    except OSError as err:
+        logger.error(f'Webhook listener failed, falling back to polling {err}')
+        return None
+
+    try:
+        updater.bot.set_webhook(url=settings.WEBHOOK_URL, secret_token=settings.WEBHOOK_SECRET or None,
+                                max_connections=settings.WEBHOOK_MAX_CONNECTIONS)
+    except TelegramError as err:
+        logger.error(f'Webhook registration failed, falling back to polling {err}')
+        server.server_close()
+        return None
+
+    run(updater, server)
+    logger.info(f'Webhook listening on {settings.WEBHOOK_LISTEN}:{settings.WEBHOOK_PORT}{settings.WEBHOOK_PATH}')
+    return server
+
+
+def run(updater, server):
+    # same startup as Updater.start_polling, so Updater.idle() and stop() shut everything down
+    updater.running = True
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher').start()
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+
+
+def replay(path, url, secret):
+    """
+    POST recorded updates, one JSON object per line, to a webhook listener
+    """
+    import requests
+
+    session = requests.Session()
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            response = session.post(url, data=line.encode(), headers={
+                SECRET_HEADER: secret,
+                'Content-Type': 'application/json'
+            })
+            print(f'{response.status_code} {line[:60].strip()}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded Telegram updates to the webhook listener')
+    parser.add_argument('updates', help='file with one update JSON per line')
+    parser.add_argument('--url', default=f'http://127.0.0.1:{settings.WEBHOOK_PORT}{settings.WEBHOOK_PATH}')
+    parser.add_argument('--secret', default=settings.WEBHOOK_SECRET)
+    args = parser.parse_args()
+    replay(args.updates, args.url, args.secret)
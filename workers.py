@@ -0,0 +1,83 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChatExecutor:
+    """
+    Runs tasks in a thread pool, one at a time and in order for the same key, in parallel for different keys
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat')
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # key is busy, its drain picks the task up in order
+                queue.append((fn, args))
+                return
+            self._queues[key] = deque([(fn, args)])
+        self._pool.submit(self._drain, key)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def shutdown(self, wait=True):
+        """
+        Stop taking keys, the tasks already queued still run
+        """
+        with self._lock:
+            self._stopping = True
+        self._pool.shutdown(wait=wait)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                fn, args = self._queues[key].popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception(f'Task for {key} failed')
+            with self._lock:
+                if not self._queues[key]:
+                    del self._queues[key]
+                    return
+                if not self._stopping:
+                    # requeue instead of looping so one busy chat can't hold a worker
+                    self._pool.submit(self._drain, key)
+                    return
+            # a shut down pool takes no more tasks, the rest of the key's queue runs on this thread
+
+
+def update_key(update):
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+
+def install(dispatcher, workers):
+    """
+    Process updates of different chats in parallel while updates from the same chat keep their order
+    """
+    executor = ChatExecutor(workers)
+    process_update = dispatcher.process_update
+
+    def submit(update):
+        executor.submit(update_key(update), process_update, update)
+
+    dispatcher.process_update = submit
+    return executor